@@ -10,6 +10,8 @@ from osgeo import ogr, gdal
 import os
 import functions.project_setup as ps
 import functions.data_processing as dp
+import functions.change_tracker as ct
+import functions.layer_registry as lr
 import pdb
 import logging
 
@@ -52,12 +54,17 @@ if not os.path.exists(log_file):
 
 
 
-last_modification_time = ps.get_file_modification_time( anchor_csv)
-last_run_time = ps.get_last_run_time(log_file)
+#fingerprint every line record so only added or changed lines are recomputed
+fingerprint_file = project_directory + '/logs/' + 'line_fingerprints.json'
+line_fingerprints = ct.read_fingerprints_from_csv( anchor_csv)
+line_changes = ct.diff_fingerprints( line_fingerprints, ct.load_fingerprints( fingerprint_file))
+previous_outputs = os.path.exists( outs + 'highline_anchors.shp') and os.path.exists( outs + 'highline_anchors_points.shp')
+rebuild = bool( line_changes['changed'] or line_changes['added'] or line_changes['removed']) or not previous_outputs
+print( 'Line records: ' + ', '.join( k + ' ' + str( len( v)) for k, v in line_changes.items()))
 
 
 
-if last_modification_time >= last_run_time:
+if rebuild:
     print( 'Detected Modification to Source CSV')
     print( 'Converting CSV to Shapefile')
     #The New data entry app writes a csv to t
@@ -68,11 +75,11 @@ if last_modification_time >= last_run_time:
     layer.setCrs( basic_crs)
     writer = QgsVectorFileWriter.writeAsVectorFormat(layer, raw + anchors, 'utf-8', basic_crs, 'ESRI Shapefile')
     ps.reproject_shapefile( raw + anchors, processed + anchors, epsg_code)
-    iface.addVectorLayer( processed + anchors, 'highline_anchors', 'ogr')  
+    ps.add_vector_layer( processed + anchors, 'highline_anchors')  
     ps.add_id_column('highline_anchors', 'line_id')
 else:
-    iface.addVectorLayer( outs + 'highline_anchors.shp', 'highline_anchors', 'ogr')
-    iface.addVectorLayer( outs + 'highline_anchors_points.shp', 'highline_anchors_points', 'ogr')
+    ps.add_vector_layer( outs + 'highline_anchors.shp', 'highline_anchors')
+    ps.add_vector_layer( outs + 'highline_anchors_points.shp', 'highline_anchors_points')
 
 
 
@@ -105,10 +112,9 @@ if blm_land not in os.listdir( processed):
 ## Close the Geodatabase
 #gdb = None
 
-#Load state and province outlines
-iface.addVectorLayer(  processed + states, 'United States', 'ogr')
-iface.addVectorLayer(  processed + fs_land, 'Forest Service Land', 'ogr')
-iface.addVectorLayer( processed + blm_land, 'BLM Land', 'ogr')
+#Load land outlines, states are assigned from a lookup grid in 02_data_extraction
+ps.add_vector_layer( processed + fs_land, 'Forest Service Land')
+ps.add_vector_layer( processed + blm_land, 'BLM Land')
 
 #iface.addVectorLayer( canada, 'Canada', 'ogr')
 
@@ -126,15 +132,20 @@ iface.addVectorLayer( processed + blm_land, 'BLM Land', 'ogr')
 #if 'highline_anchors_points.shp' in os.listdir( outs):
 #    iface.addVectorLayer( outs + 'highline_anchors_points.shp', 'highline_anchors_points', 'ogr')
 #else:
-if last_modification_time >= last_run_time:
-    #create a point layer of each line with points seperated by 1 meter
-    dp.lines_to_points( 'highline_anchors', 'highline_anchors_points', 'line_id')
+if rebuild:
+    if previous_outputs and line_changes['unchanged']:
+        #only added and changed lines are turned into points, the points of unchanged lines are copied from the
+        #last outputs together with their states, crossings and elevations, 02 then only fills the gaps
+        new_records = set( line_changes['changed'] + line_changes['added'])
+        new_lines = [f['line_id'] for f in lr.resolve( 'highline_anchors').getFeatures() if str( f['id']) in new_records]
+        dp.lines_to_points( 'highline_anchors', 'highline_anchors_points', 'line_id', line_ids = new_lines)
+        ct.merge_previous_results( 'highline_anchors', 'highline_anchors_points', outs + 'highline_anchors.shp',
+                                   outs + 'highline_anchors_points.shp', line_changes['unchanged'])
+    else:
+        #create a point layer of each line with points seperated by 1 meter
+        dp.lines_to_points( 'highline_anchors', 'highline_anchors_points', 'line_id')
     #give this layer an ID column
     ps.add_id_column('highline_anchors_points', 'id')
-    #group points into clusters for to reduce computation diurring rasterization
-    dp.cluster_points_with_dbscan("highline_anchors_points", eps=0.004, min_samples=15)
-    #color points catagoricly based on cluster_group
-    ps.apply_categorized_symbology("highline_anchors_points", "cluster_group")
 
 #Convert all layers to Project CRS
 all_layers = QgsProject.instance().mapLayers().values()
@@ -150,7 +161,7 @@ for layer in all_layers:
         print("Layer Projection:", layer.crs().authid())
 
  #Refresh the map canvas to update the changes
-iface.mapCanvas().refreshAllLayers()
+ps.refresh_canvas()
 
 
 original_layers = QgsProject.instance().mapLayers().values()
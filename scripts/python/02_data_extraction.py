@@ -3,10 +3,19 @@ import pdb
 from qgis.core import (QgsSpatialIndex, QgsFeatureRequest, QgsGeometry, QgsVectorLayer, QgsRasterLayer,
                        QgsVectorFileWriter, QgsFeature, QgsField, QgsCoordinateTransformContext, QgsPointXY,
                        QgsWkbTypes, QgsProject, QgsRaster, QgsMapLayerRenderer)
+from qgis.PyQt.QtCore import QVariant
                        
 import functions.project_setup as ps
 import functions.data_processing as dp
 import functions.helper_functions as hf
+import functions.tile_cache as tc
+import functions.tnm_downloader as td
+import functions.surface_interpolation as si
+import functions.change_tracker as ct
+import functions.instrumentation as ins
+import functions.layer_registry as lr
+import functions.layer_mirror as lm
+import functions.tile_scheduler as ts
 import time
 
 usgs = 'usgs_shapefiles/'
@@ -17,15 +26,22 @@ usgs_processed_path = processed + usgs
 
 temp_path = raw.replace( 'raw', 'temp')
 
+#downloads from The National Map are kept here between runs so a rerun reuses them
+tnm_cache = tc.TileCache( raw + 'tnm_cache/')
+#downloads run on a thread pool so the next quad's tiles can be fetched while this one is processed
+downloader = td.TNMDownloader( cache = tnm_cache)
+#time and counters of every stage of every quad are written to logs/extraction_<start time>.jsonl
+run_log = ins.RunLog( project_directory + '/logs/', 'extraction')
+
 
 #list of all layers in proj
 all_layers = QgsProject.instance().mapLayers().values()
 # Add a new field to the attribute table to store elevations
-anchors = ps.select_layers_by_substrings( all_layers, ['highline_anchors'])
-anchor_points = ps.select_layers_by_substrings( all_layers, ['highline_anchors_points'])
+#layer handles, the helpers accept them in place of names. Looked up by exact name, the substring
+#'highline_anchors' also matches the points layer
+anchors = lr.resolve( 'highline_anchors')
+anchor_points = lr.resolve( 'highline_anchors_points')
 
-anchors = anchors[0]
-anchor_points = anchor_points[0]
 #State extraction 
 #may potentially be able to add other polygons to this 
 
@@ -33,15 +49,17 @@ anchor_points = anchor_points[0]
 # For nation wide layers we can extract all data at once
 # TODO find shapefiles for landtype and jurisdiction
 
-dp.add_state_to_attribute_table( 'United States', 'highline_anchors', 'state')
-dp.extract_lengths( 'highline_anchors', 'length')
-dp.check_features_within_bounds( 'highline_anchors', 'Forest Service Land', 'fs_land')
-dp.check_features_within_bounds( 'highline_anchors', 'BLM Land', 'blm_land')
+#states come from a lookup grid saved beside the outlines, the state layer is not loaded
+with run_log.stage( 'line_attributes'):
+    run_log.count( 'features_read', anchors.featureCount())
+    dp.add_state_to_attribute_table( processed + states, 'highline_anchors', 'state')
+    dp.extract_lengths( 'highline_anchors', 'length')
+    dp.check_features_within_bounds( 'highline_anchors', ['Forest Service Land', 'BLM Land'], ['fs_land', 'blm_land'])
 
 # Because USGS topo layers are so large we need to do this in a for loop iterating over each square
-# 1) Download shapefile for given cluster
-# 2) Determine all clusters within shapefiles bounds
-# 3) Itterate through each cluster within said bounds and 
+# 1) Download the topo package of a 7.5 minute quad holding highlines
+# 2) Select the lines touching the quad
+# 3) Itterate through windows of the quad's points and 
 #   3a) Rasterize and make continuous contour layers
 #   3b) Extract intersection data with trails, roads, and railroads
 #   3c)TODO add hydrology layer for bodies of water and rivers
@@ -67,98 +85,141 @@ if len( all_downloaded_layers) > 0:
         ps.delete_folder( downloads)
 
 if len( hf.prepend( os.listdir( usgs_processed_path), usgs_processed_path) +  hf.prepend( os.listdir( usgs_path), usgs_path)) > 0:
+    #without a console to debug in (run_pipeline.py) stop instead of waiting on stdin
+    if not ps.has_gui():
+        raise RuntimeError( 'Unable to delete the earlier downloads in ' + usgs_path + ' and ' + usgs_processed_path)
     pdb.set_trace()
 
-groups = np.unique( ps.get_column_values( 'highline_anchors_points', 'cluster_group'))
-to_skip_exists = 'to_skip' in locals() or 'to_skip' in globals()
+#columnar copy of the point attributes and coordinates, the quad and line lookups below are array
+#slices instead of layer scans. Sampled elevations are kept in it and written to the layer per quad by sync
+points = lm.LayerMirror( anchor_points, ['line_id', 'index', 'elevation'])
+#a fresh points layer has no elevation field yet, the column starts empty and sync creates the field
+if 'elevation' not in points.columns:
+    points.set( 'elevation', points.fids, np.full( len( points), np.nan), field_type = QVariant.Double, dirty = False)
+#work is planned on the grid of the 7.5 minute topo packages instead of the DBSCAN clusters: each quad is
+#rasterized and sampled once and lines crossing a quad edge are worked on in every quad they touch
+scheduler = ts.QuadScheduler( points.fids, points.values( 'line_id'), points.x, points.y, epsg_code)
+quads = scheduler.order()
+done_exists = 'done_quads' in locals() or 'done_quads' in globals()
 
-if to_skip_exists:
-    print( 'Clusters ' + str( to_skip) + ' have already been itterated through.  Skipping them')
+if done_exists:
+    print( 'Quads ' + str( [scheduler.name( q) for q in done_quads]) + ' have already been itterated through.  Skipping them')
 else:
     print( 'Starting from the beginning')
-    #stash starting layers
-    #initiate skip array, items get appended to this occured in an earlier shapefile extent
-    to_skip = []
-    #initiate incomplete array, clusters that are unfinished get added to this
-    incomplete = []
-    #loop through cluster groups and get layers    
-    g = 0
-
-
-#If we are just rerunning this in order to populate new line values this limits 
-#what it itterates through by rebuilding the to_skip variable 
-point_names = ps.get_attribute_table_names( 'highline_anchors_points')
-to_do = []
-if 'elevation' in point_names and to_skip_exists == False:
-    for i in groups[0]:
-        print( i)
-        cluster_is = ps.select_indexes_from_values( 'highline_anchors_points', 'cluster_group', [i])
-        eles = ps.select_values_from_index( 'highline_anchors_points', cluster_is, 'elevation')
-        if  None in eles or NULL in eles:
-            to_do.append( i)
-        else:
-            to_skip.append( i)
+    #initiate done array, quads whose points all have elevations get appended to this
+    done_quads = []
+#initiate incomplete array, quads that are unfinished in this run get added to this. It is reset on every run so
+#a failed run does not keep later runs from saving the fingerprints
+incomplete = []
+#crossings found so far per target and line, a line crossing several quads is counted over all of their packages.
+#Kept between reruns in the console like done_quads
+if 'crossing_points' not in globals():
+    crossing_points = {}
+
+
+#If we are just rerunning this in order to populate new line values this limits
+#what it itterates through by rebuilding the done_quads variable
+point_names = ps.get_attribute_table_names( anchor_points)
+if 'elevation' in point_names and done_exists == False:
+    for q in quads:
+        eles = points.values( 'elevation', scheduler.points( q))
+        if not np.isnan( eles.astype( float)).any():
+            done_quads.append( q)
+
 
 
+#elevation surfaces are built in process unless use_grass is set, surface_mode trades quality for speed
+use_grass = False
+surface_mode = 'quality'
+#profile_mode 'contour' skips the surface and interpolates each line directly between the contours it crosses
+profile_mode = 'surface'
 
-print( 'Starting while loop')
-while g <= max( groups[0]):
-    iface.mapCanvas().refreshAllLayers()
-    if g not in to_skip:
-        print( '----Assesing Cluster ' + str( g) + '----')
-        g_indexes = ps.select_indexes_from_values( 'highline_anchors_points', 'cluster_group', [g])
-        bb = dp.get_bounding_box_dimensions( anchor_points, g_indexes)
-        utm_bbox = bb['min_x'],bb['min_y'], bb['max_x'],  bb['max_y']
-        converted_bbox = dp.convert_bbox_to_decimal_degrees( utm_bbox, '26912')
-        # Download a shapefile from the National Map
+#only these layers are extracted from the downloaded topo packages
+wanted = ['Rail', 'Trail', 'Road', 'Elev']
+
+#quads still to work on that need each package. A package shared with a neighbor is extracted and reprojected
+#once, its folders are kept until the last quad needing it is done
+package_quads = {}
+package_folders = {}
+for q in quads:
+    if q not in done_quads:
+        for package in scheduler.packages( q):
+            package_quads.setdefault( package, set()).add( q)
+
+print( 'Starting quad loop, ' + str( len( quads)) + ' quads hold highlines')
+for n, q in enumerate( quads):
+    ps.refresh_canvas()
+    quad = scheduler.name( q)
+    if q not in done_quads:
+        print( '----Assesing Quad ' + quad + '----')
+        # Download the quad's topo package from the National Map, with the packages of the neighboring quads its edge windows reach into
         print( '1) Downloading shapefiles from The National Map')
-        files = ps.download_shapefile_from_bbox( converted_bbox, usgs_path)
+        packages = scheduler.packages( q)
+        with run_log.stage( 'download', cluster = quad):
+            files = []
+            for package in packages:
+                package_files = downloader.download( scheduler.bounds( package), usgs_path, layers = wanted)
+                package_folders[ package] = package_files or []
+                #the bytes of the quad's packages, also when they were prefetched while the previous quad was worked on
+                run_log.count( 'bytes_downloaded', downloader.last_download_bytes)
+                if package_files is None and package == q:
+                    files = None
+                    break
+                files += package_files or []
+        #prefetch the tiles of the next quad while this one is rasterized, it is a neighbor in the quad order
+        next_quads = [p for p in quads[n + 1:] if p not in done_quads]
+        if next_quads:
+            for package in scheduler.packages( next_quads[0]):
+                downloader.prefetch( scheduler.bounds( package))
         if files is None:
             print( 'The National Map returned no JSON response for specified area')
-            incomplete.append( g)
-            g += 1
+            incomplete.append( q)
         else:
-            folder_num = 0
-            wanted = ['Rail', 'Trail', 'Road', 'Elev']
-            for folder in os.listdir( usgs_path):
-                if folder in list(map(os.path.basename, files)):
-                    if len( files) == 1:
-                        folder_num = ''
-                    else:
-                        folder_num = int( folder_num) + 1 
-                    shp_path = usgs_path + folder + '/Shape/'
-                    for file in os.listdir( shp_path):
-                        if file.endswith('.shp'):                
-                            if any(substring in file for substring in wanted):
-                                basename = os.path.basename( file)
-                                reprojected_shp = usgs_processed_path + folder + '/' + basename
-                                ps.reproject_shapefile( shp_path + file, reprojected_shp, epsg_code)
-                                layer_name = basename.replace( '.shp','') + str( folder_num)
-                                iface.addVectorLayer( reprojected_shp, layer_name, 'ogr')
+            with run_log.stage( 'load_layers', cluster = quad):
+                folder_num = 0
+                for folder in os.listdir( usgs_path):
+                    if folder in list(map(os.path.basename, files)):
+                        if len( files) == 1:
+                            folder_num = ''
+                        else:
+                            folder_num = int( folder_num) + 1 
+                        shp_path = usgs_path + folder + '/Shape/'
+                        for file in os.listdir( shp_path):
+                            if file.endswith('.shp'):                
+                                if any(substring in file for substring in wanted):
+                                    basename = os.path.basename( file)
+                                    reprojected_shp = usgs_processed_path + folder + '/' + basename
+                                    #packages kept from an earlier quad are already reprojected
+                                    if not os.path.exists( reprojected_shp):
+                                        ps.reproject_shapefile( shp_path + file, reprojected_shp, epsg_code)
+                                    layer_name = basename.replace( '.shp','') + str( folder_num)
+                                    added = ps.add_vector_layer( reprojected_shp, layer_name)
+                                    if added:
+                                        run_log.count( 'features_read', added.featureCount())
             
-            all_layers = QgsProject.instance().mapLayers().values()
-            #Merge all layers if bounding box for cluster g overlaps multiple areas
-            if files:
-                if len( files) > 1:
-                    print( 'There are multiple files downloaded from The National Map. Merging them...')
-                    for keyword in wanted:
-                        all_layers = QgsProject.instance().mapLayers().values()
-                        if keyword not in ['Water', 'Elev'] : 
-                            keyword = "_" + keyword
-                        layers_to_join =  ps.select_layers_by_substrings( all_layers, [keyword])
-                        similarlayers = []
-                        for layer in layers_to_join:
-                            similarlayers.append( layer.name())
-                        dp.merge_layers( similarlayers, re.sub(r'\d', '', layers_to_join[0].name()))
-                        if keyword == 'Elev':
-                            contour_path = temp_path + 'contours.shp'
-                            ps.save_temp_layer_as_permanent( 'Elev_Contour', contour_path)
+                all_layers = QgsProject.instance().mapLayers().values()
+                #Merge all layers if several packages were downloaded for the quad
+                if files:
+                    if len( files) > 1:
+                        print( 'There are multiple files downloaded from The National Map. Merging them...')
+                        for keyword in wanted:
+                            all_layers = QgsProject.instance().mapLayers().values()
+                            if keyword not in ['Water', 'Elev'] : 
+                                keyword = "_" + keyword
+                            layers_to_join =  ps.select_layers_by_substrings( all_layers, [keyword])
+                            similarlayers = []
+                            for layer in layers_to_join:
+                                similarlayers.append( layer.name())
+                            dp.merge_layers( similarlayers, re.sub(r'\d', '', layers_to_join[0].name()))
+                            if keyword == 'Elev':
+                                contour_path = temp_path + 'contours.shp'
+                                ps.save_temp_layer_as_permanent( 'Elev_Contour', contour_path)
+                    else:
+                        contour_path = usgs_processed_path + os.path.basename( files[0]) + '/Elev_Contour.shp'                
                 else:
-                    contour_path = usgs_processed_path + os.path.basename( files[0]) + '/Elev_Contour.shp'                
-            else:
-                print( 'Single File Downloaded from The National Map')
-                contour_path = usgs_processed_path + os.path.basename( files[0]) + '/Elev_Contour.shp'
-            
+                    print( 'Single File Downloaded from The National Map')
+                    contour_path = usgs_processed_path + os.path.basename( files[0]) + '/Elev_Contour.shp'
+
             #refresh all layers
             all_layers = QgsProject.instance().mapLayers().values()
             #get contour layer
@@ -166,98 +227,129 @@ while g <= max( groups[0]):
             contours = ps.select_layers_by_substrings( all_layers, ['Contour'])
             #print( contours)
             contours = contours[0]
-            print(  '2) Select highlines that exist within contours')
-            
-            #get highlines that intersect with contours
-            int_indexs = dp.get_intersecting_indexes( 'highline_anchors', 'Elev_Contour')
-            #select associated line ids
-            line_ids_in_contours = np.unique( ps.select_values_from_index( 'highline_anchors', int_indexs, 'line_id'))
-            #use line ids to select indexs from points layer
-            points_in_contours = ps.select_indexes_from_values( 'highline_anchors_points', 'line_id', line_ids_in_contours)
-            
-            if points_in_contours == []: #this is incase non of the lines overlap contours. we can assume that the cluster we are itterating over is within the bounds of the contours
-                points_in_contours = g_indexes
-                
-            #use indexs to select unique clusters
-            clusters_o = np.unique( ps.select_values_from_index( 'highline_anchors_points', points_in_contours, 'cluster_group'))
-            #remove clusters we already itterated over
-            set1 =  set( to_skip)
-            set2 = set(clusters_o)        
-            clusters = list(set2.difference(set1))
-            #loop through the clusters to reduce computation time from rasterization
-            print( 'There are ' + str( len( clusters)) + ' clusters within these contours')
-            print( 'Itterating over ' + str( len( clusters)) + ' of them')
-            
-            for z in clusters:
-                cluster_layers = []
-                #select indexs of points in cluster
-                cluster_lines = ps.select_indexes_from_values( 'highline_anchors_points', 'cluster_group', [z])
-                #get lines in contours and those in cluster z
-                these_lines = list(set(cluster_lines).intersection(points_in_contours))
-                
-                if these_lines == []:
-                    these_lines = cluster_lines
-                #select line_ids in cluster
-                line_ids = np.unique( ps.select_values_from_index( 'highline_anchors_points', these_lines, 'line_id'))
-                #select indexs from original layer
-                line_indexs = ps.select_indexes_from_values( 'highline_anchors', 'line_id', line_ids)
-                
-        
-                
+            print(  '2) Select highlines within the quad')
+            quad_points = scheduler.points( q)
+            line_ids = scheduler.lines( q)
+            print( 'There are ' + str( len( line_ids)) + ' lines within this quad')
+            if contour_path:
+                contour_layer_path = contour_path
+            else:
+                contour_layer_path = usgs_processed_path + os.path.basename(files[0]) + '/Elev_Contour.shp'
+            attribute_field = 'ContourEle'
+
+            to_sample = quad_points
+            if profile_mode == 'contour':
+                #only the contours next to the quad's windows are downloaded, the lines reaching further out of the
+                #quad are not profiled and their points in this quad are sampled from the surface
+                edge_lines = scheduler.shared_lines( q)
+                inner_lines = np.setdiff1d( line_ids, edge_lines)
+                with run_log.stage( 'contour_intersections', cluster = quad):
+                    #the hit matrix maps each line id to the contours it crosses. It is built from the file the profiles
+                    #read, the Elev_Contour layer of merged packages is a memory layer whose feature ids differ from the file's
+                    contour_source = QgsVectorLayer( contour_layer_path, 'Contours', 'ogr')
+                    contour_hits = dp.get_intersection_matrix( 'highline_anchors', contour_source, 'line_id')
+                    run_log.count( 'features_read', contours.featureCount())
+                #intersect the lines with the contours, no raster is built
+                print( '3)Extracting contour profiles for quad ' + quad)
+                with run_log.stage( 'contour_profiles', cluster = quad):
+                    profiles = dp.contour_profile_along_lines( 'highline_anchors', contour_layer_path, 'highline_anchors_points', 'line_id', attribute_field, line_ids = inner_lines, hits = contour_hits)
+                    run_log.count( 'points_sampled', sum( len( profile[1]) for profile in profiles.values()))
+                #the profiles were written to the layer directly
+                points.refresh( 'elevation')
+                to_sample = np.intersect1d( quad_points, points.indexes( 'line_id', edge_lines))
+
+            #a whole quad is too large to rasterize at once, its points are rasterized and sampled window by window
+            windows = scheduler.windows( q, to_sample)
+            print( 'Itterating over ' + str( len( windows)) + ' windows')
+            for w, window in enumerate( windows):
+                window_name = quad + '/' + str( w)
+                window_layers = []
+
                 # 4) create bounding box to reduce computation
-                print( '3) Creating Bounding Box for cluster ' + str( z))
-                bb = dp.get_bounding_box_dimensions( anchors, line_indexs)
-                temp_raster = temp_path + 'output_raster.tif'
-                bounding_box = QgsRectangle( bb['min_x'],bb['min_y'], bb['max_x'],  bb['max_y'])
-                bb_path = temp_path + 'raster_bb.shp'
-                dp.create_polygon_layer_from_bbox( bounding_box, bb_path, crs)
-                
+                print( '3) Creating Bounding Box for window ' + window_name)
+                bb = points.bounding_box( window)
+
                 # 5) rasterize features
                 print( '4) Rasterizing')
-                if contour_path:
-                    contour_layer_path = contour_path
+                if use_grass:
+                    temp_raster = temp_path + 'output_raster.tif'
+                    bounding_box = QgsRectangle( bb['min_x'],bb['min_y'], bb['max_x'],  bb['max_y'])
+                    bb_path = temp_path + 'raster_bb.shp'
+                    dp.create_polygon_layer_from_bbox( bounding_box, bb_path, crs)
+                    bounding_box_layer_name = 'Bounding Box'  # Name of the bounding box layer in the GUI
+                    window_layers.append( bounding_box_layer_name)
+                    output_raster_path = project_directory + '/shapefiles/temp/contour_raster.tif'
+
+                    raster_name = 'Rasterized Contours'
+                    window_layers.append( raster_name)
+                    with run_log.stage( 'rasterize', cluster = quad, window = w):
+                        dp.rasterize_contours_within_bbox( contour_layer_path, bounding_box_layer_name, attribute_field, output_raster_path)
+                        input_raster_layer = QgsProject.instance().mapLayersByName(raster_name)[0]
+                        run_log.count( 'raster_cells', input_raster_layer.width() * input_raster_layer.height())
+                    print( 'Making Raster Layer Continuous. This may take a few moments...')
+                    with run_log.stage( 'interpolate', cluster = quad, window = w):
+                        continuous_raster_layer = dp.make_raster_continuous(input_raster_layer)
+                    # 6)extract elevations
+                    print( '5)Extracting points for window ' + window_name)
+                    with run_log.stage( 'sample', cluster = quad, window = w):
+                        sampled_ids, sampled = dp.sample_raster_values('highline_anchors_points', 'Rasterized Contours', 'Bounding Box')
+                        run_log.count( 'points_sampled', len( sampled_ids))
+                    #every point in the box was written to the layer. The mirror keeps the values of the window's points,
+                    #the points of other windows and quads get their earlier values back with the next sync
+                    sampled_ids = np.asarray( sampled_ids, dtype = np.int64)
+                    in_window = np.isin( sampled_ids, window)
+                    points.set( 'elevation', sampled_ids[ in_window], np.asarray( sampled)[ in_window], dirty = False)
+                    others = sampled_ids[ ~in_window]
+                    points.set( 'elevation', others, points.values( 'elevation', others))
                 else:
-                    contour_layer_path = usgs_processed_path + os.path.basename(files[0]) + '/Elev_Contour.shp'
-                bounding_box_layer_name = 'Bounding Box'  # Name of the bounding box layer in the GUI
-                cluster_layers.append( bounding_box_layer_name)
-                attribute_field = 'ContourEle'
-                output_raster_path = project_directory + '/shapefiles/temp/contour_raster.tif'
-                #pdb.set_trace()
-                
-                raster_name = 'Rasterized Contours'
-                cluster_layers.append( raster_name)
-                dp.rasterize_contours_within_bbox( contour_path, bounding_box_layer_name, attribute_field, output_raster_path)
-                input_raster_layer = QgsProject.instance().mapLayersByName(raster_name)[0]
-                print( 'Making Raster Layer Continuous. This may take a few moments...')
-                continuous_raster_layer = dp.make_raster_continuous(input_raster_layer)
-                #make_raster_continuous( )
-                # 6)extract elevations 
-                print( '5)Extracting points for cluster ' + str( z))
-                dp.sample_raster_values('highline_anchors_points', 'Rasterized Contours', 'Bounding Box')            
-                elevations = ps.select_values_from_index( 'highline_anchors_points', cluster_lines, 'elevation')
-                
-                if None in elevations :
-                    print( 'Not all points have elevations for cluster ' + str(z))
-                    incomplete.append( z)
-                else: 
-                    to_skip.append( z)                
-                
-                for layer in cluster_layers:
+                    #rasterize and interpolate in memory, nothing is written to disk or added to the project
+                    with run_log.stage( 'rasterize', cluster = quad, window = w):
+                        contour_array, geotransform = dp.rasterize_contours_to_array( contour_layer_path, ( bb['min_x'], bb['min_y'], bb['max_x'], bb['max_y']), attribute_field)
+                        if contour_array is not None:
+                            run_log.count( 'raster_cells', contour_array.size)
+                    if contour_array is None:
+                        print( 'Could not rasterize contours for window ' + window_name)
+                        continue
+                    print( 'Making Raster Continuous')
+                    with run_log.stage( 'interpolate', cluster = quad, window = w):
+                        surface = si.interpolate_contour_surface( contour_array, mode = surface_mode)
+                    # 6)extract elevations
+                    print( '5)Extracting points for window ' + window_name)
+                    with run_log.stage( 'sample', cluster = quad, window = w):
+                        #only the window's points, points of the neighboring windows inside the padding are sampled with their own window
+                        sampled_ids, _ = points.sample_array( 'elevation', surface, geotransform, fids = window)
+                        run_log.count( 'points_sampled', len( sampled_ids))
+
+                for layer in window_layers:
                     ps.remove_layer( layer)
-                    
+
+            elevations = points.values( 'elevation', quad_points)
+            if np.isnan( elevations.astype( float)).any():
+                print( 'Not all points have elevations for quad ' + quad)
+                incomplete.append( q)
+            else:
+                done_quads.append( q)
+
             all_layers = QgsProject.instance().mapLayers().values()
     
             #intersection analysis
             print( '6)Intersection Analysis')
             keywords = [ 'Rail', 'Road', 'Trail']
-            to_cross = ps.select_layers_by_substrings( all_layers, keywords)
-            for i in range( len( keywords) ):
-                print(to_cross[i])
-                to_search = '_' +keywords[i]
-                intersecting_layer = ps.select_layers_by_substrings( all_layers, [to_search] )[0].name()
-                dp.intersection_analysis( anchors.name(), intersecting_layer, 'xs'+keywords[i])
+            #one crossing pass over the highlines for all targets, also records crossing counts and first crossing distance.
+            #The crossings of the quad's lines are collected over every quad they touch, each quad's package holds the
+            #crossings inside it
+            targets = {}
+            for keyword in keywords:
+                to_search = '_' + keyword
+                intersecting_layers = ps.select_layers_by_substrings( all_layers, [to_search] )
+                if intersecting_layers:
+                    print( intersecting_layers[0])
+                    targets[ 'xs' + keyword] = intersecting_layers[0]
+            with run_log.stage( 'crossings', cluster = quad):
+                run_log.count( 'features_read', sum( layer.featureCount() for layer in targets.values()))
+                dp.crossing_analysis( anchors.name(), targets, line_ids = line_ids, found = crossing_points)
             
-            #Before we itterate through the next potential cluster we must remove all the layers added for this process
+            #Before we itterate through the next quad we must remove all the layers added for this process
             all_layers = QgsProject.instance().mapLayers().values()
             #s = 0
             #if g == 2:
@@ -277,7 +369,7 @@ while g <= max( groups[0]):
                     print( 'removing '+ layer.name())
                     while layer in all_layers:
                         ps.remove_layer( layer.name())
-                        iface.mapCanvas().refreshAllLayers()
+                        ps.refresh_canvas()
                         #time.sleep( 3)
                         all_layers = QgsProject.instance().mapLayers().values()
                         
@@ -286,37 +378,58 @@ while g <= max( groups[0]):
             to_remove = list(set2.difference(set1)) 
             if len( to_remove) > 0:
                 print( 'Qgis failed to remove a layer')
+                #the next quad would pick up these layers, without a console to debug in stop the run
+                if not ps.has_gui():
+                    raise RuntimeError( 'Unable to remove layers ' + str( [layer.name() for layer in to_remove]))
                 pdb.set_trace()
             
             
-            #delete all downloaded layers           #
-            iface.mapCanvas().refreshAllLayers()
-            all_downloaded_layers = hf.prepend( os.listdir( usgs_processed_path), usgs_processed_path) +  hf.prepend( os.listdir( usgs_path), usgs_path)
-            
+            #delete the packages no later quad needs, the others stay extracted and reprojected for their next quad
+            ps.refresh_canvas()
+            finished = []
+            for package in packages:
+                package_quads[ package].discard( q)
+                if not package_quads[ package]:
+                    for folder in package_folders.get( package, []):
+                        finished += [folder, usgs_processed_path + os.path.basename( folder)]
             
             #TODO for some reason deleting files of layers does not work in this for loop
-            for downloads in all_downloaded_layers:                
-                attempt = 1
+            for downloads in finished:
                 ps.clear_cache()
-                print( attempt)
-                iface.mapCanvas().refreshAllLayers()
                 ps.delete_folder( downloads)
-                attempt = attempt + 1
-                    
                 
             #if the layers cannot be deleted halt execution
-            if len( hf.prepend( os.listdir( usgs_processed_path), usgs_processed_path) +  hf.prepend( os.listdir( usgs_path), usgs_path)) > 0:
+            if any( os.path.exists( downloads) for downloads in finished):
                 print( 'qgis failed to delete folders')
-            ps.save_temp_layer_as_permanent( 'highline_anchors_points', outs + 'highline_anchors_points.shp')    
-            ps.save_temp_layer_as_permanent( 'highline_anchors', outs + 'highline_anchors.shp')
-            g += 1
+            with run_log.stage( 'save_outputs', cluster = quad):
+                #write the elevations sampled into the mirror back to the layer
+                run_log.count( 'values_written', points.sync())
+                ps.save_temp_layer_as_permanent( 'highline_anchors_points', outs + 'highline_anchors_points.shp')    
+                ps.save_temp_layer_as_permanent( 'highline_anchors', outs + 'highline_anchors.shp')
             
     else:
-        print( 'Skipping cluster ' + str(g))
-        g += 1         
+        print( 'Skipping quad ' + quad)
 
 #iface.addVectorLayer(  outs + 'highline_anchors_points.shp', 'highline_anchors_points', 'ogr')
 
-export_attribute_table_to_csv( 'highline_anchors_points', project_directory + "/data/output/" + 'highline_anchors_points.csv')
-export_attribute_table_to_csv( 'highline_anchors', project_directory + "/data/output/" + 'highline_anchors.csv')
+downloader.shutdown()
+
+#packages of quads that failed are still on disk
+for downloads in hf.prepend( os.listdir( usgs_processed_path), usgs_processed_path) + hf.prepend( os.listdir( usgs_path), usgs_path):
+    ps.delete_folder( downloads)
+
+#record the line fingerprints of this run, the next run only recomputes lines that change after this
+if not incomplete:
+    ct.save_fingerprints( fingerprint_file, line_fingerprints)
+
+with run_log.stage( 'export'):
+    ps.export_attribute_table_to_csv( 'highline_anchors_points', project_directory + "/data/output/" + 'highline_anchors_points.csv')
+    ps.export_attribute_table_to_csv( 'highline_anchors', project_directory + "/data/output/" + 'highline_anchors.csv')
+    #columnar copies keep dtypes and full column names, 03_modeling prefers them over the csvs
+    ps.export_attribute_table( 'highline_anchors_points', project_directory + "/data/output/" + 'highline_anchors_points.parquet')
+    ps.export_attribute_table( 'highline_anchors', project_directory + "/data/output/" + 'highline_anchors.parquet')
+
+#slowest clusters and stages of this run, ins.summarize( path) gives the same report for an earlier log
+print( 'Stage log written to ' + run_log.path)
+run_log.summary()
     
\ No newline at end of file
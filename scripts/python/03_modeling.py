@@ -5,59 +5,40 @@ plt.style.use('ggplot')
 import seaborn as sns
 from sklearn import tree
 import functions.data_cleaning as dc
+import functions.feature_store as fs
+import functions.clearance as cl
 import os
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
+import joblib
 
 #path to csvs for analysis
 #path = 'Documents/github/highline_search/data/output/'
 path = 'data/output/'
 
 
-lines = pd.read_csv( path + 'highline_anchors.csv')
-ele_profiles = pd.read_csv( path + 'highline_anchors_points.csv')
-
-#if data extraction did not conclusivly detect a crossing fill in na
-for i in [ 'xsRail', 'xsRoad', 'xsTrail']:
-  lines[ i] = lines[ i].fillna( 0)
-#factorize categorical variables
-lines.home_ancho = pd.factorize( lines.home_ancho)[0]
-lines.far_anchor = pd.factorize( lines.far_anchor)[0]
-lines.state = pd.factorize( lines.state)[0]
-
-#Create Summary stats for elevation profiles
-summary_stats = ele_profiles.groupby('line_id').agg(
-    home_elevation=('elevation', 'first'),
-    far_elevation=('elevation', 'last'),
-    mean_elevation=('elevation', 'mean'),
-    median_elevation=('elevation', 'median'),
-    min_elevation=('elevation', 'min'),
-    max_elevation=('elevation', 'max'),
-    std_elevation=('elevation', 'std')
-).reset_index()
-
-# Calculate range_elevation separately
-summary_stats['range_elevation'] = abs( summary_stats['max_elevation'] - summary_stats['min_elevation'])
-
-#Sag Calculation?
-# a 100m long slackline with 15kN tension ( convert to dKn == 1500), that is loaded with a 75kg Slackliner in the middle:
-#75 : ((1500 : 100) x 4) = 75 : 60 = approx. 1,25m sag in the middle
-#
-weight = 60 # kg
+#parquet outputs are used when present, csvs get their truncated column names expanded
+ele_profiles = dc.load_output_tables( path, ['highline_anchors_points'])[0]
+
+#crossings, land flags, summary and segment elevation stats per line. They are stored in data/features
+#keyed by a hash of the outputs and only rebuilt when the outputs change
+line_w_segs = fs.load_features( path)
+
+#Sag Calculation
+# a 100m long slackline with 15kN tension, that is loaded with a 75kg Slackliner in the middle sags approx. 1,25m
+#functions.clearance applies this to every station of every profile, min_clearance and pinch_fraction are features
+weight = 75 # kg
 length = 100 # m
-tension = 1.5 # Kn
-sag = (weight / (((tension * 100)/ length)*4))
+tension = 15 # kN
+sag = cl.sag_envelope( length / 2, length, tension, weight, webbing_weight = 0)
 print( sag)
 
-# Merge summary statistics with anchor elevation difference
-lines = pd.merge(lines, summary_stats, on='line_id')
-
 # Add the target variable (usable or not usable)
 #df_features = pd.merge(df_features, df_lines[['line_id', 'usable']].drop_duplicates(), on='line_id')
 
 
 ####Plotting elevation profiles####
-df_large = pd.merge(lines, ele_profiles, on='line_id')
+df_large = pd.merge(line_w_segs[['line_id', 'riggable']], ele_profiles, on='line_id')
 list( df_large)
 df_large['normalized_index'] = df_large.groupby('line_id')['index'].transform(lambda x: x / x.max())
 
@@ -85,20 +66,6 @@ plt.tight_layout()
 plt.show()
 ####
 
-segment_sum = []
-for line in ele_profiles.line_id:
-    here = ele_profiles[ ele_profiles.line_id == line]    
-    seg = dc.split_and_compute_stats( line, here)  
-    segment_sum.append( seg)
-    
-
-
-segment_df = pd.concat(segment_sum, ignore_index=True)
-line_w_segs = pd.merge(lines, segment_df, on='line_id').drop_duplicates()
-
-
-line_w_segs['mean_anchor_height'] = 
-
 scaler = MinMaxScaler()
 
 # Select only numeric columns
@@ -129,7 +96,7 @@ X_train = train[['xsRail', 'xsRoad', 'xsTrail',
        '7_min', '7_max', '7_std', '7_slope', '8_mean', '8_median', '8_min',
        '8_max', '8_std', '8_slope', '9_mean', '9_median', '9_min', '9_max',
        '9_std', '9_slope', '10_mean', '10_median', '10_min', '10_max',
-       '10_std', '10_slope']]
+       '10_std', '10_slope', 'min_clearance', 'pinch_fraction']]
 
 X_test = test[['xsRail', 'xsRoad', 'xsTrail',
        'length', 'fs_land', 'blm_land', 'home_elevation', 'far_elevation',
@@ -143,7 +110,7 @@ X_test = test[['xsRail', 'xsRoad', 'xsTrail',
        '7_min', '7_max', '7_std', '7_slope', '8_mean', '8_median', '8_min',
        '8_max', '8_std', '8_slope', '9_mean', '9_median', '9_min', '9_max',
        '9_std', '9_slope', '10_mean', '10_median', '10_min', '10_max',
-       '10_std', '10_slope']]
+       '10_std', '10_slope', 'min_clearance', 'pinch_fraction']]
 
 y_train = train['riggable']
 
@@ -158,6 +125,12 @@ clf = tree.DecisionTreeClassifier(criterion = 'entropy', max_depth = 14)
 # Fitting the model on the train data
 clf = clf.fit(X_train, y_train)
 
+#save the model with its scaler and columns so functions.candidate_search can score new lines
+model_path = 'data/models/'
+os.makedirs( model_path, exist_ok = True)
+joblib.dump( {'model': clf, 'scaler': scaler, 'scaled_columns': list( numeric_cols),
+              'feature_columns': list( X_train.columns)}, model_path + 'riggable_tree.joblib')
+
 fig, ax = plt.subplots(figsize = (36, 36))
 
 out = tree.plot_tree(clf, fontsize = 10, max_depth = 14, impurity = False, filled = True, feature_names = ['xsRail', 'xsRoad', 'xsTrail',
@@ -172,7 +145,7 @@ out = tree.plot_tree(clf, fontsize = 10, max_depth = 14, impurity = False, fille
        '7_min', '7_max', '7_std', '7_slope', '8_mean', '8_median', '8_min',
        '8_max', '8_std', '8_slope', '9_mean', '9_median', '9_min', '9_max',
        '9_std', '9_slope', '10_mean', '10_median', '10_min', '10_max',
-       '10_std', '10_slope'], class_names = True)
+       '10_std', '10_slope', 'min_clearance', 'pinch_fraction'], class_names = True)
 
 for o in out:
 
@@ -0,0 +1,18 @@
+import os
+import functions.candidate_search as cs
+
+#Scan a DEM (or a surface written by cs.write_contour_surface) for new lines and score them with
+#the model saved by 03_modeling.py. Runs outside of QGIS, tiles are processed on a process pool.
+surface_path = 'data/raw/dem/quad_dem.tif'
+model_path = 'data/models/riggable_tree.joblib'
+output_path = 'data/output/'
+
+#the model was trained on contour elevations in feet, DEMs from The National Map are in meters
+z_factor = 3.28084
+
+if __name__ == '__main__':
+    candidates = cs.search_region( surface_path, model_path, tile_size = 2000, min_length = 20, max_length = 300,
+                                   z_factor = z_factor, threshold = 0.5)
+    if candidates is not None:
+        print( str( len( candidates)) + ' candidate lines found')
+        candidates.to_csv( os.path.join( output_path, 'candidate_lines.csv'), index = False)
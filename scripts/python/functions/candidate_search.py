@@ -0,0 +1,326 @@
+import numpy as np
+import pandas as pd
+import joblib
+from concurrent.futures import ProcessPoolExecutor
+from osgeo import gdal
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+import functions.data_cleaning as dc
+import functions.feature_store as fs
+import functions.clearance as cl
+import functions.surface_interpolation as si
+from functions.profile_sampling import (densify_lines, read_raster_window, sample_array_at_points,
+                                        rasterize_contours_to_array)
+
+# Model bundle written by 03_modeling.py, loaded once per worker process
+_worker_model = None
+
+
+def load_model(model_path):
+    """
+    Load a model bundle saved by 03_modeling.py.
+
+    :param model_path: Path to the joblib file
+    :return: Dictionary with 'model', 'scaler', 'scaled_columns' and 'feature_columns'
+    """
+    return joblib.load(model_path)
+
+
+def write_contour_surface(contour_path, bbox, output_path, attribute_field='ContourEle', mode='fast', cell_size=1):
+    """
+    Interpolate a surface from contour lines and save it as a GeoTIFF for search_region.
+
+    :param contour_path: Path to the contour shapefile
+    :param bbox: Tuple of (min_x, min_y, max_x, max_y) in the contours' CRS
+    :param output_path: Path of the GeoTIFF to write
+    :param attribute_field: Contour elevation attribute
+    :param mode: Interpolation mode of surface_interpolation.interpolate_contour_surface
+    :param cell_size: Cell size in map units
+    :return: output_path, or None if the contours could not be rasterized
+    """
+    contours, geotransform = rasterize_contours_to_array(contour_path, bbox, attribute_field, cell_size)
+    if contours is None:
+        return None
+    surface = si.interpolate_contour_surface(contours, mode=mode)
+
+    rows, cols = surface.shape
+    dataset = gdal.GetDriverByName('GTiff').Create(output_path, cols, rows, 1, gdal.GDT_Float32,
+                                                   options=['COMPRESS=DEFLATE', 'TILED=YES'])
+    dataset.SetGeoTransform(geotransform)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    band.WriteArray(np.where(np.isnan(surface), -9999, surface))
+    dataset = None
+    return output_path
+
+
+def find_high_points(surface, geotransform, window=15, min_relief=10, max_points=2000):
+    """
+    Find local high points of a surface that stand out from their surroundings.
+
+    Cells closer than window // 2 to the edge of the array are never high points: part of their
+    neighbourhood lies outside the array, so neither their maximum nor their relief is known.
+
+    :param surface: 2D elevation array, NaN marks nodata
+    :param geotransform: GDAL style geotransform of the array
+    :param window: Size in cells of the neighbourhood a high point must be the maximum of
+    :param min_relief: Minimum drop from the high point to the lowest cell of its neighbourhood
+    :param max_points: Only the max_points points with the largest relief are kept, None keeps all
+    :return: Tuple of (xs, ys, elevations) arrays of the cell centres, ordered by decreasing relief
+    """
+    nodata = np.isnan(surface)
+    # Cells outside the array never win the maximum nor the minimum
+    highest = ndimage.maximum_filter(np.where(nodata, -np.inf, surface), size=window, mode='constant', cval=-np.inf)
+    lowest = ndimage.minimum_filter(np.where(nodata, np.inf, surface), size=window, mode='constant', cval=np.inf)
+    relief = surface - lowest
+    complete = np.zeros(surface.shape, dtype=bool)
+    half = window // 2
+    complete[half:surface.shape[0] - half, half:surface.shape[1] - half] = True
+    rows, cols = np.nonzero((surface == highest) & ~nodata & (relief >= min_relief) & complete)
+
+    order = np.argsort(-relief[rows, cols], kind='stable')[:max_points]
+    rows, cols = rows[order], cols[order]
+    x0, dx, _, y0, _, dy = geotransform
+    return x0 + (cols + 0.5) * dx, y0 + (rows + 0.5) * dy, surface[rows, cols]
+
+
+def candidate_pairs(xs, ys, min_length, max_length, homes=None):
+    """
+    All pairs of points between min_length and max_length apart.
+
+    With homes, only the home points are queried against a tree of all points, so the number of pairs
+    grows with the number of homes and not with the number of points. Every pair then starts at a home
+    point that sorts before the other point by (x, y), which gives each pair a single owner.
+
+    :param xs: Array of x coordinates
+    :param ys: Array of y coordinates
+    :param min_length: Shortest pair
+    :param max_length: Longest pair
+    :param homes: Optional array of the indices of the points the pairs start from
+    :return: (n, 2) array of point index pairs
+    """
+    if len(xs) < 2:
+        return np.empty((0, 2), dtype=int)
+    points = np.column_stack([xs, ys])
+    if homes is None:
+        pairs = cKDTree(points).query_pairs(max_length, output_type='ndarray')
+    else:
+        homes = np.asarray(homes, dtype=int)
+        if len(homes) == 0:
+            return np.empty((0, 2), dtype=int)
+        neighbours = cKDTree(points).query_ball_point(points[homes], max_length)
+        counts = np.fromiter((len(found) for found in neighbours), dtype=int, count=len(homes))
+        first = np.repeat(homes, counts)
+        second = np.fromiter((j for found in neighbours for j in found), dtype=int, count=counts.sum())
+        before = (xs[first] < xs[second]) | ((xs[first] == xs[second]) & (ys[first] < ys[second]))
+        pairs = np.column_stack([first[before], second[before]])
+    lengths = np.hypot(xs[pairs[:, 0]] - xs[pairs[:, 1]], ys[pairs[:, 0]] - ys[pairs[:, 1]])
+    return pairs[lengths >= min_length]
+
+
+def candidate_features(profiles, lengths):
+    """
+    Model features of candidate lines, built the same way as feature_store.build_line_features.
+
+    Crossings and land flags are not known for candidates and are left at 0.
+
+    :param profiles: DataFrame of points with line_id, index and elevation
+    :param lengths: Array of line lengths indexed by line_id
+    :return: DataFrame with one row per line
+    """
+    features = pd.merge(fs.summary_features(profiles), dc.segment_features(profiles), on='line_id')
+    clearance = cl.line_clearance(profiles, pd.Series(lengths))
+    features = pd.merge(features, clearance[['line_id', 'min_clearance', 'pinch_fraction']], on='line_id')
+    features['length'] = lengths[features['line_id'].values]
+    features['mean_anchor_height'] = (features['home_elevation'] + features['far_elevation']) / 2
+    return features
+
+
+def score_features(features, bundle):
+    """
+    Score line features with a model bundle from 03_modeling.py.
+
+    :param features: DataFrame of line features
+    :param bundle: Dictionary from load_model
+    :return: Array with the probability of every line being riggable
+    """
+    # The scaler of 03_modeling.py was fitted on all float columns, scale those before picking the features
+    scaled = features.reindex(columns=bundle['scaled_columns']).astype(float)
+    scaled[:] = bundle['scaler'].transform(scaled)
+    X = features.reindex(columns=bundle['feature_columns']).astype(float)
+    X.update(scaled)
+    X = X.fillna(0)
+    probabilities = bundle['model'].predict_proba(X.to_numpy())
+    classes = list(bundle['model'].classes_)
+    return probabilities[:, classes.index(1)] if 1 in classes else np.zeros(len(X))
+
+
+def score_pairs(surface, geotransform, xs, ys, pairs, bundle, spacing=1, z_factor=1, min_depth=5,
+                chunk_size=5000, min_clearance=0):
+    """
+    Sample the profiles of candidate pairs and score them, chunk by chunk.
+
+    :param surface: 2D elevation array the profiles are sampled from
+    :param geotransform: GDAL style geotransform of the surface
+    :param xs: Array of x coordinates of the high points
+    :param ys: Array of y coordinates of the high points
+    :param pairs: (n, 2) array of high point index pairs
+    :param bundle: Dictionary from load_model
+    :param spacing: Distance between profile points, as in lines_to_points
+    :param z_factor: Factor converting surface elevations to the units the model was trained on
+    :param min_depth: Minimum drop of the terrain below the anchor to anchor chord for a pair to be scored
+    :param chunk_size: Number of pairs sampled at once, bounds the memory used
+    :param min_clearance: Pairs whose loaded line comes closer than this to the ground (in meters) are
+                          dropped before scoring, None keeps them
+    :return: DataFrame with one row per scored pair
+    """
+    results = []
+    for start in range(0, len(pairs), chunk_size):
+        chunk = pairs[start:start + chunk_size]
+        home = np.column_stack([xs[chunk[:, 0]], ys[chunk[:, 0]]])
+        far = np.column_stack([xs[chunk[:, 1]], ys[chunk[:, 1]]])
+        parts = list(np.stack([home, far], axis=1))
+
+        line_ids, index, px, py = densify_lines(parts, np.arange(len(chunk)), spacing)
+        elevations = sample_array_at_points(surface, geotransform, px, py, method='bilinear') * z_factor
+
+        # Depth of the terrain below the straight chord between the anchors
+        lengths = np.hypot(*(far - home).T)
+        counts = np.bincount(line_ids, minlength=len(chunk))
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        home_z = elevations[starts][line_ids]
+        far_z = elevations[starts + counts - 1][line_ids]
+        distance = np.minimum((index - 1) * spacing, lengths[line_ids])
+        fraction = distance / np.maximum(lengths[line_ids], spacing)
+        depth = np.maximum.reduceat(home_z + (far_z - home_z) * fraction - elevations, starts)
+        has_nodata = np.bincount(line_ids, weights=np.isnan(elevations), minlength=len(chunk)) > 0
+        keep = ~has_nodata & (depth >= min_depth)
+        if not keep.any():
+            continue
+
+        point_keep = keep[line_ids]
+        profiles = pd.DataFrame({'line_id': line_ids[point_keep], 'index': index[point_keep],
+                                 'elevation': elevations[point_keep]})
+        features = candidate_features(profiles, lengths)
+        if min_clearance is not None:
+            features = features[features['min_clearance'] >= min_clearance]
+            if features.empty:
+                continue
+        kept = features['line_id'].values
+
+        results.append(pd.DataFrame({
+            'home_x': home[kept, 0], 'home_y': home[kept, 1], 'home_elevation': features['home_elevation'].values,
+            'far_x': far[kept, 0], 'far_y': far[kept, 1], 'far_elevation': features['far_elevation'].values,
+            'length': lengths[kept], 'depth': depth[kept], 'min_clearance': features['min_clearance'].values,
+            'score': score_features(features, bundle),
+        }))
+
+    if not results:
+        return pd.DataFrame(columns=['home_x', 'home_y', 'home_elevation', 'far_x', 'far_y', 'far_elevation',
+                                     'length', 'depth', 'min_clearance', 'score'])
+    return pd.concat(results, ignore_index=True)
+
+
+def _init_worker(model_path):
+    global _worker_model
+    _worker_model = load_model(model_path)
+
+
+def _search_tile(task):
+    # Runs in a worker: read the tile plus a margin of max_length so pairs reaching out of the tile are complete
+    surface_path, tile, settings = task
+    min_x, min_y, max_x, max_y = tile
+    margin = settings['max_length']
+    surface, geotransform = read_raster_window(surface_path, (min_x - margin, min_y - margin,
+                                                              max_x + margin, max_y + margin))
+    if surface is None:
+        return None
+
+    xs, ys, _ = find_high_points(surface, geotransform, settings['window'], settings['min_relief'], None)
+    # Home anchors are the max_points strongest high points of the tile's own area. Every high point, the
+    # margin's included, can be a far anchor, so what the margin holds does not change the candidates.
+    # A pair belongs to the tile of its home anchor, the one sorting first by (x, y)
+    inside = (xs >= min_x) & (xs < max_x) & (ys >= min_y) & (ys < max_y)
+    homes = np.nonzero(inside)[0][:settings['max_points']]
+    pairs = candidate_pairs(xs, ys, settings['min_length'], settings['max_length'], homes)
+
+    return score_pairs(surface, geotransform, xs, ys, pairs, _worker_model, settings['spacing'],
+                       settings['z_factor'], settings['min_depth'], settings['chunk_size'], settings['min_clearance'])
+
+
+def region_tiles(bbox, tile_size):
+    """
+    Split a bounding box into square tiles.
+
+    :param bbox: Tuple of (min_x, min_y, max_x, max_y)
+    :param tile_size: Width and height of a tile in map units
+    :return: List of tile bounding boxes
+    """
+    min_x, min_y, max_x, max_y = bbox
+    return [(float(x), float(y), float(min(x + tile_size, max_x)), float(min(y + tile_size, max_y)))
+            for y in np.arange(min_y, max_y, tile_size) for x in np.arange(min_x, max_x, tile_size)]
+
+
+def search_region(surface_path, model_path, bbox=None, tile_size=2000, min_length=20, max_length=300, spacing=1,
+                  window=15, min_relief=10, max_points=2000, min_depth=5, z_factor=1, chunk_size=5000,
+                  max_workers=None, threshold=0.5, min_clearance=0):
+    """
+    Search a DEM or contour derived surface for new highline candidates and score them.
+
+    The region is split into tiles that are processed on a process pool. Every worker reads its tile plus
+    a margin of max_length, finds the local high points, pairs them up within the length range, samples
+    the profile of every pair at the lines_to_points spacing and scores the pairs in chunks with the model
+    trained in 03_modeling.py. Pairs whose terrain never drops min_depth below the chord, or whose loaded
+    line would come closer than min_clearance to the ground, are skipped.
+
+    :param surface_path: Path to the elevation raster (e.g. a DEM or write_contour_surface output)
+    :param model_path: Path to the model bundle saved by 03_modeling.py
+    :param bbox: Optional (min_x, min_y, max_x, max_y) to search, the whole raster by default
+    :param tile_size: Width and height of a tile in map units
+    :param min_length: Shortest candidate line
+    :param max_length: Longest candidate line, also the margin read around every tile
+    :param spacing: Distance between profile points
+    :param window: Neighbourhood size in cells of a high point
+    :param min_relief: Minimum drop around a high point
+    :param max_points: Maximum number of home anchors per tile, the high points of the tile with the largest relief
+    :param min_depth: Minimum depth of the terrain below the chord
+    :param z_factor: Factor converting raster elevations to the model's units (e.g. 3.28084 for meters to feet)
+    :param chunk_size: Number of pairs scored at once per worker
+    :param max_workers: Number of worker processes (default: number of CPUs)
+    :param threshold: Minimum score of the returned candidates
+    :param min_clearance: Minimum ground clearance in meters of the loaded line (see clearance.line_clearance)
+    :return: DataFrame of candidates sorted by score
+    """
+    if bbox is None:
+        dataset = gdal.Open(surface_path)
+        if dataset is None:
+            print(f"Error: Unable to open raster '{surface_path}'")
+            return None
+        x0, dx, _, y0, _, dy = dataset.GetGeoTransform()
+        x1, y1 = x0 + dataset.RasterXSize * dx, y0 + dataset.RasterYSize * dy
+        bbox = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        dataset = None
+
+    settings = {'min_length': min_length, 'max_length': max_length, 'spacing': spacing, 'window': window,
+                'min_relief': min_relief, 'max_points': max_points, 'min_depth': min_depth,
+                'z_factor': z_factor, 'chunk_size': chunk_size, 'min_clearance': min_clearance}
+    tasks = [(surface_path, tile, settings) for tile in region_tiles(bbox, tile_size)]
+    print(f"Searching {len(tasks)} tiles for candidate lines")
+
+    results = []
+    if max_workers == 1:
+        _init_worker(model_path)
+        results = [_search_tile(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(model_path,)) as executor:
+            results = list(executor.map(_search_tile, tasks))
+
+    results = [result for result in results if result is not None and len(result)]
+    if not results:
+        return pd.DataFrame(columns=['home_x', 'home_y', 'home_elevation', 'far_x', 'far_y', 'far_elevation',
+                                     'length', 'depth', 'min_clearance', 'score'])
+    candidates = pd.concat(results, ignore_index=True)
+    candidates = candidates[candidates['score'] >= threshold]
+    return candidates.sort_values('score', ascending=False).reset_index(drop=True)
@@ -0,0 +1,196 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from qgis.core import QgsProject, QgsVectorLayer, QgsFeatureRequest, QgsFeature, QgsField, NULL
+
+import functions.project_setup as ps
+import functions.layer_registry as lr
+
+# Columns of highline_point_data.csv that define a line; edits to any other column do not trigger a recompute
+FINGERPRINT_COLUMNS = ['home_latitude', 'home_longitude', 'home_anchor_type',
+                       'far_latitude', 'far_longitude', 'far_anchor_type', 'riggable']
+
+# Columns of the previous outputs that describe how a run was organized, not its results; never carried over
+NOT_MERGED_COLUMNS = ['id', 'cluster_group']
+
+
+def fingerprint_rows(df, id_column='id', columns=FINGERPRINT_COLUMNS):
+    """
+    Hash the defining columns of every line record.
+
+    :param df: DataFrame read from highline_point_data.csv
+    :param id_column: Column holding the record ID written by the data entry app
+    :param columns: Columns included in the fingerprint
+    :return: Dictionary mapping record ID (as a string) to its fingerprint
+    """
+    fingerprints = {}
+    for record_id, values in zip(df[id_column], df[columns].itertuples(index=False, name=None)):
+        # repr keeps full float precision and distinguishes NaN from empty strings
+        fingerprints[str(record_id)] = hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+    return fingerprints
+
+
+def load_fingerprints(state_file):
+    """
+    :param state_file: Path to the JSON state file written by save_fingerprints
+    :return: Dictionary mapping record ID to fingerprint, empty if there is no state yet
+    """
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error: Unable to read fingerprints '{state_file}', treating every line as new. {e}")
+        return {}
+
+
+def save_fingerprints(state_file, fingerprints):
+    """
+    :param state_file: Path to the JSON state file
+    :param fingerprints: Dictionary mapping record ID to fingerprint
+    """
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(fingerprints, f, indent=1)
+    os.replace(temp_file, state_file)
+
+
+def diff_fingerprints(current, previous):
+    """
+    Compare the fingerprints of this run with those of the last completed run.
+
+    :param current: Dictionary of record ID to fingerprint for the current CSV
+    :param previous: Dictionary of record ID to fingerprint from the state file
+    :return: Dictionary of sorted ID lists under 'unchanged', 'changed', 'added' and 'removed'
+    """
+    return {
+        'unchanged': sorted(i for i in current if previous.get(i) == current[i]),
+        'changed': sorted(i for i in current if i in previous and previous[i] != current[i]),
+        'added': sorted(i for i in current if i not in previous),
+        'removed': sorted(i for i in previous if i not in current),
+    }
+
+
+def read_fingerprints_from_csv(csv_file, id_column='id'):
+    """
+    :param csv_file: Path to highline_point_data.csv
+    :param id_column: Column holding the record ID
+    :return: Dictionary mapping record ID to fingerprint
+    """
+    return fingerprint_rows(pd.read_csv(csv_file), id_column)
+
+
+def _read_previous(path, key_fields, skip_fields, geometry=False):
+    # Attributes of a previous output keyed by a tuple of key field values, NULL becomes None.
+    # Shapefiles truncate field names to 10 characters, so truncated names of skipped fields are skipped too.
+    # With geometry the rows also hold the feature geometry under None
+    layer = QgsVectorLayer(path, 'previous', 'ogr')
+    if not layer.isValid():
+        print(f"Error: Unable to open previous output '{path}'")
+        return None, {}
+    skip_fields = set(skip_fields) | set(NOT_MERGED_COLUMNS)
+    skip_fields |= {name[:10] for name in skip_fields}
+    fields = [field for field in layer.fields() if field.name() not in skip_fields]
+    request = QgsFeatureRequest()
+    if not geometry:
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+    rows = {}
+    for feature in layer.getFeatures(request):
+        key = tuple(str(feature[name]) for name in key_fields)
+        rows[key] = {field.name(): None if feature[field.name()] == NULL else feature[field.name()]
+                     for field in fields}
+        if geometry:
+            rows[key][None] = feature.geometry()
+    return fields, rows
+
+
+def merge_previous_results(lines_layer_name, points_layer_name, previous_lines_path, previous_points_path,
+                           unchanged_ids, id_column='id', line_id_column='line_id', index_column='index'):
+    """
+    Copy the results of unchanged lines from the previous outputs onto freshly built layers.
+
+    Line attributes are matched by record ID and only columns missing from the current line layer are
+    copied (e.g. state, crossings and length). The points of unchanged lines are not densified again: the
+    point layer is expected to hold only the points of added and changed lines (see
+    dp.lines_to_points(..., line_ids=...)) and the previous points of the unchanged lines are appended to
+    it with their results (e.g. elevation). The line IDs of the previous run are translated to the
+    current ones through the record ID, so lines may be renumbered when records are added or removed.
+    Columns in NOT_MERGED_COLUMNS are never copied.
+
+    :param lines_layer_name: Name of the rebuilt line layer
+    :param points_layer_name: Name of the point layer holding the points of the added and changed lines
+    :param previous_lines_path: Path to the previous line output (outputs/highline_anchors.shp)
+    :param previous_points_path: Path to the previous point output (outputs/highline_anchors_points.shp)
+    :param unchanged_ids: Record IDs whose results can be reused
+    :param id_column: Column holding the record ID in the line layers
+    :param line_id_column: Column holding the line ID in both layers
+    :param index_column: Column holding the point index in the point layers
+    :return: Number of lines whose results were merged
+    """
+    unchanged_ids = set(str(i) for i in unchanged_ids)
+    lines_layer = lr.resolve(lines_layer_name)
+    points_layer = lr.resolve(points_layer_name)
+
+    # Line attributes, keyed by record ID
+    current_line_fields = set(lines_layer.fields().names())
+    line_fields, previous_lines = _read_previous(previous_lines_path, [id_column], current_line_fields - {line_id_column})
+    if line_fields is None:
+        return 0
+
+    old_to_record = {str(row[line_id_column]): key[0] for key, row in previous_lines.items()}
+    record_to_new = {}
+    feature_ids = []
+    values = {field.name(): [] for field in line_fields if field.name() != line_id_column}
+    for feature in lines_layer.getFeatures(QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)):
+        record_id = str(feature[id_column])
+        record_to_new[record_id] = feature[line_id_column]
+        if record_id not in unchanged_ids or (record_id,) not in previous_lines:
+            continue
+        feature_ids.append(feature.id())
+        for name in values:
+            values[name].append(previous_lines[(record_id,)][name])
+
+    if feature_ids and values:
+        ps.write_attribute_columns(lines_layer, feature_ids, values,
+                                   field_types={field.name(): field.type() for field in line_fields},
+                                   skip_missing=True)
+
+    # Points of the unchanged lines with their results, keyed by (line ID, index) of the previous run
+    point_fields, previous_points = _read_previous(previous_points_path, [line_id_column, index_column],
+                                                   [], geometry=True)
+    if point_fields is None:
+        return len(feature_ids)
+
+    old_to_new = {old: record_to_new[record] for old, record in old_to_record.items()
+                  if record in unchanged_ids and record in record_to_new}
+
+    # Create the result columns the point layer does not have yet
+    provider = points_layer.dataProvider()
+    new_fields = [QgsField(field.name(), field.type()) for field in point_fields
+                  if points_layer.fields().indexFromName(field.name()) == -1]
+    if new_fields:
+        provider.addAttributes(new_fields)
+        points_layer.updateFields()
+
+    fields = points_layer.fields()
+    features = []
+    for (old_line, _), row in previous_points.items():
+        new_line = old_to_new.get(old_line)
+        if new_line is None:
+            continue
+        feature = QgsFeature(fields)
+        feature.setGeometry(row[None])
+        for name, value in row.items():
+            if name is not None and value is not None:
+                feature[name] = value
+        feature[line_id_column] = new_line
+        features.append(feature)
+
+    if features and not provider.addFeatures(features):
+        print(f"Error: Unable to add the previous points to layer '{points_layer.name()}'")
+    points_layer.updateExtents()
+
+    print(f"Merged previous results for {len(feature_ids)} unchanged lines ({len(features)} points).")
+    return len(feature_ids)
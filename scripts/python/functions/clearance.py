@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+GRAVITY = 9.81  # m/s^2
+FEET_TO_METERS = 0.3048
+
+
+def sag_envelope(distance, length, tension=15, weight=75, webbing_weight=0.05):
+    """
+    Lowest position below the anchor to anchor chord the loaded line reaches at every station.
+
+    The line is treated as a taut string: a point load W standing at x deflects it by
+    W * x * (L - x) / (T * L) and the webbing's own weight w adds the parabolic sag
+    w * x * (L - x) / (2 * T). As the slackliner walks the line the deepest position at x is
+    reached when standing at x, so the envelope is x * (L - x) / T * (W / L + w / 2).
+
+    :param distance: Array of distances from the home anchor in meters
+    :param length: Array of line lengths in meters, aligned with distance
+    :param tension: Line tension in kN
+    :param weight: Slackliner weight in kg
+    :param webbing_weight: Webbing weight in kg per meter
+    :return: Array of sag in meters
+    """
+    distance = np.asarray(distance, dtype=float)
+    length = np.asarray(length, dtype=float)
+    tension_n = tension * 1000
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sag = distance * (length - distance) / tension_n * (weight * GRAVITY / length + webbing_weight * GRAVITY / 2)
+    return np.where(length > 0, sag, 0)
+
+
+def line_clearance(profiles, lengths, spacing=1, tension=15, weight=75, webbing_weight=0.05, anchor_height=1,
+                   setback=3, elevation_scale=FEET_TO_METERS, id_col='line_id', index_col='index',
+                   value_col='elevation'):
+    """
+    Minimum ground clearance of the loaded line over the terrain profile of every line.
+
+    The line runs from anchor_height above the terrain at the first point of a profile to
+    anchor_height above its last point. The sag envelope is subtracted from that chord and compared
+    with the terrain at every station; all lines are evaluated at once on the flat point arrays.
+    The stations within setback of either anchor always clear the ground by about anchor_height, they
+    are left out of the minimum unless a line has no other station.
+
+    :param profiles: DataFrame of points with line ID, point index and elevation (e.g. highline_anchors_points)
+    :param lengths: Series of line lengths in meters indexed by line ID
+    :param spacing: Distance between profile points in meters, as in lines_to_points
+    :param tension: Line tension in kN
+    :param weight: Slackliner weight in kg
+    :param webbing_weight: Webbing weight in kg per meter
+    :param anchor_height: Height of the anchors above the terrain in meters
+    :param setback: Distance in meters from each anchor within which stations are left out of the minimum
+    :param elevation_scale: Factor converting profile elevations to meters (default: feet to meters)
+    :return: DataFrame with one row per line: min_clearance (m, negative when the line touches the ground),
+             pinch_distance (m from the home anchor), pinch_fraction (0 at home, 1 at far) and max_sag (m)
+    """
+    profiles = profiles.sort_values([id_col, index_col], kind='stable')
+    line_ids, line_codes, counts = np.unique(profiles[id_col].values, return_inverse=True, return_counts=True)
+    terrain = profiles[value_col].values.astype(float) * elevation_scale
+    line_lengths = pd.Series(lengths).reindex(line_ids).values.astype(float)
+
+    # Distance of every station from the home anchor
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    length = line_lengths[line_codes]
+    distance = np.minimum((profiles[index_col].values - 1) * spacing, length)
+
+    # Anchor to anchor chord minus the sag envelope
+    home = terrain[starts][line_codes] + anchor_height
+    far = terrain[starts + counts - 1][line_codes] + anchor_height
+    with np.errstate(invalid='ignore', divide='ignore'):
+        chord = home + (far - home) * np.where(length > 0, distance / length, 0)
+    sag = sag_envelope(distance, length, tension, weight, webbing_weight)
+    clearance = chord - sag - terrain
+
+    # Lowest clearance per line. Stations next to the anchors sort after the others and NaN terrain sorts last,
+    # so they only win when a line has nothing else
+    near_anchor = (distance <= setback) | (distance >= length - setback)
+    rank = np.where(np.isnan(clearance), 2, np.where(near_anchor, 1, 0))
+    order = np.lexsort((np.where(np.isnan(clearance), np.inf, clearance), rank, line_codes))
+    first = order[np.concatenate(([0], np.cumsum(counts)[:-1]))]
+
+    return pd.DataFrame({
+        id_col: line_ids,
+        'min_clearance': clearance[first],
+        'pinch_distance': distance[first],
+        'pinch_fraction': np.where(line_lengths > 0, distance[first] / np.where(line_lengths > 0, line_lengths, 1), 0),
+        'max_sag': sag_envelope(line_lengths / 2, line_lengths, tension, weight, webbing_weight),
+    })
@@ -1,6 +1,20 @@
 import pandas as pd
 import numpy as np
 from scipy.stats import linregress
+import os
+
+# Shapefile (DBF) attribute names are truncated to 10 characters; these are the full names
+FULL_COLUMN_NAMES = {
+    'home_latit': 'home_latitude',
+    'home_longi': 'home_longitude',
+    'home_ancho': 'home_anchor_type',
+    'far_latitu': 'far_latitude',
+    'far_longit': 'far_longitude',
+    'far_anchor': 'far_anchor_type',
+    'home_lat_l': 'home_lat_long',
+    'far_lat_lo': 'far_lat_long',
+    'cluster_gr': 'cluster_group',
+}
 
 
 def compute_slope(elevations):
@@ -43,3 +57,152 @@ def split_and_compute_stats(parent_id, child_df):
         columns.extend([f'{i}_mean', f'{i}_median', f'{i}_min', f'{i}_max', f'{i}_std', f'{i}_slope'])
 
     return pd.DataFrame([result], columns=columns)
+
+
+def segment_features(profiles, id_col='line_id', index_col='index', value_col='elevation', segments=10):
+    """
+    Compute split_and_compute_stats for every line at once.
+
+    The points of all lines are sorted into one array and every point is assigned to its segment with the
+    same rule as split_and_compute_stats (n // segments points per segment, the last segment taking the
+    remainder). Sums, minima and maxima are reduced per segment with np.bincount / np.minimum.reduceat,
+    medians are read from the sorted values of each segment and slopes use the closed-form least-squares
+    solution over x = 0, 1, ..., m - 1, so no Python loop runs per line or per segment.
+
+    :param profiles: DataFrame of points with line ID, point index and elevation columns
+    :param id_col: Column holding the line ID
+    :param index_col: Column holding the position of the point along the line
+    :param value_col: Column holding the elevation
+    :param segments: Number of segments per line (default 10)
+    :return: DataFrame with one row per line: the line ID followed by {i}_mean, {i}_median, {i}_min,
+             {i}_max, {i}_std and {i}_slope for i = 1..segments. Empty segments are NaN.
+    """
+    profiles = profiles.sort_values([id_col, index_col], kind='stable')
+    line_ids, line_codes, counts = np.unique(profiles[id_col].values, return_inverse=True, return_counts=True)
+    values = profiles[value_col].values.astype(float)
+
+    # Position of every point along its line and the segment it falls in
+    line_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    position = np.arange(len(values)) - line_starts[line_codes]
+    segment_size = (counts // segments)[line_codes]
+    segment = np.where(segment_size > 0, position // np.maximum(segment_size, 1), segments - 1)
+    segment = np.minimum(segment, segments - 1)
+    x = position - segment * segment_size
+
+    # Points are ordered by line and then segment, so every segment is one contiguous run
+    key = line_codes * segments + segment
+    size = len(line_ids) * segments
+    n = np.bincount(key, minlength=size).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(key, weights=values, minlength=size) / n
+        std = np.sqrt(np.bincount(key, weights=(values - mean[key]) ** 2, minlength=size) / n)
+
+        # Least-squares slope against x = 0..m-1: sum((x - x_mean) * y) / sum((x - x_mean) ** 2)
+        x_mean = (n - 1) / 2
+        sxx = n * (n ** 2 - 1) / 12
+        slope = np.bincount(key, weights=(x - x_mean[key]) * values, minlength=size) / sxx
+    slope[sxx == 0] = np.nan
+
+    minimum = np.full(size, np.nan)
+    maximum = np.full(size, np.nan)
+    median = np.full(size, np.nan)
+    occupied = np.flatnonzero(n > 0)
+    if len(values):
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(key)) + 1))
+        minimum[occupied] = np.minimum.reduceat(values, run_starts)
+        maximum[occupied] = np.maximum.reduceat(values, run_starts)
+
+        # Sort the values within each segment and take the middle one (or two)
+        ordered = values[np.lexsort((values, key))]
+        run_counts = n[occupied].astype(int)
+        lower = ordered[run_starts + (run_counts - 1) // 2]
+        upper = ordered[run_starts + run_counts // 2]
+        median[occupied] = (lower + upper) / 2
+        has_nan = np.bincount(key, weights=np.isnan(values), minlength=size) > 0
+        median[has_nan] = np.nan
+
+    stats = np.stack([mean, median, minimum, maximum, std, slope], axis=1).reshape(len(line_ids), segments * 6)
+    columns = [f'{i}_{name}' for i in range(1, segments + 1)
+               for name in ['mean', 'median', 'min', 'max', 'std', 'slope']]
+    result = pd.DataFrame(stats, columns=columns)
+    result.insert(0, id_col, line_ids)
+    return result
+
+
+def compare_elevation_profiles(reference, candidate, id_col='line_id', index_col='index', value_col='elevation'):
+    """
+    Compare two sets of point elevation profiles, e.g. raster sampled against contour derived.
+
+    :param reference: DataFrame (or path to a CSV) of points with line ID, point index and elevation
+    :param candidate: DataFrame (or path to a CSV) with the same columns
+    :return: DataFrame with one row per line holding the number of matched points and the mean absolute,
+             root mean square and maximum absolute difference
+    """
+    if isinstance(reference, str):
+        reference = pd.read_csv(reference)
+    if isinstance(candidate, str):
+        candidate = pd.read_csv(candidate)
+
+    merged = reference[[id_col, index_col, value_col]].merge(
+        candidate[[id_col, index_col, value_col]], on=[id_col, index_col], suffixes=('_ref', '_new'))
+    merged['diff'] = merged[value_col + '_new'] - merged[value_col + '_ref']
+    merged = merged.dropna(subset=['diff'])
+
+    grouped = merged.groupby(id_col)['diff']
+    return pd.DataFrame({
+        'n': grouped.size(),
+        'mae': grouped.apply(lambda d: d.abs().mean()),
+        'rmse': grouped.apply(lambda d: np.sqrt((d ** 2).mean())),
+        'max_abs': grouped.apply(lambda d: d.abs().max()),
+    }).reset_index()
+
+
+def load_output_table(path):
+    """
+    Load an output table of the extraction scripts with full column names.
+
+    Parquet (.parquet) and Arrow IPC / Feather (.feather, .arrow) files written by
+    project_setup.export_attribute_table are read as is. CSV files exported from shapefiles
+    have their truncated column names expanded with FULL_COLUMN_NAMES.
+
+    :param path: Path to the table
+    :return: DataFrame
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        return pd.read_parquet(path)
+    if extension in ('.feather', '.arrow'):
+        return pd.read_feather(path)
+    df = pd.read_csv(path, na_values=['NULL'])
+    return df.rename(columns=FULL_COLUMN_NAMES)
+
+
+def output_table_paths(path, names=('highline_anchors', 'highline_anchors_points')):
+    """
+    Locate the output tables in a folder, preferring columnar files over CSV.
+
+    :param path: Folder holding the outputs (e.g. 'data/output/')
+    :param names: Table names without extension
+    :return: List of paths in the order of names
+    """
+    paths = []
+    for name in names:
+        for extension in ('.parquet', '.feather', '.csv'):
+            table_path = os.path.join(path, name + extension)
+            if os.path.exists(table_path):
+                paths.append(table_path)
+                break
+        else:
+            raise FileNotFoundError(f"No output table '{name}' found in '{path}'")
+    return paths
+
+
+def load_output_tables(path, names=('highline_anchors', 'highline_anchors_points')):
+    """
+    Load the output tables from a folder, preferring columnar files over CSV.
+
+    :param path: Folder holding the outputs (e.g. 'data/output/')
+    :param names: Table names without extension
+    :return: List of DataFrames in the order of names
+    """
+    return [load_output_table(table_path) for table_path in output_table_paths(path, names)]
@@ -3,14 +3,20 @@ import numpy as np
 
 from qgis.core import (QgsSpatialIndex, QgsFeatureRequest, QgsGeometry, QgsVectorLayer, QgsRasterLayer,
                        QgsVectorFileWriter, QgsFeature, QgsField, QgsCoordinateTransformContext, QgsPointXY,
-                       QgsWkbTypes, QgsProject, QgsRaster, QgsProcessingException, QgsMapLayerRenderer)
-from osgeo import gdal
+                       QgsWkbTypes, QgsProject, QgsRaster, QgsProcessingException, QgsMapLayerRenderer,
+                       QgsRectangle, QgsCoordinateReferenceSystem, QgsCoordinateTransform)
+from osgeo import gdal, ogr
 from qgis.analysis import ( QgsRasterCalculator, QgsRasterCalculatorEntry, QgsNativeAlgorithms)
 from PyQt5.QtCore import QVariant
 import processing
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
 from PyQt5.QtCore import QVariant
+import functions.project_setup as ps
+import functions.state_lookup as sl
+import functions.layer_registry as lr
+from functions.profile_sampling import (densify_lines, station_distances, rasterize_contours_to_array,
+                                       read_raster_window, sample_array_at_points)
 
 def compare_crs(layer1, layer2):
     crs1 = layer1.crs()
@@ -22,96 +28,163 @@ def compare_crs(layer1, layer2):
     else:
         return True
 
-def add_state_to_attribute_table(states_layer, target_layer, column_name):
-    # Create a spatial index for the states layer for faster querying
-    
-    
-    states_layer = QgsProject.instance().mapLayersByName(states_layer)[0]
-    index = QgsSpatialIndex(states_layer.getFeatures())
+def add_state_to_attribute_table(states_path, target_layer, column_name, grid_path=None):
+    """
+    Add the state each feature lies in to the attribute table of a layer.
 
-    # Start editing the target layer
-    target_layer = QgsProject.instance().mapLayersByName(target_layer)[0]
-    target_layer.startEditing()
+    States are assigned from the serialized lookup grid of functions.state_lookup (built beside the
+    state outlines on first use), so the state layer is never loaded into the project. Lines are
+    assigned by their first vertex, i.e. the home anchor.
 
-    # Add a new field to the target layer if the specified column name doesn't exist
-    if target_layer.fields().indexFromName(column_name) == -1:
-        target_layer.addAttribute(QgsField(column_name, QVariant.String))
+    :param states_path: Path to the state outlines (e.g. processed + 'cb_2018_us_state_500k.shp')
+    :param target_layer: Name of the layer to update
+    :param column_name: Name of the column holding the state name
+    :param grid_path: Optional path of the lookup grid (default beside the state outlines)
+    """
+    lookup = sl.load_state_lookup(states_path, grid_path)
+    if lookup is None:
+        return
 
-    # Get the index of the newly added column
-    column_index = target_layer.fields().lookupField(column_name)
+    target_layer = lr.resolve(target_layer)
 
-    # Iterate over features in the target layer
+    # Bring the anchors into the coordinate system of the grid if needed
+    transform = None
+    grid_crs = QgsCoordinateReferenceSystem.fromWkt(lookup.crs_wkt)
+    if grid_crs.isValid() and grid_crs != target_layer.crs():
+        transform = QgsCoordinateTransform(target_layer.crs(), grid_crs, QgsProject.instance())
+
+    feature_ids = []
+    xs = []
+    ys = []
     for feature in target_layer.getFeatures():
-        # Get the geometry of the feature
         geometry = feature.geometry()
-        # Use the spatial index to find the intersecting states
-        intersecting_states = [f["NAME"] for f in states_layer.getFeatures(QgsFeatureRequest().setFilterRect(geometry.boundingBox())) if f.geometry().intersects(geometry)]
-        # Set the column attribute value for the feature
-        if intersecting_states:
-            target_layer.changeAttributeValue(feature.id(), column_index, intersecting_states[0])
-        else:
-            target_layer.changeAttributeValue(feature.id(), column_index, "Not in any state")
+        if geometry.isEmpty():
+            continue
+        point = QgsPointXY(geometry.vertexAt(0))
+        if transform is not None:
+            point = transform.transform(point)
+        feature_ids.append(feature.id())
+        xs.append(point.x())
+        ys.append(point.y())
+
+    # Write the states back in one batch
+    state_names = lookup.lookup(xs, ys)
+    ps.write_attribute_columns(target_layer, feature_ids, {column_name: state_names},
+                               field_types={column_name: QVariant.String})
+
+# Spatial indexes and prepared geometries of polygon layers, keyed by (layer id, feature count).
+# The entries of a layer are dropped when its geometries are edited
+_polygon_index_cache = {}
+_watched_polygon_layers = set()
+
+def _forget_polygon_index(layer_id):
+    for key in [key for key in _polygon_index_cache if key[0] == layer_id]:
+        del _polygon_index_cache[key]
+
+def get_polygon_index(layer):
+    """
+    Build a spatial index and prepared geometries for a polygon layer, reusing them across calls.
 
-    # Commit changes and stop editing
-    target_layer.commitChanges()
-    target_layer.triggerRepaint()    
+    :param layer: The polygon QgsVectorLayer to index
+    :return: A tuple of (QgsSpatialIndex, dict mapping feature ID to (geometry, prepared geometry engine))
+    """
+    key = (layer.id(), layer.featureCount())
+    if key in _polygon_index_cache:
+        return _polygon_index_cache[key]
 
-def check_features_within_bounds(layer1_name, layer2_name, column_name):
+    index = QgsSpatialIndex()
+    prepared = {}
+    for feature in layer.getFeatures():
+        geometry = feature.geometry()
+        if geometry.isEmpty():
+            continue
+        index.addFeature(feature)
+        # The engine only borrows the geometry, so keep the geometry alive alongside it
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+        prepared[feature.id()] = (geometry, engine)
+
+    _polygon_index_cache[key] = (index, prepared)
+    layer_id = layer.id()
+    if layer_id not in _watched_polygon_layers:
+        # Geometry edits keep the feature count, so the key alone would hand out the stale index
+        layer.geometryChanged.connect(lambda *args: _forget_polygon_index(layer_id))
+        layer.committedGeometriesChanges.connect(lambda *args: _forget_polygon_index(layer_id))
+        _watched_polygon_layers.add(layer_id)
+    return index, prepared
+
+def clear_polygon_index_cache():
     """
-    Function to check if features from layer1 are within the bounds of features in layer2.
-    Adds a column to layer1 indicating 'y' or 'n' for each feature.
-    
-    :param layer1: The input vector layer to check features from
-    :param layer2: The reference vector layer to check features within
-    :param column_name: The name of the column to be added to layer1
+    Drop all cached polygon indexes, e.g. after the polygon layers were edited or reloaded.
     """
-    
-    layer1 = QgsProject.instance().mapLayersByName(layer1_name)[0]  
-    layer2 = QgsProject.instance().mapLayersByName(layer2_name)[0]  
+    _polygon_index_cache.clear()
+
+def check_features_within_bounds(layer1_name, layer2_names, column_names):
+    """
+    Function to check if features from layer1 are within the bounds of features in one or more polygon layers.
+    Adds a column to layer1 per polygon layer indicating 1 or 0 for each feature.
 
-    # Ensure both layers are valid
-    if not layer1.isValid() or not layer2.isValid():
-        print("One or both layers are invalid")
+    Each polygon layer is indexed once (see get_polygon_index) and only polygons whose bounding box
+    hits a feature are tested exactly, so all polygon layers are handled in a single pass over layer1.
+
+    :param layer1_name: The name of the input vector layer to check features from
+    :param layer2_names: The name of the reference polygon layer, or a list of names
+    :param column_names: The name of the column to be added to layer1, or a list of names matching layer2_names
+    """
+    if isinstance(layer2_names, str):
+        layer2_names = [layer2_names]
+    if isinstance(column_names, str):
+        column_names = [column_names]
+    if len(layer2_names) != len(column_names):
+        print("Error: One column name is needed for each reference layer")
         return
 
-    # Start an edit session for layer1
-    layer1.startEditing()
-    
-    # Add the new column to layer1
-    if column_name not in [field.name() for field in layer1.fields()]:
-        layer1.addAttribute(QgsField(column_name, QVariant.String))
-    layer1.updateFields()
+    layer1 = lr.resolve(layer1_name)
+    layers2 = [lr.resolve(name) for name in layer2_names]
 
-    # Get the index of the new column
-    column_index = layer1.fields().indexFromName(column_name)
-    
-    # Iterate over each feature in layer1
+    # Ensure all layers are valid
+    if layer1 is None or any(layer2 is None for layer2 in layers2):
+        print("One or more layers were not found")
+        return
+    if not layer1.isValid() or not all(layer2.isValid() for layer2 in layers2):
+        print("One or more layers are invalid")
+        return
+
+    polygon_indexes = [get_polygon_index(layer2) for layer2 in layers2]
+
+    # Iterate over each feature in layer1 once, testing it against every reference layer
+    feature_ids = []
+    within = []
     for feature1 in layer1.getFeatures():
         feature1_geometry = feature1.geometry()
-        within = 0
-        
-        # Check if this feature is within any feature in layer2
-        for feature2 in layer2.getFeatures():
-            if feature1_geometry.within(feature2.geometry()):
-                within = 1
-                break
-        
-        # Update the feature's attribute
-        layer1.changeAttributeValue(feature1.id(), column_index, within)
-    
-    # Commit changes to layer1
-    layer1.commitChanges()
+        bbox = feature1_geometry.boundingBox()
+        row = [0] * len(polygon_indexes)
+
+        for column, (index, prepared) in enumerate(polygon_indexes):
+            # Only test polygons whose bounding box hits this feature
+            for candidate in index.intersects(bbox):
+                if prepared[candidate][1].contains(feature1_geometry.constGet()):
+                    row[column] = 1
+                    break
+
+        feature_ids.append(feature1.id())
+        within.append(row)
+
+    # Write all results back in one batch
+    within = np.array(within, dtype=int).reshape(len(feature_ids), len(polygon_indexes))
+    ps.write_attribute_columns(layer1, feature_ids,
+                               {name: within[:, column] for column, name in enumerate(column_names)},
+                               field_types={name: QVariant.String for name in column_names})
 
 def cluster_points_with_dbscan(layer_name, eps=0.1, min_samples=5):
     """
     Perform DBSCAN clustering on points in a given QGIS layer and update the attribute table.
     """
     # Load the point layer by its name
-    point_layers = QgsProject.instance().mapLayersByName(layer_name)
-    if not point_layers:
+    point_layer = lr.resolve(layer_name)
+    if point_layer is None:
         print(f"Error: Layer '{layer_name}' not found")
         return
-    point_layer = point_layers[0]
 
     # Check if the layer is a point layer
     if point_layer.wkbType() != QgsWkbTypes.Point:
@@ -146,21 +219,9 @@ def cluster_points_with_dbscan(layer_name, eps=0.1, min_samples=5):
     cluster_labels = db.labels_
     #print( cluster_labels.head( 10))
     
-    # Add a 'cluster_group' field to the point layer if it doesn't exist
-    point_layer.startEditing()
-    if point_layer.fields().indexFromName("cluster_group") == -1:
-        point_layer.addAttribute(QgsField("cluster_group", QVariant.Int))
-        point_layer.updateFields()
-
-    # Get the index for the 'cluster_group' field
-    cluster_group_index = point_layer.fields().indexFromName("cluster_group")
-    
-    # Update the 'cluster_group' field for each feature
-    for feature, cluster_label in zip(feature_ids, cluster_labels):
-        point_layer.changeAttributeValue(feature, cluster_group_index, int(cluster_label))
-    
-    # Commit the changes
-    point_layer.commitChanges()
+    # Write the 'cluster_group' field for every feature in one batch
+    ps.write_attribute_columns(point_layer, feature_ids, {"cluster_group": cluster_labels.astype(int)},
+                               field_types={"cluster_group": QVariant.Int})
     
     print("DBSCAN clustering completed and attribute table updated.")
 
@@ -232,17 +293,12 @@ def create_polygon_layer_from_bbox(bounding_box, output_path, crs):
 
 def detect_crossing_lines(layer1_name, layer2_name, field_name):
     # Get the layers by name
-    layer1 = QgsProject.instance().mapLayersByName(layer1_name)[0]
-    layer2 = QgsProject.instance().mapLayersByName(layer2_name)[0]
-
-    # Add a new field to store the result in layer1    
-    field_index = layer1.fields().indexFromName(field_name)
-    if field_index == -1:
-        field = QgsField(field_name, QVariant.String)
-        layer1.startEditing()
-        layer1.addAttribute(field)
+    layer1 = lr.resolve(layer1_name)
+    layer2 = lr.resolve(layer2_name)
 
     # Iterate through features in layer1
+    feature_ids = []
+    crossings = []
     for feat1 in layer1.getFeatures():
         crosses = 'n'  # Assume the line does not cross initially
         geom1 = feat1.geometry()
@@ -256,11 +312,12 @@ def detect_crossing_lines(layer1_name, layer2_name, field_name):
                 crosses = 'y'
                 break
 
-        # Update the attribute table of layer1
-        layer1.changeAttributeValue(feat1.id(), field_index, crosses)
+        feature_ids.append(feat1.id())
+        crossings.append(crosses)
 
-    # Commit changes to the attribute table
-    layer1.commitChanges()
+    # Update the attribute table of layer1 in one batch
+    ps.write_attribute_columns(layer1, feature_ids, {field_name: np.array(crossings, dtype=object)},
+                               field_types={field_name: QVariant.String})
 
 def download_shapefile_from_bbox(bbox, output_folder):
     """
@@ -331,55 +388,71 @@ def download_shapefile_from_bbox(bbox, output_folder):
 # Example usage:
 #detect_crossing_lines('layer1_name', 'layer2_name')
 
+def get_intersection_matrix(layer1_name, layer2_name, id_col=None):
+    """
+    Find, for every feature in the first layer, the features in the second layer it intersects.
+
+    The second layer is indexed once with its geometries stored in the index. Only features of the first
+    layer overlapping the extent of the second layer are visited; each is prepared once and tested exactly
+    against the features whose bounding box it hits.
+
+    :param layer1_name: Name of the first line layer (e.g. 'highline_anchors')
+    :param layer2_name: Name of the second line layer (e.g. 'Elev_Contour'), or the layer itself
+    :param id_col: Optional column of the first layer to key the result by instead of the feature ID
+    :return: A dictionary mapping each intersecting feature of the first layer to the list of feature IDs
+             of the second layer it intersects
+    """
+    # Load the line layers by name
+    layer1 = lr.resolve(layer1_name)
+    layer2 = lr.resolve(layer2_name)
+
+    if layer1 is None or layer2 is None:
+        raise ValueError(f"One or both layers '{lr.layer_label(layer1_name)}' or '{lr.layer_label(layer2_name)}' not found")
+
+    index = QgsSpatialIndex(layer2.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+
+    matrix = {}
+    for feature1 in layer1.getFeatures(QgsFeatureRequest().setFilterRect(layer2.extent())):
+        geom1 = feature1.geometry()
+        if geom1.isEmpty():
+            continue
+        candidates = index.intersects(geom1.boundingBox())
+        if not candidates:
+            continue
+
+        engine = QgsGeometry.createGeometryEngine(geom1.constGet())
+        engine.prepareGeometry()
+        hits = [fid for fid in candidates if engine.intersects(index.geometry(fid).constGet())]
+        if hits:
+            matrix[feature1[id_col] if id_col else feature1.id()] = hits
+
+    return matrix
+
+
 def get_intersecting_indexes(layer1_name, layer2_name):
     """
     Find the indices of features in the first layer that intersect with features in the second layer.
     
     :param layer1_name: Name of the first line layer
     :param layer2_name: Name of the second line layer
-    :return: A set of indices of features in the first layer that intersect with features in the second layer
+    :return: A list of indices of features in the first layer that intersect with features in the second layer
     """
-    # Load the line layers by name
-    layer1 = QgsProject.instance().mapLayersByName(layer1_name)
-    layer2 = QgsProject.instance().mapLayersByName(layer2_name)
-    
-    if not layer1 or not layer2:
-        raise ValueError(f"One or both layers '{layer1_name}' or '{layer2_name}' not found")
-    
-    layer1 = layer1[0]
-    layer2 = layer2[0]
-    
-    # Set to store unique indices of intersecting features in the first layer
-    intersecting_indices = set()
-    
-    # Iterate over each feature in the first layer
-    for feature1 in layer1.getFeatures():
-        geom1 = feature1.geometry()
-        
-        # Check if this feature intersects with any feature in the second layer
-        for feature2 in layer2.getFeatures():
-            geom2 = feature2.geometry()
-            
-            if geom1.intersects(geom2):
-                intersecting_indices.add(feature1.id())  # Add unique index to the set
-                break  # If intersection is found, no need to check further for this feature
-    
-    return list(intersecting_indices)  # Return a list of unique intersecting indices
+    return list(get_intersection_matrix(layer1_name, layer2_name))
 
 
-def lines_to_points(input_line_layer_name, output_point_layer_name, id_col):
+def lines_to_points(input_line_layer_name, output_point_layer_name, id_col, line_ids=None):
     """
     Convert a line layer into a point layer with points every meter, including start and end points.
 
     :param input_line_layer_name: Name of the input line layer
     :param output_point_layer_name: Name of the output point layer
     :param id_col: Column name for line ID
+    :param line_ids: Optional iterable of line IDs; only these lines are converted
     """
     # Load the input line layer
-    input_line_layer = QgsProject.instance().mapLayersByName(input_line_layer_name)
-    if not input_line_layer:
+    input_line_layer = lr.resolve(input_line_layer_name)
+    if input_line_layer is None:
         raise ValueError(f"Layer '{input_line_layer_name}' not found.")
-    input_line_layer = input_line_layer[0]
 
     # Create a new memory point layer
     output_point_layer = QgsVectorLayer(
@@ -394,52 +467,40 @@ def lines_to_points(input_line_layer_name, output_point_layer_name, id_col):
     ])
     output_point_layer.updateFields()
 
-    # Initialize the new feature with the correct fields
-    new_feature = QgsFeature()
-    new_feature.setFields(provider.fields())
-
-    # Iterate over each feature in the input line layer
+    # Collect the vertices of every part of every line
+    wanted = None if line_ids is None else set(line_ids)
+    parts = []
+    line_ids = []
     for line_feature in input_line_layer.getFeatures():
+        if wanted is not None and line_feature.attribute(id_col) not in wanted:
+            continue
         geom = line_feature.geometry()
 
         # Ensure the geometry is either single-line or multi-line
         if geom.isMultipart():
-            parts = geom.asMultiPolyline()  # Decompose multi-line
+            polylines = geom.asMultiPolyline()  # Decompose multi-line
         else:
-            parts = [geom.asPolyline()]  # Treat as single-line
+            polylines = [geom.asPolyline()]  # Treat as single-line
 
         # Use the ID from the specified column
         line_id = line_feature.attribute(id_col)
 
-        # Process each part of the multi-part line or single line
-        for part_index, part in enumerate(parts):
-            # Reset index for each part
-            index = 1
-
-            # Add the start point
-            start_point = part[0]  # First vertex in the part
-            new_feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(start_point.x(), start_point.y())))
-            new_feature.setAttributes([line_id, index])
-            provider.addFeature(new_feature)
-            index += 1
-
-            # Add points at 1-meter intervals
-            current_distance = 1
-            # Create a geometry from the part to interpolate points
-            polyline_geom = QgsGeometry.fromPolylineXY(part)  # From PolylineXY for safety
-            while current_distance < polyline_geom.length():
-                point = polyline_geom.interpolate(current_distance)  # Interpolated point
-                new_feature.setGeometry(QgsGeometry.fromPointXY(point.asPoint()))  # Use asPointXY
-                new_feature.setAttributes([line_id, index])
-                provider.addFeature(new_feature)
-                current_distance += 1
-                index += 1
-
-            # Add the end point
-            end_point = part[-1]  # Last vertex in the part
-            new_feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(end_point.x(), end_point.y())))
-            new_feature.setAttributes([line_id, index])
-            provider.addFeature(new_feature)
+        for part in polylines:
+            parts.append([(vertex.x(), vertex.y()) for vertex in part])
+            line_ids.append(line_id)
+
+    # Compute every point along every line at once
+    point_line_ids, point_index, xs, ys = densify_lines(parts, line_ids, spacing=1)
+
+    # Build all features and load them in a single batch
+    fields = provider.fields()
+    features = []
+    for line_id, index, x, y in zip(point_line_ids.tolist(), point_index.tolist(), xs.tolist(), ys.tolist()):
+        new_feature = QgsFeature(fields)
+        new_feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+        new_feature.setAttributes([line_id, index])
+        features.append(new_feature)
+    provider.addFeatures(features)
 
     # Commit changes to the output point layer
     output_point_layer.commitChanges()
@@ -451,6 +512,119 @@ def lines_to_points(input_line_layer_name, output_point_layer_name, id_col):
 
 
 
+def contour_profile_along_lines(lines_layer_name, contour_layer_path, points_layer_name, id_col='line_id',
+                                attribute_field='ContourEle', spacing=1, column_name='elevation', line_ids=None,
+                                hits=None):
+    """
+    Build elevation profiles directly from the contour lines crossed by each line, without a raster.
+
+    Every line is intersected with the contour polylines, the distance along the line and the contour
+    elevation of each crossing are recorded and the profile is linearly interpolated between crossings at
+    the same stations lines_to_points creates. Stations before the first or after the last crossing take
+    the elevation of that crossing; lines that cross no contour are left untouched.
+
+    :param lines_layer_name: Name of the line layer
+    :param contour_layer_path: Path to the contour vector layer (it is not added to the project)
+    :param points_layer_name: Name of the point layer created by lines_to_points
+    :param id_col: Column holding the line ID in both layers (default 'line_id')
+    :param attribute_field: Contour elevation attribute (default 'ContourEle')
+    :param spacing: Spacing used by lines_to_points (default 1 meter)
+    :param column_name: Column of the points layer the profile is written to (default 'elevation')
+    :param line_ids: Optional iterable of line IDs to restrict the computation to
+    :param hits: Optional hit matrix from get_intersection_matrix keyed by line ID; only the contours
+                 listed for a line are intersected with it. Its feature IDs must be those of the file at
+                 contour_layer_path, so build it from a layer opened on that file
+    :return: Dictionary mapping line ID to a tuple of (station distances, elevations)
+    """
+    lines_layer = lr.resolve(lines_layer_name)
+    points_layer = lr.resolve(points_layer_name)
+    contour_layer = QgsVectorLayer(contour_layer_path, "Contours", "ogr")
+    if not contour_layer.isValid():
+        print("Invalid contour layer")
+        return {}
+
+    # Collect the lines to profile
+    wanted = None if line_ids is None else set(line_ids)
+    line_features = [feature for feature in lines_layer.getFeatures()
+                     if wanted is None or feature[id_col] in wanted]
+    if not line_features:
+        return {}
+    extent = QgsRectangle(line_features[0].geometry().boundingBox())
+    for feature in line_features[1:]:
+        extent.combineExtentWith(feature.geometry().boundingBox())
+
+    # Index the contours around the lines once, or only fetch the contours already known to be crossed
+    if hits is not None:
+        request = QgsFeatureRequest().setFilterFids(sorted({fid for line_id, fids in hits.items()
+                                                             if wanted is None or line_id in wanted
+                                                             for fid in fids}))
+    else:
+        request = QgsFeatureRequest().setFilterRect(extent)
+    index = QgsSpatialIndex()
+    contour_geometries = {}
+    contour_values = {}
+    for contour in contour_layer.getFeatures(request):
+        index.addFeature(contour)
+        contour_geometries[contour.id()] = contour.geometry()
+        contour_values[contour.id()] = contour[attribute_field]
+
+    profiles = {}
+    first_parts = {}
+    for line_feature in line_features:
+        geom = line_feature.geometry()
+        parts = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
+        stations = []
+        elevations = []
+
+        for part in parts:
+            part_geom = QgsGeometry.fromPolylineXY(part)
+            distances = []
+            values = []
+            if hits is not None:
+                candidates = [fid for fid in hits.get(line_feature[id_col], []) if fid in contour_geometries]
+            else:
+                candidates = index.intersects(part_geom.boundingBox())
+            for candidate in candidates:
+                contour_geom = contour_geometries[candidate]
+                if not part_geom.intersects(contour_geom):
+                    continue
+                crossing = part_geom.intersection(contour_geom)
+                for vertex in crossing.vertices():
+                    distances.append(part_geom.lineLocatePoint(QgsGeometry.fromPointXY(QgsPointXY(vertex.x(), vertex.y()))))
+                    values.append(contour_values[candidate])
+
+            part_stations = station_distances(part_geom.length(), spacing)
+            stations.append(part_stations)
+            if distances:
+                order = np.argsort(distances)
+                elevations.append(np.interp(part_stations, np.array(distances)[order], np.array(values, dtype=float)[order]))
+            else:
+                elevations.append(np.full(len(part_stations), np.nan))
+
+        profiles[line_feature[id_col]] = (np.concatenate(stations), np.concatenate(elevations))
+        # Point indexes restart on every part, so points are matched against the first part
+        first_parts[line_feature[id_col]] = elevations[0]
+
+    # Match the profiles to the point features by line ID and index
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([id_col, 'index'], points_layer.fields())
+    feature_ids = []
+    point_values = []
+    for point in points_layer.getFeatures(request):
+        profile = first_parts.get(point[id_col])
+        if profile is None or not 1 <= point['index'] <= len(profile):
+            continue
+        value = profile[point['index'] - 1]
+        if np.isnan(value):
+            continue
+        feature_ids.append(point.id())
+        point_values.append(value)
+
+    ps.write_attribute_columns(points_layer, feature_ids, {column_name: np.array(point_values, dtype=float)},
+                               field_types={column_name: QVariant.Double})
+    print(f"Contour profiles computed for {len(profiles)} lines.")
+
+    return profiles
+
 def extract_elevation_along_lines(line_layer, contour_layer, output_field_name):    # Prepare raster layer for elevation data (if not already done)
     print( 'start')
     #print( contour_layer.name())
@@ -476,8 +650,9 @@ def extract_elevation_along_lines(line_layer, contour_layer, output_field_name):
         return
 
     # Get elevation values along lines
-    line_layer.startEditing()
-    line_layer_provider = line_layer.dataProvider()
+    feature_ids = []
+    start_elevations = []
+    end_elevations = []
     for feat in line_layer.getFeatures():
         line_geom = feat.geometry()
         line_start_point = line_geom.vertexAt(0)
@@ -488,11 +663,14 @@ def extract_elevation_along_lines(line_layer, contour_layer, output_field_name):
         # Get elevation at end point
         end_elevation = get_elevation_at_point(line_end_point, contour_raster_layer)
 
-        # Save elevation values as attributes
-        line_layer_provider.changeAttributeValues({feat.id(): {f"{output_field_name}_start": start_elevation,
-                                                               f"{output_field_name}_end": end_elevation}})
+        feature_ids.append(feat.id())
+        start_elevations.append(start_elevation)
+        end_elevations.append(end_elevation)
 
-    line_layer.commitChanges()
+    # Save elevation values as attributes
+    ps.write_attribute_columns(line_layer, feature_ids,
+                               {f"{output_field_name}_start": np.array(start_elevations, dtype=float),
+                                f"{output_field_name}_end": np.array(end_elevations, dtype=float)})
     print("Elevation extraction completed.")
 
 from qgis.core import QgsProject, QgsField, QgsFeature
@@ -500,27 +678,18 @@ from qgis.PyQt.QtCore import QVariant
 
 def extract_lengths(layer_name, field_name='length'):
     # Get the layer by name
-    layer = QgsProject.instance().mapLayersByName(layer_name)
-    if not layer:
+    layer = lr.resolve(layer_name)
+    if layer is None:
         print(f"Layer '{layer_name}' not found")
         return
-    layer = layer[0]
 
     # Check if the layer is a line layer
     if layer.geometryType() != QgsWkbTypes.LineGeometry:
         print(f"Layer '{layer_name}' is not a line layer")
         return
 
-    # Check if the field already exists, if not, create it
-    if field_name not in [field.name() for field in layer.fields()]:
-        layer.startEditing()
-        layer.dataProvider().addAttributes([QgsField(field_name, QVariant.Double)])
-        layer.updateFields()
-    
-    # Get the index of the new field
-    field_index = layer.fields().indexOf(field_name)
-
-    # Initialize a list to store lengths
+    # Initialize lists to store feature IDs and lengths
+    feature_ids = []
     feature_lengths = []
 
     # Loop through each feature in the layer
@@ -532,13 +701,13 @@ def extract_lengths(layer_name, field_name='length'):
             length = geom.length()  # length for singlepart geometry
         
         # Append the length to the list
+        feature_ids.append(feature.id())
         feature_lengths.append(length)
-        
-        # Update the feature with the new length attribute
-        layer.startEditing()
-        layer.changeAttributeValue(feature.id(), field_index, length)
-        layer.commitChanges()
-    
+
+    # Update the features with the new length attribute in one batch
+    ps.write_attribute_columns(layer, feature_ids, {field_name: np.array(feature_lengths, dtype=float)},
+                               field_types={field_name: QVariant.Double})
+
     return feature_lengths
 
 
@@ -597,16 +766,13 @@ def intersection_analysis(layer_a_name, layer_b_name, column_name):
     """   
     
     # Load the layers by name
-    layer_a = QgsProject.instance().mapLayersByName(layer_a_name)
-    layer_b = QgsProject.instance().mapLayersByName(layer_b_name)
+    layer_a = lr.resolve(layer_a_name)
+    layer_b = lr.resolve(layer_b_name)
 
-    if not layer_a or not layer_b:
+    if layer_a is None or layer_b is None:
         print("Error: One or both layers not found.")
         return
 
-    layer_a = layer_a[0]
-    layer_b = layer_b[0]
-
     # Define a temporary memory layer to hold the intersections
     output_path = 'memory:temporary_intersections'
 
@@ -631,23 +797,10 @@ def intersection_analysis(layer_a_name, layer_b_name, column_name):
             if intersecting_id is not None:
                 intersecting_ids.add(int(intersecting_id)-1)
 
-        # Add the field to layer_a if it doesn't exist
-        field_index = layer_a.fields().indexFromName(column_name)
-        if field_index == -1:
-            layer_a.startEditing()  # Enable editing
-            layer_a.dataProvider().addAttributes([QgsField(column_name, QVariant.String)])
-            layer_a.updateFields()
-            layer_a.commitChanges()  # Save changes
-
-        # Update Layer A with 'y' if there are intersections
-        layer_a.startEditing()
-        field_index = layer_a.fields().indexFromName(column_name)  # Re-check the field index
-        
-        for feature in layer_a.getFeatures():
-            if feature.id() in intersecting_ids:
-                layer_a.changeAttributeValue(feature.id(), field_index, 1)
-
-        layer_a.commitChanges()  # Commit the changes to persist them
+        # Update Layer A with 1 if there are intersections, adding the field if it doesn't exist
+        hits = [feature.id() for feature in layer_a.getFeatures() if feature.id() in intersecting_ids]
+        ps.write_attribute_columns(layer_a, hits, {column_name: np.ones(len(hits), dtype=int)},
+                                   field_types={column_name: QVariant.String})
 
         print("Intersection analysis and attribute update completed.")
 
@@ -655,6 +808,116 @@ def intersection_analysis(layer_a_name, layer_b_name, column_name):
         print(f"Error during processing: {e}")
 
 
+# Crossings rounding to the same point at this many decimals of a map unit are one crossing
+CROSSING_DECIMALS = 2
+
+def crossing_analysis(lines_layer_name, targets, count_suffix='_n', distance_suffix='_d', line_ids=None,
+                      id_field='line_id', found=None):
+    """
+    Identify the crossings between the lines of one layer and several target line layers in a single pass.
+
+    Every target layer is indexed once with its geometries stored in the index. Each line is prepared once
+    and tested against the bounding-box candidates of every target. For each target column three values
+    are written: 1 in the column itself if the line crosses the target, the number of crossings in
+    column + count_suffix and the distance along the line to the first crossing in column + distance_suffix.
+    Only lines with at least one crossing are written, so running the analysis quad by quad never resets
+    crossings found earlier. With found, the crossings of a line are collected over every call, so a line
+    crossing several quads is counted over the packages of all of them.
+
+    :param lines_layer_name: Name of the line layer to update (e.g. 'highline_anchors')
+    :param targets: Dictionary mapping column name to target layer name or layer, e.g. {'xsRail': 'Trans_RailFeature'}
+    :param count_suffix: Suffix of the crossing count columns (default '_n')
+    :param distance_suffix: Suffix of the first crossing distance columns (default '_d')
+    :param line_ids: Optional IDs restricting the analysis to some lines, e.g. the lines of the quad the targets
+        were downloaded for
+    :param id_field: Field of the line layer holding the line IDs (default 'line_id')
+    :param found: Optional dictionary the crossings are collected in, {column: {feature id: {location: distance}}}.
+        The counts and distances written are those of every crossing collected for the line
+    :return: Dictionary mapping column name to the number of lines crossing that target
+    """
+    lines_layer = lr.resolve(lines_layer_name)
+    if lines_layer is None:
+        print("Error: Line layer not found.")
+        return None
+
+    indexes = {}
+    extent = None
+    for column, target in targets.items():
+        if isinstance(target, str):
+            found = lr.resolve(target)
+            if found is None:
+                print(f"Error: Layer '{target}' not found.")
+                return None
+            target = found
+        indexes[column] = QgsSpatialIndex(target.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+        if extent is None:
+            extent = QgsRectangle(target.extent())
+        else:
+            extent.combineExtentWith(target.extent())
+
+    if extent is None:
+        return {}
+
+    wanted = None if line_ids is None else set(np.asarray(line_ids).tolist())
+    hits = {column: ([], [], []) for column in targets}
+    for line in lines_layer.getFeatures(QgsFeatureRequest().setFilterRect(extent)):
+        if wanted is not None and line[id_field] not in wanted:
+            continue
+        geom = line.geometry()
+        if geom.isEmpty():
+            continue
+        engine = None
+
+        for column, index in indexes.items():
+            candidates = index.intersects(geom.boundingBox())
+            if not candidates:
+                continue
+            if engine is None:
+                engine = QgsGeometry.createGeometryEngine(geom.constGet())
+                engine.prepareGeometry()
+
+            # Every point (or shared stretch) of the intersection is one crossing, keyed by where it starts
+            # along the line. A target split into several features at the crossing (e.g. two road segments
+            # meeting on the line) touches the line at the same location and is counted once
+            crossings = {} if found is None else found.setdefault(column, {}).setdefault(line.id(), {})
+            for fid in candidates:
+                target_geom = index.geometry(fid)
+                if not engine.intersects(target_geom.constGet()):
+                    continue
+                for part in geom.intersection(target_geom).asGeometryCollection():
+                    distance, x, y = min((geom.lineLocatePoint(QgsGeometry.fromPointXY(QgsPointXY(vertex.x(), vertex.y()))),
+                                          vertex.x(), vertex.y()) for vertex in part.vertices())
+                    crossings[(round(x, CROSSING_DECIMALS), round(y, CROSSING_DECIMALS))] = distance
+
+            if crossings:
+                feature_ids, counts, distances = hits[column]
+                feature_ids.append(line.id())
+                counts.append(len(crossings))
+                distances.append(min(crossings.values()))
+
+    # One batched commit for all targets; lines that do not cross a target keep their stored values
+    hit_ids = sorted({fid for feature_ids, _, _ in hits.values() for fid in feature_ids})
+    position = {fid: i for i, fid in enumerate(hit_ids)}
+    columns = {}
+    field_types = {}
+    for column, (feature_ids, counts, distances) in hits.items():
+        rows = [position[fid] for fid in feature_ids]
+        columns[column] = np.full(len(hit_ids), None, dtype=object)
+        columns[column][rows] = 1
+        columns[column + count_suffix] = np.full(len(hit_ids), None, dtype=object)
+        columns[column + count_suffix][rows] = counts
+        columns[column + distance_suffix] = np.full(len(hit_ids), np.nan)
+        columns[column + distance_suffix][rows] = distances
+        field_types[column] = QVariant.String
+        field_types[column + count_suffix] = QVariant.Int
+        field_types[column + distance_suffix] = QVariant.Double
+    if hit_ids:
+        ps.write_attribute_columns(lines_layer, hit_ids, columns, field_types=field_types, skip_missing=True)
+
+    print("Crossing analysis and attribute update completed.")
+    return {column: len(feature_ids) for column, (feature_ids, _, _) in hits.items()}
+
+
 # Example usage:
 #layer1 = QgsProject.instance().mapLayersByName('Layer 1')[0]
 #layer2 = QgsProject.instance().mapLayersByName('Layer 2')[0]
@@ -704,13 +967,13 @@ def merge_layers(layers_to_merge, output_layer_name):
     merge_layers = []
 
     for layer_name in layers_to_merge:
-        layer = QgsProject.instance().mapLayersByName(layer_name)
+        layer = lr.resolve(layer_name)
 
-        if not layer:
+        if layer is None:
             print(f"Error: Layer '{layer_name}' not found.")
             return None
         
-        merge_layers.append(layer[0])
+        merge_layers.append(layer)
 
     # Merge all specified contour layers into one without dissolving
     merged_layer = processing.run(
@@ -754,11 +1017,10 @@ def rasterize_contours_within_bbox(contour_layer_path, bounding_box_layer_name,
         return False
 
     # Get bounding box layer
-    bounding_box_layers = QgsProject.instance().mapLayersByName(bounding_box_layer_name)
-    if not bounding_box_layers:
+    bounding_box_layer = lr.resolve(bounding_box_layer_name)
+    if bounding_box_layer is None:
         print(f"Bounding box layer '{bounding_box_layer_name}' not found")
         return False
-    bounding_box_layer = bounding_box_layers[0]
 
     # Get bounding box layer's extent
     bounding_box_extent = bounding_box_layer.extent()
@@ -824,44 +1086,92 @@ def select_overlapping_features(layer_to_select_from, layer_with_extent):
     #print( selected_feature_ids)
     return selected_feature_ids
 
-def sample_raster_values(points_layer_name, raster_layer_name, bounding_box_layer_name):
-    from qgis.core import (QgsSpatialIndex, QgsFeatureRequest, QgsGeometry, QgsVectorLayer, QgsRasterLayer,
-                       QgsVectorFileWriter, QgsFeature, QgsField, QgsCoordinateTransformContext, QgsPointXY,
-                       QgsWkbTypes, QgsProject, QgsRaster)
+def get_points_in_rectangle(point_layer, rectangle):
+    """
+    Collect the IDs and coordinates of the points of a layer that fall inside a rectangle.
+
+    :param point_layer: The point QgsVectorLayer
+    :param rectangle: QgsRectangle to filter by
+    :return: A tuple of (feature IDs, x array, y array)
+    """
+    request = QgsFeatureRequest().setFilterRect(rectangle).setNoAttributes()
+    feature_ids = []
+    xs = []
+    ys = []
+    for feature in point_layer.getFeatures(request):
+        point = feature.geometry().asPoint()
+        if not rectangle.contains(point):
+            continue
+        feature_ids.append(feature.id())
+        xs.append(point.x())
+        ys.append(point.y())
+    return feature_ids, np.array(xs, dtype=float), np.array(ys, dtype=float)
+
+def sample_array_values(points_layer_name, array, geotransform, method='nearest', column_name='elevation'):
+    """
+    Sample an in-memory raster array at every point inside its extent and store the values in a column.
+
+    :param points_layer_name: Name of the point layer to update
+    :param array: 2D array of raster values, e.g. from surface_interpolation.interpolate_contour_surface
+    :param geotransform: GDAL style geotransform of the array
+    :param method: 'nearest' or 'bilinear'
+    :param column_name: The column the sampled values are written to (default 'elevation')
+    :return: A tuple of (feature IDs, value array) for the sampled points
+    """
+    point_layer = lr.resolve(points_layer_name)
+
+    x0, dx, _, y0, _, dy = geotransform
+    rows, cols = array.shape
+    extent = QgsRectangle(x0, y0 + rows * dy, x0 + cols * dx, y0)
+    extent.normalize()
+
+    feature_ids, xs, ys = get_points_in_rectangle(point_layer, extent)
+    values = sample_array_at_points(array, geotransform, xs, ys, method=method)
+
+    ps.write_attribute_columns(point_layer, feature_ids, {column_name: values},
+                               field_types={column_name: QVariant.Double})
+    print(f"{len(feature_ids)} values sampled and added to the point layer.")
+
+    return feature_ids, values
+
+def sample_raster_values(points_layer_name, raster_layer_name, bounding_box_layer_name, method='nearest'):
+    """
+    Sample a raster at every point inside a bounding box and store the values in the 'elevation' column.
+
+    The raster window covering the bounding box is read once and all points are converted to pixel
+    indices in bulk (see read_raster_window and sample_array_at_points).
+
+    :param points_layer_name: Name of the point layer to update
+    :param raster_layer_name: Name of the raster layer to sample
+    :param bounding_box_layer_name: Name of the layer whose extent limits the points sampled
+    :param method: 'nearest' or 'bilinear'
+    :return: A tuple of (feature IDs, elevation array) for the sampled points
+    """
     # Load the point layer
-    point_layer = QgsProject.instance().mapLayersByName(points_layer_name)[0]
-    
+    point_layer = lr.resolve(points_layer_name)
+
     # Load the raster layer
-    raster_layer = QgsProject.instance().mapLayersByName(raster_layer_name)[0]
-    
+    raster_layer = lr.resolve(raster_layer_name)
+
     # Get the bounding box layer
-    bounding_box_layer = QgsProject.instance().mapLayersByName(bounding_box_layer_name)[0]
+    bounding_box_layer = lr.resolve(bounding_box_layer_name)
     bounding_box_extent = bounding_box_layer.extent()
-    
-    # Create a new field to store the elevation values
-    point_layer.startEditing()
-    if not point_layer.fields().indexFromName('elevation') == -1:
-        print("Elevation column already exists.")
-        
-    
-    point_layer.addAttribute(QgsField('elevation', QVariant.Double))
-    point_layer.updateFields()
-    
-    # Iterate over each point feature
-    for feature in point_layer.getFeatures():
-        point = feature.geometry().asPoint()
-    
-        # Check if the point is within the bounding box
-        if not bounding_box_extent.contains(point):
-            continue
-    
-        # Sample raster value at the point
-        value = raster_layer.dataProvider().identify(point, QgsRaster.IdentifyFormatValue).results()[1]
-    
-        # Update the elevation attribute
-        
-        point_layer.changeAttributeValue(feature.id(), point_layer.fields().indexFromName('elevation'), value)
-    
-    point_layer.commitChanges()
+
+    # Only iterate over the points inside the bounding box
+    feature_ids, xs, ys = get_points_in_rectangle(point_layer, bounding_box_extent)
+
+    # Read the raster window once and sample every point from it
+    bbox = (bounding_box_extent.xMinimum(), bounding_box_extent.yMinimum(),
+            bounding_box_extent.xMaximum(), bounding_box_extent.yMaximum())
+    array, geotransform = read_raster_window(raster_layer.source(), bbox)
+    if array is None:
+        return feature_ids, np.full(len(feature_ids), np.nan)
+    elevations = sample_array_at_points(array, geotransform, xs, ys, method=method)
+
+    # Update the elevation attribute in one batch
+    ps.write_attribute_columns(point_layer, feature_ids, {'elevation': elevations},
+                               field_types={'elevation': QVariant.Double})
     print("Elevation values sampled and added to the point layer.")
 
+    return feature_ids, elevations
+
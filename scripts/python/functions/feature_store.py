@@ -0,0 +1,117 @@
+import os
+import glob
+import hashlib
+import pandas as pd
+
+import functions.data_cleaning as dc
+import functions.clearance as cl
+
+# Bump when build_line_features changes so stored features are rebuilt
+FEATURE_VERSION = 2
+
+CROSSING_COLUMNS = ['xsRail', 'xsRoad', 'xsTrail']
+CATEGORICAL_COLUMNS = ['home_anchor_type', 'far_anchor_type', 'state']
+
+
+def summary_features(profiles, id_col='line_id', index_col='index', value_col='elevation'):
+    """
+    Whole-profile elevation statistics of every line.
+
+    :param profiles: DataFrame of points with line ID, point index and elevation columns
+    :return: DataFrame with one row per line: home, far, mean, median, min, max, std and range elevation
+    """
+    profiles = profiles.sort_values([id_col, index_col], kind='stable')
+    summary = profiles.groupby(id_col).agg(
+        home_elevation=(value_col, 'first'),
+        far_elevation=(value_col, 'last'),
+        mean_elevation=(value_col, 'mean'),
+        median_elevation=(value_col, 'median'),
+        min_elevation=(value_col, 'min'),
+        max_elevation=(value_col, 'max'),
+        std_elevation=(value_col, 'std')
+    ).reset_index()
+    summary['range_elevation'] = (summary['max_elevation'] - summary['min_elevation']).abs()
+    return summary
+
+
+def build_line_features(lines, profiles):
+    """
+    Engineer the per-line modeling features from the extraction outputs.
+
+    Crossing flags missing from the extraction are filled with 0, categorical columns are factorized and
+    the summary and 10-segment elevation statistics and the ground clearance of the loaded line
+    (see clearance.line_clearance) are merged onto the line attributes (length, land flags, riggable, ...).
+
+    :param lines: DataFrame of highline_anchors with full column names
+    :param profiles: DataFrame of highline_anchors_points with full column names
+    :return: DataFrame with one row per line
+    """
+    lines = lines.copy()
+    for column in CROSSING_COLUMNS:
+        if column in lines:
+            # Older extractions flagged crossings with 'y', newer ones with 1; missing means no crossing
+            flags = pd.to_numeric(lines[column], errors='coerce')
+            lines[column] = flags.where(flags.notna() | lines[column].isna(), 1).fillna(0).astype(int)
+    for column in CATEGORICAL_COLUMNS:
+        if column in lines:
+            lines[column] = pd.factorize(lines[column])[0]
+
+    features = pd.merge(lines, summary_features(profiles), on='line_id')
+    features = pd.merge(features, dc.segment_features(profiles), on='line_id')
+    clearance = cl.line_clearance(profiles, lines.set_index('line_id')['length'])
+    features = pd.merge(features, clearance[['line_id', 'min_clearance', 'pinch_fraction']], on='line_id')
+    features['mean_anchor_height'] = (features['home_elevation'] + features['far_elevation']) / 2
+    return features
+
+
+def input_key(paths):
+    """
+    Key of a set of input tables: a hash of their contents and of FEATURE_VERSION.
+
+    :param paths: Paths to the input tables
+    :return: Hex digest
+    """
+    digest = hashlib.sha256(f"features-v{FEATURE_VERSION}".encode('utf-8'))
+    for table_path in paths:
+        with open(table_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def load_features(path, store_dir=None, rebuild=False, keep=3):
+    """
+    Load the per-line features of the outputs in path, building and storing them when the inputs changed.
+
+    Features are stored as pickles named after input_key, so loading unchanged inputs only hashes the
+    input files and reads one pickle. Only the `keep` most recently used entries are kept.
+
+    :param path: Folder holding the extraction outputs (e.g. 'data/output/')
+    :param store_dir: Folder of the feature store (default: a 'features' folder beside path)
+    :param rebuild: Rebuild the features even if they are stored
+    :param keep: Number of stored entries to keep
+    :return: DataFrame of per-line features (see build_line_features)
+    """
+    if store_dir is None:
+        store_dir = os.path.join(os.path.dirname(os.path.normpath(path)), 'features')
+    os.makedirs(store_dir, exist_ok=True)
+
+    paths = dc.output_table_paths(path)
+    store_path = os.path.join(store_dir, f"line_features_{input_key(paths)}.pkl")
+
+    if os.path.exists(store_path) and not rebuild:
+        # Touch the entry so it counts as recently used
+        os.utime(store_path)
+        return pd.read_pickle(store_path)
+
+    print(f"Building line features from {', '.join(paths)}")
+    lines, profiles = [dc.load_output_table(table_path) for table_path in paths]
+    features = build_line_features(lines, profiles)
+    features.to_pickle(store_path)
+
+    # Drop the least recently used entries
+    entries = sorted(glob.glob(os.path.join(store_dir, 'line_features_*.pkl')), key=os.path.getmtime, reverse=True)
+    for entry in entries[keep:]:
+        os.remove(entry)
+
+    return features
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import datetime
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+class RunLog:
+    """
+    Per-stage timers and counters of a pipeline run, written as JSON lines.
+
+    Every `with run_log.stage(name, cluster=...)` block appends one record to
+    <log_dir>/<name>_<start time>.jsonl when it exits, holding the run ID, cluster, stage, wall time
+    in seconds, status ('ok' or 'error') and the counters incremented inside the block (e.g.
+    bytes_downloaded, features_read, raster_cells, points_sampled). Records are appended as they
+    finish, so the log of an interrupted run is still readable.
+
+    Counters go to the innermost open stage; stages opened inside another stage record it as their
+    parent and are left out of the cluster totals of summarize so time is not counted twice.
+
+    :param log_dir: Folder the log is written to (e.g. project_directory + '/logs/')
+    :param name: Prefix of the log file name
+    """
+
+    def __init__(self, log_dir, name='extraction'):
+        os.makedirs(log_dir, exist_ok=True)
+        self.run_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.path = os.path.join(log_dir, f"{name}_{self.run_id}.jsonl")
+        self.records = []
+        self.totals = {}
+        self._open = []
+
+    @contextmanager
+    def stage(self, name, cluster=None, **fields):
+        """
+        Time a block of work and collect its counters.
+
+        :param name: Stage name (e.g. 'download', 'rasterize')
+        :param cluster: Cluster the work belongs to, None for run wide stages
+        :param fields: Additional values stored with the record
+        :return: Context manager yielding the dictionary of counters of the stage
+        """
+        counters = {}
+        parent = self._open[-1][0] if self._open else None
+        self._open.append((name, counters))
+        status = 'ok'
+        start = time.perf_counter()
+        try:
+            yield counters
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self._open.pop()
+            self.write({
+                'run': self.run_id,
+                'cluster': _plain(cluster),
+                'stage': name,
+                'parent': parent,
+                'seconds': round(seconds, 6),
+                'status': status,
+                'counters': counters,
+                **{key: _plain(value) for key, value in fields.items()},
+            })
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter of the innermost open stage and to the run totals.
+
+        :param name: Counter name
+        :param amount: Amount added
+        """
+        amount = _plain(amount)
+        self.totals[name] = self.totals.get(name, 0) + amount
+        if self._open:
+            counters = self._open[-1][1]
+            counters[name] = counters.get(name, 0) + amount
+
+    def write(self, record):
+        """
+        Append a record to the log.
+
+        :param record: JSON serializable dictionary
+        """
+        self.records.append(record)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def summary(self, top=10):
+        """
+        Print the slowest clusters and stages of this run (see summarize).
+        """
+        return summarize(self.records, top)
+
+
+def _plain(value):
+    # NumPy scalars (cluster IDs, array sizes) are not JSON serializable
+    return value.item() if hasattr(value, 'item') else value
+
+
+def read_run_log(log_path):
+    """
+    :param log_path: Path to a log written by RunLog
+    :return: List of records, lines that cannot be parsed (e.g. cut off by a crash) are skipped
+    """
+    records = []
+    with open(log_path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summarize(records, top=10):
+    """
+    Rank the clusters and stages of a run by the time spent on them and print the report.
+
+    :param records: Records of a RunLog, or the path to its log
+    :param top: Number of clusters listed
+    :return: Tuple of DataFrames (clusters, stages). clusters has the total seconds, the number of
+             failed stages and the slowest stage of every cluster; stages has the count, total, mean
+             and max seconds and the summed counters of every stage
+    """
+    if isinstance(records, str):
+        records = read_run_log(records)
+    if not records:
+        print("No stage records to summarize.")
+        return None, None
+
+    df = pd.DataFrame(records)
+    # Keep integer cluster IDs from turning into floats next to the run wide (None) records
+    df['cluster'] = pd.Series([record.get('cluster') for record in records], index=df.index, dtype=object)
+    counters = pd.DataFrame(list(df['counters']), index=df.index).fillna(0)
+
+    stages = df.groupby('stage')['seconds'].agg(['count', 'sum', 'mean', 'max'])
+    stages = stages.join(counters.groupby(df['stage']).sum().round().astype('int64'))
+    stages = stages.sort_values('sum', ascending=False)
+
+    top_level = df[df['cluster'].notna() & df['parent'].isna()]
+    if top_level.empty:
+        clusters = pd.DataFrame(columns=['seconds', 'errors', 'slowest_stage'])
+    else:
+        slowest = top_level.loc[top_level.groupby('cluster')['seconds'].idxmax(), ['cluster', 'stage']]
+        clusters = top_level.groupby('cluster').agg(
+            seconds=('seconds', 'sum'),
+            errors=('status', lambda status: int((status == 'error').sum()))
+        )
+        clusters['slowest_stage'] = slowest.set_index('cluster')['stage']
+        clusters = clusters.sort_values('seconds', ascending=False)
+
+    total = df.loc[df['parent'].isna(), 'seconds'].sum()
+    print(f"Run {df['run'].iloc[0]}: {len(df)} stage records, {total:.1f} s in top level stages")
+    print("\nStages by total time:")
+    print(stages.to_string(float_format=lambda value: f"{value:.2f}"))
+    print(f"\nSlowest {min(top, len(clusters))} clusters:")
+    print(clusters.head(top).to_string(float_format=lambda value: f"{value:.2f}"))
+
+    return clusters, stages
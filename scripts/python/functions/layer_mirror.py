@@ -0,0 +1,287 @@
+import numpy as np
+from qgis.core import QgsFeatureRequest, QgsWkbTypes, NULL
+from qgis.PyQt.QtCore import QVariant
+
+import functions.project_setup as ps
+import functions.layer_registry as lr
+from functions.profile_sampling import sample_array_at_points
+
+INTEGER_TYPES = (QVariant.Int, QVariant.LongLong, QVariant.UInt, QVariant.ULongLong)
+
+
+class LayerMirror:
+    """
+    Columnar NumPy copy of the attributes and point coordinates of a vector layer.
+
+    The layer is read once; afterwards group lookups (the feature IDs of a cluster_group or of a set of
+    line_ids), value lookups by feature ID and bounding boxes are array operations instead of layer scans.
+    Grouping a column sorts it once and keeps the start and end offset of every value, so the rows of a
+    value are one slice. Integer columns without NULLs are int64, other numeric columns float64 with NaN
+    for NULL and everything else object arrays with None for NULL.
+
+    Columns changed with set() are written back with sync() in one write_attribute_columns call per
+    column set; values the layer already holds (e.g. written by dp.sample_raster_values) can be recorded
+    with set(..., dirty=False) or re-read with refresh().
+
+    :param layer: The vector layer, its ID or its name (see layer_registry)
+    :param columns: Columns to mirror (default: all fields)
+    """
+
+    def __init__(self, layer, columns=None):
+        self.layer = lr.resolve(layer)
+        if self.layer is None:
+            raise ValueError(f"Layer '{layer}' not found")
+        self.columns = {}
+        self._groups = {}
+        self._dirty = {}
+        self._field_types = {}
+
+        names = self.layer.fields().names()
+        self.refresh(names if columns is None else [name for name in columns if name in names], geometry=True)
+
+    def __len__(self):
+        return len(self.fids)
+
+    def refresh(self, columns=None, geometry=False):
+        """
+        Re-read columns (and optionally the coordinates) from the layer, e.g. after another function wrote to it.
+        Unsynced changes of the re-read columns are dropped.
+
+        :param columns: Column name or list of column names (default: all mirrored columns)
+        :param geometry: Also re-read feature IDs and coordinates; every mirrored column is re-read with them
+        """
+        if isinstance(columns, str):
+            columns = [columns]
+        if columns is None:
+            columns = list(self.columns)
+        if geometry:
+            columns = list(dict.fromkeys(list(self.columns) + list(columns)))
+        fields = self.layer.fields()
+        indexes = [fields.indexFromName(name) for name in columns]
+
+        request = QgsFeatureRequest().setSubsetOfAttributes([index for index in indexes if index != -1])
+        if not geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        fids = []
+        xs = []
+        ys = []
+        values = [[] for _ in columns]
+        for feature in self.layer.getFeatures(request):
+            fids.append(feature.id())
+            if geometry:
+                geom = feature.geometry()
+                if geom.isEmpty():
+                    point = None
+                elif geom.type() == QgsWkbTypes.PointGeometry and not geom.isMultipart():
+                    point = geom.asPoint()
+                else:
+                    point = geom.boundingBox().center()
+                xs.append(np.nan if point is None else point.x())
+                ys.append(np.nan if point is None else point.y())
+            for column_values, index in zip(values, indexes):
+                column_values.append(None if index == -1 or feature[index] == NULL else feature[index])
+
+        fids = np.array(fids, dtype=np.int64)
+        if not geometry and not np.array_equal(fids, self.fids):
+            # Features were added or removed since the mirror was built
+            self.refresh(columns, geometry=True)
+            return
+
+        if geometry:
+            self.fids = fids
+            self.x = np.array(xs, dtype=float)
+            self.y = np.array(ys, dtype=float)
+            self._fid_order = np.argsort(fids, kind='stable')
+            self._sorted_fids = fids[self._fid_order]
+
+        for name, column_values, index in zip(columns, values, indexes):
+            field_type = fields.at(index).type() if index != -1 else None
+            self.columns[name] = _to_array(column_values, field_type)
+            self._groups.pop(name, None)
+            self._dirty.pop(name, None)
+
+    def rows(self, fids):
+        """
+        :param fids: Feature IDs
+        :return: Row positions of the features in the mirror's arrays
+        """
+        fids = np.asarray(list(fids) if not isinstance(fids, np.ndarray) else fids, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_fids, fids)
+        positions = np.minimum(positions, len(self._sorted_fids) - 1)
+        if len(fids) and (len(self._sorted_fids) == 0 or np.any(self._sorted_fids[positions] != fids)):
+            raise KeyError(f"Feature IDs not in the mirror of '{self.layer.name()}'")
+        return self._fid_order[positions]
+
+    def _group_index(self, column):
+        # Rows sorted by the column's values and the offsets of every value in that order
+        group = self._groups.get(column)
+        if group is None:
+            values = self.columns[column]
+            keyed = values.astype(str) if values.dtype == object else values
+            order = np.argsort(keyed, kind='stable')
+            unique, starts = np.unique(keyed[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            offsets = {(value.item() if hasattr(value, 'item') else value): (start, end)
+                       for value, start, end in zip(unique, starts, ends)}
+            group = (order, offsets, values.dtype == object)
+            self._groups[column] = group
+        return group
+
+    def group_rows(self, column, values):
+        """
+        :param column: Column to group by (e.g. 'cluster_group' or 'line_id')
+        :param values: A value or an iterable of values
+        :return: Row positions of the features holding any of the values
+        """
+        order, offsets, as_str = self._group_index(column)
+        if np.isscalar(values):
+            values = [values]
+        slices = []
+        for value in values:
+            key = str(value) if as_str else (value.item() if hasattr(value, 'item') else value)
+            span = offsets.get(key)
+            if span is not None:
+                slices.append(order[span[0]:span[1]])
+        return np.concatenate(slices) if slices else np.array([], dtype=np.int64)
+
+    def indexes(self, column, values):
+        """
+        Array version of project_setup.select_indexes_from_values.
+
+        :return: Feature IDs of the features whose column holds any of the values
+        """
+        return self.fids[self.group_rows(column, values)]
+
+    def values(self, column, fids=None):
+        """
+        Array version of project_setup.select_values_from_index.
+
+        :param column: Column name
+        :param fids: Feature IDs (default: all features)
+        :return: Values of the column for the features
+        """
+        if fids is None:
+            return self.columns[column]
+        return self.columns[column][self.rows(fids)]
+
+    def unique(self, column):
+        """
+        :return: Sorted distinct values of a column
+        """
+        order, offsets, _ = self._group_index(column)
+        return np.array(sorted(offsets))
+
+    def bounding_box(self, fids, padding=30):
+        """
+        Bounding box of the points of some features, same keys as dp.get_bounding_box_dimensions.
+
+        :param fids: Feature IDs
+        :param padding: Distance added on every side in map units (default 30 as get_bounding_box_dimensions)
+        :return: Dictionary with min_x, max_x, min_y, max_y, height and width
+        """
+        rows = self.rows(fids)
+        min_x = np.nanmin(self.x[rows]) - padding
+        max_x = np.nanmax(self.x[rows]) + padding
+        min_y = np.nanmin(self.y[rows]) - padding
+        max_y = np.nanmax(self.y[rows]) + padding
+        return {'min_x': min_x, 'max_x': max_x, 'min_y': min_y, 'max_y': max_y,
+                'height': max_y - min_y, 'width': max_x - min_x}
+
+    def in_rectangle(self, min_x, min_y, max_x, max_y):
+        """
+        :return: Feature IDs of the points inside a rectangle (edges included)
+        """
+        inside = (self.x >= min_x) & (self.x <= max_x) & (self.y >= min_y) & (self.y <= max_y)
+        return self.fids[inside]
+
+    def coordinates(self, fids):
+        """
+        :return: Tuple of (x array, y array) of the features
+        """
+        rows = self.rows(fids)
+        return self.x[rows], self.y[rows]
+
+    def sample_array(self, column, array, geotransform, method='nearest', fids=None):
+        """
+        Array version of dp.sample_array_values: sample a raster array at every point inside its extent
+        and store the values in a column of the mirror (written to the layer by sync).
+
+        :param column: Column the values are stored in (e.g. 'elevation')
+        :param array: 2D array of raster values
+        :param geotransform: GDAL style geotransform of the array
+        :param method: 'nearest' or 'bilinear'
+        :param fids: Optional feature IDs; only these points are sampled
+        :return: A tuple of (feature IDs, value array) for the sampled points
+        """
+        x0, dx, _, y0, _, dy = geotransform
+        rows, cols = array.shape
+        min_x, max_x = sorted((x0, x0 + cols * dx))
+        min_y, max_y = sorted((y0, y0 + rows * dy))
+        inside = self.in_rectangle(min_x, min_y, max_x, max_y)
+        fids = inside if fids is None else inside[np.isin(inside, fids)]
+        xs, ys = self.coordinates(fids)
+        values = sample_array_at_points(array, geotransform, xs, ys, method=method)
+        self.set(column, fids, values, field_type=QVariant.Double)
+        return fids, values
+
+    def set(self, column, fids, values, field_type=None, dirty=True):
+        """
+        Change the values of a column for some features. The column is created if needed.
+
+        :param column: Column name
+        :param fids: Feature IDs
+        :param values: Values aligned with fids
+        :param field_type: QVariant type used if sync has to create the field
+        :param dirty: Mark the rows to be written by sync; False records values the layer already holds
+        """
+        rows = self.rows(fids)
+        values = np.asarray(values)
+        if column not in self.columns:
+            self.columns[column] = np.full(len(self.fids), np.nan) if values.dtype.kind in 'fiub' \
+                else np.full(len(self.fids), None, dtype=object)
+        current = self.columns[column]
+        if values.dtype.kind == 'f' and current.dtype.kind in 'iub':
+            current = current.astype(float)
+        elif values.dtype.kind not in 'fiub' and current.dtype != object:
+            current = current.astype(object)
+        current[rows] = values
+        self.columns[column] = current
+        self._groups.pop(column, None)
+        if field_type is not None:
+            self._field_types[column] = field_type
+        if dirty:
+            self._dirty.setdefault(column, set()).update(rows.tolist())
+
+    def dirty_columns(self):
+        """
+        :return: Names of the columns with changes not yet written to the layer
+        """
+        return [name for name, rows in self._dirty.items() if rows]
+
+    def sync(self):
+        """
+        Write the changed values of every dirty column back to the layer in one batch per column.
+
+        :return: Number of values written
+        """
+        written = 0
+        for column in self.dirty_columns():
+            rows = np.array(sorted(self._dirty[column]), dtype=np.int64)
+            values = self.columns[column][rows]
+            field_types = {column: self._field_types[column]} if column in self._field_types else None
+            if ps.write_attribute_columns(self.layer, self.fids[rows], {column: values}, field_types=field_types):
+                written += len(rows)
+                self._dirty[column] = set()
+        return written
+
+
+def _to_array(values, field_type):
+    # Attribute values of one field as a NumPy array, see LayerMirror for the dtypes
+    if field_type in INTEGER_TYPES and None not in values:
+        return np.array(values, dtype=np.int64)
+    if field_type in INTEGER_TYPES or field_type == QVariant.Double:
+        return np.array([np.nan if value is None else value for value in values], dtype=float)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
@@ -0,0 +1,134 @@
+from qgis.core import QgsProject, QgsMapLayer
+
+
+class LayerRegistry:
+    """
+    Cache of the project's layers handing out layer objects and field indexes by handle.
+
+    A handle is the layer itself, its layer ID or its name. A name is resolved with mapLayersByName
+    the first time it is used and remembered, later lookups are dictionary hits. When several layers
+    share a name a warning is printed and the first is used, as before; pass the layer or its ID to
+    pick a specific one. Entries are dropped when the project removes the layer and cached field
+    indexes when the layer's fields change, so a layer added again under the same name (e.g. the
+    Elev_Contour layer of every cluster) is looked up afresh.
+
+    :param project: The QgsProject to look layers up in (default: QgsProject.instance())
+    """
+
+    def __init__(self, project=None):
+        self.project = project if project is not None else QgsProject.instance()
+        self._layers = {}  # layer ID -> layer
+        self._names = {}  # name -> layer ID
+        self._fields = {}  # layer ID -> {field name: index}
+        self.project.layersWillBeRemoved.connect(self._forget)
+        self.project.cleared.connect(self.clear)
+
+    def _remember(self, layer):
+        layer_id = layer.id()
+        if layer_id not in self._layers:
+            self._layers[layer_id] = layer
+            if isinstance(layer, QgsMapLayer) and layer.type() == QgsMapLayer.VectorLayer:
+                layer.updatedFields.connect(lambda: self._fields.pop(layer_id, None))
+        return layer
+
+    def _forget(self, layer_ids):
+        # Connected to QgsProject.layersWillBeRemoved
+        for layer_id in layer_ids:
+            self._layers.pop(layer_id, None)
+            self._fields.pop(layer_id, None)
+        removed = set(layer_ids)
+        self._names = {name: layer_id for name, layer_id in self._names.items() if layer_id not in removed}
+
+    def clear(self):
+        """
+        Drop every cached entry.
+        """
+        self._layers.clear()
+        self._names.clear()
+        self._fields.clear()
+
+    def layer(self, handle):
+        """
+        :param handle: A layer, a layer ID or a layer name
+        :return: The layer, or None if there is no such layer in the project
+        """
+        if isinstance(handle, QgsMapLayer):
+            return handle
+
+        layer = self._layers.get(handle)
+        if layer is not None:
+            return layer
+
+        layer_id = self._names.get(handle)
+        if layer_id is not None:
+            layer = self._layers.get(layer_id)
+            if layer is not None and layer.name() == handle:
+                return layer
+            # The layer was renamed
+            del self._names[handle]
+
+        layer = self.project.mapLayer(handle)
+        if layer is not None:
+            return self._remember(layer)
+
+        matches = self.project.mapLayersByName(handle)
+        if not matches:
+            return None
+        if len(matches) > 1:
+            print(f"Warning: {len(matches)} layers are named '{handle}', using the first. "
+                  f"Pass the layer or its ID to choose another.")
+        self._names[handle] = matches[0].id()
+        return self._remember(matches[0])
+
+    def field_index(self, handle, field_name):
+        """
+        :param handle: A vector layer, its ID or its name
+        :param field_name: Name of the field
+        :return: Index of the field, -1 if the layer or the field does not exist
+        """
+        layer = self.layer(handle)
+        if layer is None:
+            return -1
+        layer_id = layer.id()
+        indexes = self._fields.get(layer_id)
+        if indexes is None:
+            self._remember(layer)
+            indexes = {name: index for index, name in enumerate(layer.fields().names())}
+            self._fields[layer_id] = indexes
+        return indexes.get(field_name, -1)
+
+
+_registry = None
+
+
+def get_registry():
+    """
+    :return: The LayerRegistry of the current project, created on first use
+    """
+    global _registry
+    if _registry is None:
+        _registry = LayerRegistry()
+    return _registry
+
+
+def resolve(handle):
+    """
+    Layer of a handle (the layer, its ID or its name) through the shared registry.
+
+    :return: The layer, or None if it is not in the project
+    """
+    return get_registry().layer(handle)
+
+
+def field_index(handle, field_name):
+    """
+    Cached field index of a layer through the shared registry.
+
+    :return: Index of the field, -1 if the layer or the field does not exist
+    """
+    return get_registry().field_index(handle, field_name)
+
+
+def layer_label(handle):
+    # Name of a handle for messages
+    return handle.name() if isinstance(handle, QgsMapLayer) else str(handle)
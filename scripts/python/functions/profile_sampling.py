@@ -0,0 +1,216 @@
+import numpy as np
+from osgeo import gdal, ogr
+
+# Raster and profile sampling helpers that only need NumPy and GDAL, kept out of data_processing so
+# they can run outside of QGIS (e.g. in the candidate_search workers). data_processing re-exports them.
+
+
+def densify_lines(parts, line_ids, spacing=1):
+    """
+    Compute points every `spacing` map units along a set of polylines, including start and end points.
+
+    All stations of all parts are located in one pass: the vertices of every part are laid end to end
+    on a single cumulative distance axis, each station is placed on its segment with `np.searchsorted`
+    and its coordinates are linearly interpolated between the segment's vertices.
+
+    :param parts: A list of (n, 2) arrays (or sequences of (x, y) pairs) holding the vertices of each part
+    :param line_ids: A list of line IDs, one per part
+    :param spacing: Distance between interior points (default 1 meter)
+    :return: A tuple of arrays (line_id, index, x, y) with one entry per point, index starting at 1 for each part
+    """
+    parts = [np.asarray(part, dtype=float).reshape(-1, 2) for part in parts]
+    line_ids = np.asarray(line_ids)
+
+    if not parts:
+        empty = np.array([], dtype=float)
+        return line_ids[:0], np.array([], dtype=int), empty, empty
+
+    vertices = np.concatenate(parts)
+    vertex_counts = np.array([len(part) for part in parts])
+    part_of_vertex = np.repeat(np.arange(len(parts)), vertex_counts)
+    first_vertex = np.concatenate(([0], np.cumsum(vertex_counts)[:-1]))
+    last_vertex = first_vertex + vertex_counts - 1
+
+    # Length of every segment; the "segment" joining the last vertex of a part to the first vertex
+    # of the next part is not part of either line and gets zero length
+    segment_lengths = np.hypot(np.diff(vertices[:, 0]), np.diff(vertices[:, 1]))
+    segment_lengths[part_of_vertex[1:] != part_of_vertex[:-1]] = 0
+    vertex_distance = np.concatenate(([0], np.cumsum(segment_lengths)))
+    part_lengths = vertex_distance[last_vertex] - vertex_distance[first_vertex]
+
+    # Interior stations sit at spacing, 2 * spacing, ... strictly before the end of the part
+    station_counts = np.maximum(np.ceil(part_lengths / spacing).astype(int) - 1, 0)
+    part_of_station = np.repeat(np.arange(len(parts)), station_counts)
+    station_offsets = np.concatenate(([0], np.cumsum(station_counts)[:-1]))
+    station_number = np.arange(station_counts.sum()) - np.repeat(station_offsets, station_counts) + 1
+    station_distance = vertex_distance[first_vertex][part_of_station] + station_number * spacing
+
+    # Locate the segment each station falls on and interpolate along it
+    segment = np.searchsorted(vertex_distance, station_distance, side='right') - 1
+    segment = np.minimum(segment, last_vertex[part_of_station] - 1)
+    fraction = (station_distance - vertex_distance[segment]) / segment_lengths[segment]
+    station_xy = vertices[segment] + fraction[:, None] * (vertices[segment + 1] - vertices[segment])
+
+    # Assemble start point, interior stations and end point of each part in order
+    point_counts = station_counts + 2
+    point_offsets = np.concatenate(([0], np.cumsum(point_counts)[:-1]))
+    xy = np.empty((point_counts.sum(), 2))
+    xy[point_offsets] = vertices[first_vertex]
+    xy[point_offsets + point_counts - 1] = vertices[last_vertex]
+    interior = np.ones(len(xy), dtype=bool)
+    interior[point_offsets] = False
+    interior[point_offsets + point_counts - 1] = False
+    xy[interior] = station_xy
+
+    point_line_ids = np.repeat(line_ids, point_counts)
+    point_index = np.arange(len(xy)) - np.repeat(point_offsets, point_counts) + 1
+
+    return point_line_ids, point_index, xy[:, 0], xy[:, 1]
+
+def station_distances(length, spacing=1):
+    """
+    Distances along a line of the points created by lines_to_points / densify_lines.
+
+    :param length: Length of the line part
+    :param spacing: Distance between interior points (default 1 meter)
+    :return: Array holding 0, spacing, 2 * spacing, ... (strictly below length) and length
+    """
+    count = max(int(np.ceil(length / spacing)) - 1, 0)
+    return np.concatenate(([0], np.arange(1, count + 1) * spacing, [length]))
+
+def read_raster_window(raster_path, bbox=None, band=1):
+    """
+    Read a window of a raster band into a NumPy array in one call.
+
+    :param raster_path: Path to a raster readable by GDAL
+    :param bbox: Optional tuple of (min_x, min_y, max_x, max_y) in the raster's CRS. The whole band is read if omitted.
+    :param band: The band number to read (default 1)
+    :return: A tuple of (array, geotransform) where nodata cells are NaN and the geotransform describes the window,
+             or (None, None) if the raster could not be read
+    """
+    dataset = gdal.Open(raster_path)
+    if dataset is None:
+        print(f"Error: Unable to open raster '{raster_path}'")
+        return None, None
+
+    x0, dx, _, y0, _, dy = dataset.GetGeoTransform()
+    raster_band = dataset.GetRasterBand(band)
+
+    # Convert the bounding box to a pixel window clipped to the raster
+    xoff, yoff = 0, 0
+    xsize, ysize = dataset.RasterXSize, dataset.RasterYSize
+    if bbox is not None:
+        min_x, min_y, max_x, max_y = bbox
+        cols = np.sort([(min_x - x0) / dx, (max_x - x0) / dx])
+        rows = np.sort([(max_y - y0) / dy, (min_y - y0) / dy])
+        xoff = int(np.clip(np.floor(cols[0]), 0, dataset.RasterXSize))
+        yoff = int(np.clip(np.floor(rows[0]), 0, dataset.RasterYSize))
+        xsize = int(np.clip(np.ceil(cols[1]), 0, dataset.RasterXSize)) - xoff
+        ysize = int(np.clip(np.ceil(rows[1]), 0, dataset.RasterYSize)) - yoff
+        if xsize <= 0 or ysize <= 0:
+            print("Error: Bounding box does not overlap the raster")
+            return None, None
+
+    array = raster_band.ReadAsArray(xoff, yoff, xsize, ysize).astype(float)
+    nodata = raster_band.GetNoDataValue()
+    if nodata is not None:
+        array[array == nodata] = np.nan
+    dataset = None
+
+    return array, (x0 + xoff * dx, dx, 0, y0 + yoff * dy, 0, dy)
+
+def sample_array_at_points(array, geotransform, xs, ys, method='nearest'):
+    """
+    Sample a raster array at many points at once.
+
+    :param array: 2D array of raster values, NaN marks nodata
+    :param geotransform: GDAL style geotransform of the array (no rotation)
+    :param xs: Array of x coordinates in the raster's CRS
+    :param ys: Array of y coordinates in the raster's CRS
+    :param method: 'nearest' returns the value of the cell containing each point, 'bilinear' interpolates
+                   between the four surrounding cell centres
+    :return: Array of values aligned with xs/ys, NaN for points outside the array or on nodata
+    """
+    x0, dx, _, y0, _, dy = geotransform
+    rows_count, cols_count = array.shape
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    values = np.full(xs.shape, np.nan)
+
+    # Fractional pixel coordinates of every point
+    cols = (xs - x0) / dx
+    rows = (ys - y0) / dy
+    inside = (cols >= 0) & (cols < cols_count) & (rows >= 0) & (rows < rows_count)
+
+    if method == 'nearest' or cols_count < 2 or rows_count < 2:
+        values[inside] = array[rows[inside].astype(int), cols[inside].astype(int)]
+    elif method == 'bilinear':
+        # Offsets relative to the cell centres, clamped to the outer ring of centres
+        cols_c = np.clip(cols[inside] - 0.5, 0, cols_count - 1)
+        rows_c = np.clip(rows[inside] - 0.5, 0, rows_count - 1)
+        col0 = np.minimum(np.floor(cols_c).astype(int), cols_count - 2)
+        row0 = np.minimum(np.floor(rows_c).astype(int), rows_count - 2)
+        fc = cols_c - col0
+        fr = rows_c - row0
+        values[inside] = (array[row0, col0] * (1 - fc) * (1 - fr) + array[row0, col0 + 1] * fc * (1 - fr)
+                          + array[row0 + 1, col0] * (1 - fc) * fr + array[row0 + 1, col0 + 1] * fc * fr)
+    else:
+        raise ValueError(f"Unknown sampling method '{method}'")
+
+    return values
+
+def rasterize_contours_to_array(contour_layer_path, bbox, attribute_field='ContourEle', cell_size=1, all_touched=False):
+    """
+    Rasterize contour lines within a bounding box into an in-memory array.
+
+    Uses gdal.RasterizeLayer on a MEM dataset, so no GRASS session is started and nothing is written to disk.
+
+    :param contour_layer_path: Path to the contour vector layer
+    :param bbox: Tuple of (min_x, min_y, max_x, max_y) in the contour layer's CRS
+    :param attribute_field: The attribute burned into the raster (default 'ContourEle')
+    :param cell_size: Cell size in map units (default 1 meter)
+    :param all_touched: Burn every cell a contour touches instead of only the cells on its rendered path
+    :return: A tuple of (array, geotransform) where cells without a contour are NaN, or (None, None) on error
+    """
+    source = ogr.Open(contour_layer_path)
+    if source is None:
+        print(f"Invalid contour layer '{contour_layer_path}'")
+        return None, None
+    contour_layer = source.GetLayer()
+
+    if contour_layer.FindFieldIndex(attribute_field, True) == -1:
+        print(f"Attribute '{attribute_field}' not found in '{contour_layer_path}'")
+        return None, None
+
+    # Only hand the contours inside the bounding box to the rasterizer
+    min_x, min_y, max_x, max_y = bbox
+    contour_layer.SetSpatialFilterRect(min_x, min_y, max_x, max_y)
+
+    # Create the in-memory raster aligned to the top left corner of the bounding box
+    cols = max(int(np.ceil((max_x - min_x) / cell_size)), 1)
+    rows = max(int(np.ceil((max_y - min_y) / cell_size)), 1)
+    geotransform = (min_x, cell_size, 0, max_y, 0, -cell_size)
+    nodata = -9999.0
+
+    dataset = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Float64)
+    dataset.SetGeoTransform(geotransform)
+    spatial_ref = contour_layer.GetSpatialRef()
+    if spatial_ref is not None:
+        dataset.SetProjection(spatial_ref.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.Fill(nodata)
+
+    options = [f"ATTRIBUTE={attribute_field}"]
+    if all_touched:
+        options.append("ALL_TOUCHED=TRUE")
+    if gdal.RasterizeLayer(dataset, [1], contour_layer, options=options) != 0:
+        print("Error: Rasterization failed")
+        return None, None
+
+    array = band.ReadAsArray()
+    array[array == nodata] = np.nan
+    dataset = None
+    source = None
+
+    return array, geotransform
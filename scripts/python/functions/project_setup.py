@@ -7,7 +7,7 @@ from qgis.core import (QgsVectorLayer, QgsCoordinateReferenceSystem, QgsProject,
                        QgsField, QgsFeature, edit, QgsVectorFileWriter,
                        QgsFeatureRequest, QgsExpression, QgsCategorizedSymbolRenderer,
                        QgsRendererCategory,QgsSymbol,QgsWkbTypes, QgsMapLayer,
-                       QgsNetworkAccessManager, QgsApplication)
+                       QgsNetworkAccessManager, QgsApplication, NULL)
 
 from qgis.PyQt.QtCore import QVariant
 from qgis.PyQt.QtNetwork import QNetworkDiskCache
@@ -26,26 +26,26 @@ import pandas as pd
 import logging
 import re
 import csv
+from functions.data_cleaning import FULL_COLUMN_NAMES
+import functions.layer_registry as lr
 
 def add_id_column(layer_name, id_column_name):
     # Load the layer
-    layer = QgsProject.instance().mapLayersByName(layer_name)[0]
+    layer = lr.resolve(layer_name)
 
     # Check if the ID column already exists, if so, delete it
     if id_column_name in layer.fields().names():
         layer.dataProvider().deleteAttributes([layer.fields().indexFromName(id_column_name)])
-
-    # Add the new ID column
-    layer.dataProvider().addAttributes([QgsField(id_column_name, QVariant.Int)])
-    layer.updateFields()
+        layer.updateFields()
 
     # Get the number of features in the layer
     feature_count = layer.featureCount()
 
-    # Update the attribute table with IDs
-    with edit(layer):
-        for i, feature in enumerate(layer.getFeatures()):
-            layer.changeAttributeValue(feature.id(), layer.fields().indexFromName(id_column_name), i + 1)
+    # Number the features in iteration order and write the new ID column in one batch
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setNoAttributes()
+    feature_ids = [feature.id() for feature in layer.getFeatures(request)]
+    write_attribute_columns(layer, feature_ids, {id_column_name: np.arange(1, len(feature_ids) + 1)},
+                            field_types={id_column_name: QVariant.Int})
 
     print("ID column '{}' added to layer '{}' with values from 1 to {}.".format(id_column_name, layer_name, feature_count))
 
@@ -89,11 +89,10 @@ def apply_categorized_symbology(layer_name, attribute_name, color_map=None):
     :param color_map: Optional dictionary mapping attribute values to colors (as QColor or RGB hex strings)
     """
     # Get the point layer by name
-    layers = QgsProject.instance().mapLayersByName(layer_name)
-    if not layers:
+    point_layer = lr.resolve(layer_name)
+    if point_layer is None:
         print(f"Error: Layer '{layer_name}' not found")
         return
-    point_layer = layers[0]
 
     # Check if the layer has the specified attribute
     field_index = point_layer.fields().indexFromName(attribute_name)
@@ -168,7 +167,7 @@ def export_attribute_table_to_csv(layer_name, output_csv_path):
     :param output_csv_path: The path where the CSV file will be saved.
     """
     # Get the layer by name
-    layer = QgsProject.instance().mapLayersByName(layer_name)[0]
+    layer = lr.resolve(layer_name)
     
     # Ensure the layer is valid
     if not layer.isValid():
@@ -189,6 +188,72 @@ def export_attribute_table_to_csv(layer_name, output_csv_path):
     print(f"Attribute table of layer {layer_name} has been exported to {output_csv_path}")
 
 
+def layer_to_dataframe(layer_name):
+    """
+    Read the attribute table of a layer into a DataFrame with typed columns and full column names.
+
+    Integer fields become nullable Int64 columns, real fields float64 (NULL as NaN) and everything else
+    string columns. Names truncated by the shapefile format are expanded with
+    data_cleaning.FULL_COLUMN_NAMES.
+
+    :param layer_name: The name of the layer, its ID or the layer itself
+    :return: DataFrame with one row per feature, or None if the layer is not valid
+    """
+    layer = lr.resolve(layer_name)
+    if not layer.isValid():
+        print(f"Layer {layer.name()} is not valid.")
+        return None
+
+    fields = layer.fields()
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    rows = [feature.attributes() for feature in layer.getFeatures(request)]
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+
+    data = {}
+    for field, values in zip(fields, columns):
+        values = [None if value == NULL else value for value in values]
+        if field.type() in (QVariant.Int, QVariant.LongLong, QVariant.UInt, QVariant.ULongLong):
+            data[field.name()] = pd.array(values, dtype='Int64')
+        elif field.type() == QVariant.Double:
+            data[field.name()] = pd.array([np.nan if value is None else value for value in values], dtype='float64')
+        else:
+            data[field.name()] = pd.array([None if value is None else str(value) for value in values], dtype='string')
+
+    return pd.DataFrame(data).rename(columns=FULL_COLUMN_NAMES)
+
+
+def export_attribute_table(layer_name, output_path):
+    """
+    Export the attribute table of a layer to a columnar file with proper dtypes and full column names.
+
+    The format follows the extension: .parquet for Parquet, .feather or .arrow for Arrow IPC. Both need
+    pyarrow. Load the result with data_cleaning.load_output_table.
+
+    :param layer_name: The name of the layer to export
+    :param output_path: The path of the output file
+    :return: The output path, or None if the table could not be written
+    """
+    df = layer_to_dataframe(layer_name)
+    if df is None:
+        return None
+
+    extension = os.path.splitext(output_path)[1].lower()
+    try:
+        if extension == '.parquet':
+            df.to_parquet(output_path, index=False)
+        elif extension in ('.feather', '.arrow'):
+            df.to_feather(output_path)
+        else:
+            print(f"Error: Unsupported table format '{extension}'")
+            return None
+    except ImportError as e:
+        print(f"Error: Unable to write '{output_path}', pyarrow is required. {e}")
+        return None
+
+    print(f"Attribute table of layer {layer_name} has been exported to {output_path}")
+    return output_path
+
+
 def clear_cache():
     """
     Clears various QGIS caches to ensure no lingering data is being held.
@@ -239,18 +304,16 @@ def get_attribute_table_names(layer_name):
     """
     Returns the attribute table field names for a specific layer in QGIS.
 
-    :param layer_name: The name of the layer for which to get attribute table names.
+    :param layer_name: The layer, its ID or its name, for which to get attribute table names.
     :type layer_name: str
     :return: A list of attribute table field names.
     :rtype: list
     """
     # Get the layer by name from the current project
-    layer = QgsProject.instance().mapLayersByName(layer_name)
+    layer = lr.resolve(layer_name)
     
-    if not layer:
+    if layer is None:
         raise ValueError(f"No layer found with the name: {layer_name}")
-    
-    layer = layer[0]  # Assuming the first layer with the given name is the one desired
 
     # Retrieve the fields from the layer
     fields = layer.fields()
@@ -264,18 +327,16 @@ def get_column_values(layer_name, column_name):
     """
     Retrieve all unique values from a specified column in the attribute table of a given layer.
 
-    :param layer_name: The name of the layer
+    :param layer_name: The layer, its ID or its name (see layer_registry)
     :param column_name: The name of the column from which to extract values
     :return: A set of unique values from the specified column
     """
     # Get the specified layer by name
-    layer = QgsProject.instance().mapLayersByName(layer_name)
+    layer = lr.resolve(layer_name)
     
-    if not layer:
+    if layer is None:
         print(f"Error: Layer '{layer_name}' not found.")
         return None
-    
-    layer = layer[0]
 
     # Check if the column exists in the layer
     field_names = [field.name() for field in layer.fields()]
@@ -329,21 +390,43 @@ def delete_folder(folder_path):
         print(f"Folder '{folder_path}' does not exist.")
 
 
-def download_shapefile_from_bbox(bbox, output_folder):
+TNM_PRODUCTS_URL = "https://tnmaccess.nationalmap.gov/api/v1/products"
+
+def build_tnm_request_url(bbox, api_url=TNM_PRODUCTS_URL):
+    """
+    Build the products API query for the 7.5 minute topo shapefiles covering a bounding box.
+
+    :param bbox: Tuple of (min_lon, min_lat, max_lon, max_lat)
+    :param api_url: Products API endpoint
+    :return: The request URL
+    """
+    # Format the bounding box as a query parameter
+    bbox_str = ",".join(map(str, bbox))
+    return api_url + "?bbox=" + bbox_str + "&prodExtents=7.5%20x%207.5%20minute&prodFormats=Shapefile&start=2022-01-01&outputFormat=JSON"
+
+def download_shapefile_from_bbox(bbox, output_folder, cache=None, api_url=TNM_PRODUCTS_URL, layers=None):
     """
     Download a shapefile from an API using a bounding box.
 
     :param bbox: Tuple of (min_lon, min_lat, max_lon, max_lat)
     :param output_folder: Directory to save the shapefile
+    :param cache: Optional functions.tile_cache.TileCache. Product queries and zips are then served
+                  from the cache when possible and new downloads are kept in it.
+    :param api_url: Products API endpoint, can be pointed at a local stand-in for testing
+    :param layers: Optional list of layer name substrings; only those shapefiles are extracted (see unzip_folder)
     :return: Path to the extracted shapefile folder or None if an error occurred
     """
     #bbox = converted_bbox 
     #output_folder = usgs_path
     
-    # Format the bounding box as a query parameter
-    bbox_str = ",".join(map(str, bbox))
     # Build the request URL
-    request_url = "https://tnmaccess.nationalmap.gov/api/v1/products?bbox=" + bbox_str + "&prodExtents=7.5%20x%207.5%20minute&prodFormats=Shapefile&start=2022-01-01&outputFormat=JSON"
+    request_url = build_tnm_request_url(bbox, api_url)
+
+    if cache is not None:
+        items = cache.query_products(request_url)
+        if items is None:
+            return None
+        return _extract_products(items, output_folder, cache, layers)
 
     # Fetch the response from the API
     response = requests.get(request_url)
@@ -376,6 +459,18 @@ def download_shapefile_from_bbox(bbox, output_folder):
     # Parse the response JSON to get the items
     items = response_json.get("items", [])
     
+    return _extract_products(items, output_folder, layers=layers)
+
+def _extract_products(items, output_folder, cache=None, layers=None):
+    """
+    Download and extract the zips of a list of products API items.
+
+    :param items: The 'items' list of a products API response
+    :param output_folder: Directory to extract each product into, one folder per item title
+    :param cache: Optional TileCache to fetch the zips through
+    :param layers: Optional list of layer name substrings to extract
+    :return: List of extracted folders or None if there were no items
+    """
     if not items:
         print("Error: No shapefiles found for the given bounding box.")
         return None
@@ -403,25 +498,34 @@ def download_shapefile_from_bbox(bbox, output_folder):
             extracted_folders.append(specific_output_folder)
             continue
 
-        # Create a temporary file to save the response content
-        temp_zip_path = os.path.join(tempfile.gettempdir(), "downloaded_shapefile.zip")
+        if cache is not None:
+            # Serve the zip from the tile cache, downloading it only on a miss
+            temp_zip_path = cache.fetch(item)
+            if temp_zip_path is None:
+                continue
+        else:
+            # Create a temporary file for this item so downloads never share a path
+            fd, temp_zip_path = tempfile.mkstemp(suffix=".zip")
 
-        # Download the shapefile from the provided link
-        response = requests.get(download_url, stream=True)
+            # Download the shapefile from the provided link
+            response = requests.get(download_url, stream=True)
 
-        # Write the response content to the temporary file
-        with open(temp_zip_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                f.write(chunk)
+            # Write the response content to the temporary file
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
 
         # Check if the file is a valid zipfile
         if not zipfile.is_zipfile(temp_zip_path):
             print(f"Error: The downloaded file '{title}' is not a valid zipfile.")
+            if cache is None:
+                os.remove(temp_zip_path)
             continue
 
         # Extract the zipfile to the specific output folder
-        with zipfile.ZipFile(temp_zip_path, "r") as zip_ref:
-            zip_ref.extractall(specific_output_folder)
+        unzip_folder(temp_zip_path, specific_output_folder, layers)
+        if cache is None:
+            os.remove(temp_zip_path)
 
         print(f"Shapefile '{title}' downloaded and extracted successfully.")
         extracted_folders.append(specific_output_folder)
@@ -518,17 +622,15 @@ def remove_layer(layer_name):
     """
     Remove a layer from the QGIS project by its name.
 
-    :param layer_name: The name of the layer to remove.
+    :param layer_name: The layer to remove, its ID or its name.
     """
     project = QgsProject.instance()
-    layers = project.mapLayersByName(layer_name)
+    layer = lr.resolve(layer_name)
     
-    if not layers:
+    if layer is None:
         print(f"Layer '{layer_name}' not found in the project.")
         return
     
-    layer = layers[0]
-    
     # Check if the layer is valid before removing
     if isinstance(layer, QgsMapLayer) and layer.isValid():
         try:
@@ -540,6 +642,52 @@ def remove_layer(layer_name):
         print(f"Layer '{layer_name}' is not valid or has already been deleted.")
     
 
+def has_gui():
+    """
+    :return: True when running inside the QGIS desktop application, False in standalone (headless) runs
+    """
+    try:
+        from qgis.utils import iface
+    except ImportError:
+        return False
+    return iface is not None
+
+
+def add_vector_layer(path, layer_name, provider='ogr'):
+    """
+    Load a vector layer into the project. In the QGIS desktop it is added through iface so it is drawn,
+    in headless runs (see run_pipeline.py) it goes straight into QgsProject with no canvas or symbology work.
+
+    :param path: Path to the vector file
+    :param layer_name: Name of the layer in the project
+    :param provider: Data provider (default 'ogr')
+    :return: The added layer, or None if it could not be loaded
+    """
+    if has_gui():
+        from qgis.utils import iface
+        layer = iface.addVectorLayer(path, layer_name, provider)
+        if not layer:
+            print(f"Error: Unable to load layer '{layer_name}' from '{path}'")
+            return None
+        return layer
+
+    layer = QgsVectorLayer(path, layer_name, provider)
+    if not layer.isValid():
+        print(f"Error: Unable to load layer '{layer_name}' from '{path}'")
+        return None
+    QgsProject.instance().addMapLayer(layer)
+    return layer
+
+
+def refresh_canvas():
+    """
+    Redraw all layers of the map canvas in the QGIS desktop, does nothing in headless runs.
+    """
+    if has_gui():
+        from qgis.utils import iface
+        iface.mapCanvas().refreshAllLayers()
+
+
 def save_layer(layer, output_path, file_format):
     # Define the output options
     options = QgsVectorFileWriter.SaveVectorOptions()
@@ -562,18 +710,16 @@ def select_attribute_values(layer_name, column_name):
     """
     Retrieve all values from a specific column in a layer's attribute table.
 
-    :param layer_name: The name of the layer
+    :param layer_name: The layer, its ID or its name (see layer_registry)
     :param column_name: The name of the column to retrieve values from
     :return: A list of values from the specified column
     """
     # Load the layer by its name
-    layer = QgsProject.instance().mapLayersByName(layer_name)
+    layer = lr.resolve(layer_name)
 
-    if not layer:
+    if layer is None:
         print(f"Error: Layer '{layer_name}' not found.")
         return None
-    
-    layer = layer[0]
 
     # Ensure the column exists in the layer
     if layer.fields().indexFromName(column_name) == -1:
@@ -596,11 +742,10 @@ def select_features_by_index(layer_name, feature_indexes):
     :return: None
     """
     # Load the vector layer
-    layer = QgsProject.instance().mapLayersByName(layer_name)
-    if not layer:
+    layer = lr.resolve(layer_name)
+    if layer is None:
         print(f"Error: Layer '{layer_name}' not found")
         return
-    layer = layer[0]
 
     # Start editing the layer to select features
     layer.startEditing()
@@ -635,20 +780,19 @@ def select_indexes_from_values(layer_name, column_name, values):
     """
     Select feature indexes from a QGIS vector layer where a specific column has one of the given values.
 
-    :param layer_name: The name of the vector layer
+    :param layer_name: The vector layer, its ID or its name (see layer_registry)
     :param column_name: The name of the column to apply the condition on
     :param values: An iterable of values to match in the specified column
     :return: A list of feature IDs (indexes) where the condition is true
     """
     # Load the vector layer
-    layer = QgsProject.instance().mapLayersByName(layer_name)
-    if not layer:
+    layer = lr.resolve(layer_name)
+    if layer is None:
         print(f"Error: Layer '{layer_name}' not found")
         return None
-    layer = layer[0]
 
     # Ensure the column exists
-    field_index = layer.fields().indexFromName(column_name)
+    field_index = lr.field_index(layer, column_name)
     if field_index == -1:
         print(f"Error: Column '{column_name}' not found")
         return None
@@ -657,7 +801,8 @@ def select_indexes_from_values(layer_name, column_name, values):
     values_str = ', '.join([f"'{v}'" for v in values])  # Join values with quotes for SQL
     expression_str = f'"{column_name}" IN ({values_str})'
     expression = QgsExpression(expression_str)
-    request = QgsFeatureRequest(expression)
+    request = QgsFeatureRequest(expression).setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([field_index])
 
     # Collect feature IDs that meet the condition
     matching_indexes = []
@@ -672,38 +817,38 @@ def select_values_from_index(layer_name, indexes, column_name):
     Select features from a QGIS vector layer based on a list of indexes (feature IDs) and 
     return the unique values from a specific attribute.
 
-    :param layer_name: The name of the vector layer
+    :param layer_name: The vector layer, its ID or its name (see layer_registry)
     :param indexes: A list of feature IDs to select
     :param column_name: The name of the column to extract unique values from
     :return: A set of unique values from the specified column
     """
     # Load the vector layer
-    layer = QgsProject.instance().mapLayersByName(layer_name)
-    if not layer:
+    layer = lr.resolve(layer_name)
+    if layer is None:
         print(f"Error: Layer '{layer_name}' not found")
         return None
-    layer = layer[0]
 
     # Ensure the column exists
-    field_index = layer.fields().indexFromName(column_name)
+    field_index = lr.field_index(layer, column_name)
     if field_index == -1:
         print(f"Error: Column '{column_name}' not found")
         return None
 
-    # Create a feature request to filter based on feature IDs
-    request = QgsFeatureRequest().setFilterFids(indexes)
+    # Create a feature request to filter based on feature IDs, only the wanted column is read
+    request = QgsFeatureRequest().setFilterFids(list(indexes)).setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([field_index])
 
     # Extract unique values from the specified column
     to_return = []
     for feature in layer.getFeatures(request):
-        value = feature[column_name]
+        value = feature[field_index]
         to_return.append(value)
 
     return to_return
     
 def save_temp_layer_as_permanent(layer_name, save_path):
     # Find the layer by name
-    layer = QgsProject.instance().mapLayersByName(layer_name)[0]
+    layer = lr.resolve(layer_name)
     #print( layer)
     QgsVectorFileWriter.writeAsVectorFormat(layer, save_path, "utf-8", layer.crs(), "ESRI Shapefile")
 
@@ -727,9 +872,37 @@ def setup_logging(logfile_name):
     console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
     logging.getLogger().addHandler(console_handler)
 
-def unzip_folder(zip_file_path, extract_to):
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+def _matching_members(zip_ref, layers, extensions):
+    # Members whose file name contains one of the layer substrings and has one of the extensions
+    members = []
+    for member in zip_ref.namelist():
+        file_name = os.path.basename(member)
+        if not file_name.lower().endswith(extensions):
+            continue
+        if any(layer in file_name for layer in layers):
+            members.append(member)
+    return members
+
+def unzip_folder(zip_file_path, extract_to, layers=None, extensions=SHAPEFILE_EXTENSIONS):
+    """
+    Extract a zip file, optionally only the shapefile members of the wanted layers.
+
+    :param zip_file_path: Path to the zip file
+    :param extract_to: Directory to extract into
+    :param layers: Optional list of substrings (e.g. ['Rail', 'Trail', 'Road', 'Elev']). When given only
+                   members whose file name contains one of them and ends with one of extensions are extracted.
+    :param extensions: File extensions extracted when filtering by layers
+    :return: List of extracted member names
+    """
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
+        if layers is None:
+            members = zip_ref.namelist()
+        else:
+            members = _matching_members(zip_ref, layers, tuple(extensions))
+        zip_ref.extractall(extract_to, members=members)
+    return members
         
 def update_last_run_time(log_file):
     # Read the existing log file if it exists
@@ -751,4 +924,75 @@ def update_last_run_time(log_file):
     
     # Write back the updated log file
     with open(log_file, 'w') as f:
-        f.writelines(lines)
\ No newline at end of file
+        f.writelines(lines)
+
+def write_attribute_columns(layer, feature_ids, columns, field_types=None, skip_missing=False):
+    """
+    Write whole columns of attribute values back to a layer in a single batch.
+
+    Values are collected per feature ID and handed to the data provider with one
+    changeAttributeValues call, so the layer is written (and committed) once instead
+    of once per feature. Missing columns are created first.
+
+    :param layer: The vector layer, or the name of the layer, to update
+    :param feature_ids: A sequence of feature IDs the values belong to
+    :param columns: A dictionary mapping column name to a sequence of values aligned with feature_ids
+    :param field_types: Optional dictionary mapping column name to the QVariant type used when the
+                        column has to be created. Types are otherwise inferred from the values.
+    :param skip_missing: Leave the stored value untouched where the new value is None or NaN instead of
+                         writing NULL, so several sparse columns can be written in one batch
+    :return: True if the changes were written, False otherwise
+    """
+    if isinstance(layer, str):
+        layer_name = layer
+        layer = lr.resolve(layer_name)
+        if layer is None:
+            print(f"Error: Layer '{layer_name}' not found")
+            return False
+
+    field_types = field_types or {}
+    feature_ids = np.asarray(feature_ids).tolist()
+    columns = {name: np.asarray(values) for name, values in columns.items()}
+
+    for name, values in columns.items():
+        if len(values) != len(feature_ids):
+            print(f"Error: Column '{name}' has {len(values)} values for {len(feature_ids)} features")
+            return False
+
+    provider = layer.dataProvider()
+
+    # Create any missing columns
+    new_fields = []
+    for name, values in columns.items():
+        if layer.fields().indexFromName(name) != -1:
+            continue
+        if name in field_types:
+            field_type = field_types[name]
+        elif np.issubdtype(values.dtype, np.bool_) or np.issubdtype(values.dtype, np.integer):
+            field_type = QVariant.Int
+        elif np.issubdtype(values.dtype, np.floating):
+            field_type = QVariant.Double
+        else:
+            field_type = QVariant.String
+        new_fields.append(QgsField(name, field_type))
+    if new_fields:
+        provider.addAttributes(new_fields)
+        layer.updateFields()
+
+    # Collect the updates per feature ID, NaN becomes NULL
+    updates = {fid: {} for fid in feature_ids}
+    for name, values in columns.items():
+        field_index = layer.fields().indexFromName(name)
+        for fid, value in zip(feature_ids, values.tolist()):
+            if isinstance(value, float) and np.isnan(value):
+                value = None
+            if value is None and skip_missing:
+                continue
+            updates[fid][field_index] = value
+
+    if not provider.changeAttributeValues(updates):
+        print(f"Error: Unable to write attributes {list(columns)} to layer '{layer.name()}'")
+        return False
+
+    layer.triggerRepaint()
+    return True
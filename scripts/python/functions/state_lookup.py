@@ -0,0 +1,179 @@
+import os
+import numpy as np
+from osgeo import gdal, ogr
+
+
+class StateLookup:
+    """
+    Serialized grid for assigning states to points without loading the state outlines.
+
+    Every grid cell holds the number of the state covering the whole cell, -1 where no state covers it
+    and -2 where a state boundary runs through it. The grid is built once from the state outlines
+    (e.g. cb_2018_us_state_500k.shp) and saved as a compressed .npz beside them, so later runs load it
+    in milliseconds. Points are assigned with one array lookup; only points falling in boundary cells are
+    tested exactly against the state outlines, which are read lazily with OGR.
+
+    :param grid: 2D int array of state numbers
+    :param geotransform: GDAL style geotransform of the grid
+    :param names: Array of state names indexed by state number
+    :param states_path: Path to the state outlines used for the exact fallback
+    :param name_field: Attribute holding the state name
+    :param crs_wkt: WKT of the coordinate reference system of the grid
+    """
+
+    outside = "Not in any state"
+
+    def __init__(self, grid, geotransform, names, states_path, name_field='NAME', crs_wkt=''):
+        self.grid = grid
+        self.geotransform = tuple(float(value) for value in geotransform)
+        self.names = np.asarray(names, dtype=object)
+        self.states_path = states_path
+        self.name_field = name_field
+        self.crs_wkt = crs_wkt
+        self._outlines = None
+
+    @classmethod
+    def build(cls, states_path, cell_size=None, name_field='NAME'):
+        """
+        Rasterize the state outlines into a lookup grid in the coordinate system of the outlines.
+
+        :param states_path: Path to the state polygon shapefile
+        :param cell_size: Cell size of the grid in map units (default: 4000 cells along the longer side)
+        :param name_field: Attribute holding the state name (default 'NAME')
+        :return: A StateLookup, or None if the outlines could not be read
+        """
+        source = ogr.Open(states_path)
+        if source is None:
+            print(f"Error: Unable to open state outlines '{states_path}'")
+            return None
+        layer = source.GetLayer()
+        min_x, max_x, min_y, max_y = layer.GetExtent()
+        crs_wkt = layer.GetSpatialRef().ExportToWkt() if layer.GetSpatialRef() else ''
+
+        if cell_size is None:
+            cell_size = max(max_x - min_x, max_y - min_y) / 4000
+        cols = int(np.ceil((max_x - min_x) / cell_size))
+        rows = int(np.ceil((max_y - min_y) / cell_size))
+        geotransform = (min_x, cell_size, 0, max_y, 0, -cell_size)
+
+        # Copy the outlines into memory with a state number to burn and their boundaries as lines
+        memory = ogr.GetDriverByName('Memory').CreateDataSource('states')
+        polygons = memory.CreateLayer('polygons', layer.GetSpatialRef(), ogr.wkbMultiPolygon)
+        polygons.CreateField(ogr.FieldDefn('number', ogr.OFTInteger))
+        boundaries = memory.CreateLayer('boundaries', layer.GetSpatialRef(), ogr.wkbMultiLineString)
+        names = []
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            polygon = ogr.Feature(polygons.GetLayerDefn())
+            polygon.SetField('number', len(names) + 1)
+            polygon.SetGeometry(geometry)
+            polygons.CreateFeature(polygon)
+            boundary = ogr.Feature(boundaries.GetLayerDefn())
+            boundary.SetGeometry(geometry.Boundary())
+            boundaries.CreateFeature(boundary)
+            names.append(feature.GetField(name_field))
+
+        raster = gdal.GetDriverByName('MEM').Create('', cols, rows, 2, gdal.GDT_Int16)
+        raster.SetGeoTransform(geotransform)
+        gdal.RasterizeLayer(raster, [1], polygons, options=['ATTRIBUTE=number'])
+        gdal.RasterizeLayer(raster, [2], boundaries, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+
+        # State numbers are stored from 0, cells crossed by a boundary are resolved exactly
+        grid = raster.GetRasterBand(1).ReadAsArray().astype(np.int16) - 1
+        grid[raster.GetRasterBand(2).ReadAsArray() > 0] = -2
+        raster = None
+        source = None
+
+        return cls(grid, geotransform, names, states_path, name_field, crs_wkt)
+
+    def save(self, grid_path):
+        """
+        Save the grid as a compressed .npz file.
+
+        :param grid_path: Output path
+        """
+        np.savez_compressed(grid_path, grid=self.grid, geotransform=np.array(self.geotransform),
+                            names=np.array(self.names, dtype=str), name_field=self.name_field, crs_wkt=self.crs_wkt)
+
+    @classmethod
+    def load(cls, grid_path, states_path):
+        """
+        Load a grid saved with save.
+
+        :param grid_path: Path to the .npz file
+        :param states_path: Path to the state outlines used for the exact fallback
+        :return: A StateLookup
+        """
+        with np.load(grid_path) as data:
+            return cls(data['grid'], data['geotransform'], data['names'], states_path, str(data['name_field']),
+                       str(data['crs_wkt']))
+
+    def _exact(self, x, y):
+        # Exact point in polygon test against the states around the point
+        if self._outlines is None:
+            source = ogr.Open(self.states_path)
+            layer = source.GetLayer()
+            self._outlines = [feature.GetGeometryRef().Clone() for feature in layer
+                              if feature.GetGeometryRef() is not None]
+            source = None
+
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(float(x), float(y))
+        for number, outline in enumerate(self._outlines):
+            min_x, max_x, min_y, max_y = outline.GetEnvelope()
+            if min_x <= x <= max_x and min_y <= y <= max_y and outline.Intersects(point):
+                return number
+        return -1
+
+    def lookup(self, xs, ys):
+        """
+        Assign a state to every point.
+
+        :param xs: Array of x coordinates in the coordinate system of the grid
+        :param ys: Array of y coordinates in the coordinate system of the grid
+        :return: Array of state names, StateLookup.outside for points outside every state
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        origin_x, cell_x, _, origin_y, _, cell_y = self.geotransform
+        rows, cols = self.grid.shape
+
+        col = np.floor((xs - origin_x) / cell_x).astype(int)
+        row = np.floor((ys - origin_y) / cell_y).astype(int)
+        inside = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+
+        numbers = np.full(len(xs), -1, dtype=int)
+        numbers[inside] = self.grid[row[inside], col[inside]]
+
+        for i in np.flatnonzero(numbers == -2):
+            numbers[i] = self._exact(xs[i], ys[i])
+
+        names = np.full(len(xs), self.outside, dtype=object)
+        found = numbers >= 0
+        names[found] = self.names[numbers[found]]
+        return names
+
+
+def load_state_lookup(states_path, grid_path=None, cell_size=None):
+    """
+    Load the state lookup grid, building and saving it first if it is missing or older than the outlines.
+
+    :param states_path: Path to the state polygon shapefile
+    :param grid_path: Path of the .npz grid (default: beside the shapefile, with a _grid.npz suffix)
+    :param cell_size: Cell size in map units used when the grid has to be built (default: see StateLookup.build)
+    :return: A StateLookup, or None if it could not be built
+    """
+    if grid_path is None:
+        grid_path = os.path.splitext(states_path)[0] + '_grid.npz'
+
+    if os.path.exists(grid_path) and (not os.path.exists(states_path)
+                                      or os.path.getmtime(grid_path) >= os.path.getmtime(states_path)):
+        return StateLookup.load(grid_path, states_path)
+
+    print(f"Building state lookup grid '{grid_path}'. This only happens once...")
+    lookup = StateLookup.build(states_path, cell_size)
+    if lookup is not None:
+        lookup.save(grid_path)
+    return lookup
@@ -0,0 +1,119 @@
+import numpy as np
+from scipy import ndimage
+
+
+def _border_levels(regions, level_grid, level_count):
+    """
+    Contour levels bordering every region between the contours.
+
+    :param regions: 2D int array of region labels, 0 on contour cells
+    :param level_grid: 2D int array holding the level number of contour cells and -1 elsewhere
+    :param level_count: Number of distinct levels
+    :return: Dictionary mapping region label to the array of level numbers of the contour cells next to it
+    """
+    keys = []
+    # Pairs of a region cell and a contour cell side by side, in both directions along both axes
+    for region_cells, neighbours in [(regions[:-1, :], level_grid[1:, :]), (regions[1:, :], level_grid[:-1, :]),
+                                     (regions[:, :-1], level_grid[:, 1:]), (regions[:, 1:], level_grid[:, :-1])]:
+        touching = (region_cells > 0) & (neighbours >= 0)
+        keys.append(region_cells[touching].astype(np.int64) * level_count + neighbours[touching])
+    keys = np.unique(np.concatenate(keys))
+    region_of_key = keys // level_count
+    labels, starts = np.unique(region_of_key, return_index=True)
+    return {label: keys[start:end] % level_count
+            for label, start, end in zip(labels.tolist(), starts, np.append(starts[1:], len(keys)))}
+
+
+def _fill_between_contours(contours):
+    # Full resolution interpolation, see interpolate_contour_surface
+    is_contour = ~np.isnan(contours)
+    levels = np.unique(contours[is_contour])
+    surface = contours.copy()
+
+    if len(levels) == 0:
+        return surface
+
+    level_grid = np.full(contours.shape, -1, dtype=int)
+    level_grid[is_contour] = np.searchsorted(levels, contours[is_contour])
+
+    # Rasterized contours are 8-connected lines, so 4-connected labelling splits the empty cells into
+    # the regions between neighbouring contours
+    regions, _ = ndimage.label(~is_contour)
+    borders = _border_levels(regions, level_grid, len(levels))
+
+    for label, region_slice in enumerate(ndimage.find_objects(regions), start=1):
+        border = borders.get(label)
+        if region_slice is None or border is None:
+            # No contour next to the region, it stays NaN
+            continue
+        # Grow the window by a cell so it holds the contour cells around the region
+        window = tuple(slice(max(part.start - 1, 0), part.stop + 1) for part in region_slice)
+        in_region = regions[window] == label
+        if len(border) == 1:
+            # e.g. inside the highest closed contour
+            surface[window][in_region] = levels[border[0]]
+            continue
+
+        # Only the cells of each level that touch the region count, so a cell is interpolated between the
+        # contours enclosing it and never toward a contour behind one of them. With two bordering levels
+        # the inverse distance weights are linear interpolation between them
+        next_to_region = ndimage.binary_dilation(in_region)
+        weights = np.zeros(in_region.sum())
+        weighted = np.zeros(in_region.sum())
+        for level in border:
+            edge = next_to_region & (level_grid[window] == level)
+            distance = ndimage.distance_transform_edt(~edge)[in_region]
+            weights += 1 / distance
+            weighted += levels[level] / distance
+        surface[window][in_region] = weighted / weights
+
+    return surface
+
+
+def interpolate_contour_surface(contours, mode='quality', downsample=4):
+    """
+    Interpolate a continuous elevation surface from rasterized contour lines.
+
+    Works like GRASS r.surf.contour: the empty cells are split into the regions enclosed by
+    the contours and each cell takes a value between the contour levels bordering its region,
+    weighted by the inverse Euclidean distance to the contour cells of each level next to the
+    region. Cells inside a single closed contour take its level; regions no contour borders
+    stay NaN.
+
+    :param contours: 2D array of contour elevations with NaN where there is no contour,
+                     e.g. from data_processing.rasterize_contours_to_array
+    :param mode: 'quality' interpolates at full resolution. 'fast' interpolates on a grid
+                 coarsened by `downsample`, resamples the result bilinearly back to full
+                 resolution and restores the exact contour cells.
+    :param downsample: Coarsening factor used by the 'fast' mode
+    :return: 2D array of the same shape as contours, NaN only in regions no contour borders
+    """
+    contours = np.asarray(contours, dtype=float)
+
+    if mode == 'quality' or downsample <= 1:
+        return _fill_between_contours(contours)
+    if mode != 'fast':
+        raise ValueError(f"Unknown interpolation mode '{mode}'")
+
+    rows, cols = contours.shape
+    coarse_rows = -(-rows // downsample)
+    coarse_cols = -(-cols // downsample)
+
+    # Coarsen by taking the highest contour in every block, padding the edges with NaN
+    padded = np.full((coarse_rows * downsample, coarse_cols * downsample), np.nan)
+    padded[:rows, :cols] = contours
+    blocks = padded.reshape(coarse_rows, downsample, coarse_cols, downsample)
+    coarse = np.where(np.isnan(blocks), -np.inf, blocks).max(axis=(1, 3))
+    coarse[np.isinf(coarse)] = np.nan
+
+    coarse_surface = _fill_between_contours(coarse)
+
+    # Resample the cell centres of the full grid from the coarse cell centres
+    row_positions = (np.arange(rows) + 0.5) / downsample - 0.5
+    col_positions = (np.arange(cols) + 0.5) / downsample - 0.5
+    grid_rows, grid_cols = np.meshgrid(row_positions, col_positions, indexing='ij')
+    surface = ndimage.map_coordinates(coarse_surface, [grid_rows, grid_cols], order=1, mode='nearest')
+
+    is_contour = ~np.isnan(contours)
+    surface[is_contour] = contours[is_contour]
+    return surface
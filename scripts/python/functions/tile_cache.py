@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import requests
+
+
+class TileCache:
+    """
+    Persistent on-disk cache for products downloaded from The National Map.
+
+    Every product zip is stored under a key derived from its product id and publication date,
+    so a newer edition of a quad gets a new entry while repeated requests for the same edition
+    are served from disk. Products API responses are cached by request URL as well and are
+    dropped once they are older than query_max_age. An index file records the size and last
+    access time of every entry and the least recently used zips are evicted once the cache grows
+    beyond max_bytes. Cache hits only update the index in memory, it is written when an entry is
+    added and by flush. The index is guarded by a lock so one cache can be shared by several
+    download threads.
+
+    :param cache_dir: Directory holding the cached zips and the index file
+    :param max_bytes: Maximum total size of the cached zips (default 5 GB)
+    :param query_max_age: Maximum age in seconds of a cached products API response (default 7 days)
+    """
+
+    index_name = 'index.json'
+
+    def __init__(self, cache_dir, max_bytes=5 * 1024 ** 3, query_max_age=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.query_max_age = query_max_age
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, self.index_name)
+        self._lock = threading.RLock()
+        self.index = self._load_index()
+        # Set when the index in memory has changes that are not written yet
+        self._dirty = False
+        # Bytes downloaded by fetch since the cache was opened, hits are not counted
+        self.bytes_downloaded = 0
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    index = json.load(f)
+                index.setdefault('tiles', {})
+                index.setdefault('queries', {})
+                self._prune_queries(index)
+                return index
+            except (OSError, ValueError) as e:
+                print(f"Error: Unable to read tile cache index '{self.index_path}', starting empty. {e}")
+        return {'tiles': {}, 'queries': {}}
+
+    def _save_index(self):
+        # Write to a temporary file first so an interrupted run never leaves a truncated index
+        self._prune_queries(self.index)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(temp_path, self.index_path)
+        self._dirty = False
+
+    def _prune_queries(self, index):
+        # Drop the products API responses older than query_max_age, they are never served again
+        now = time.time()
+        expired = [key for key, entry in index['queries'].items() if now - entry['created'] > self.query_max_age]
+        for key in expired:
+            del index['queries'][key]
+        return expired
+
+    def flush(self):
+        """
+        Write the index if cache hits changed it since it was last written.
+        """
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    @staticmethod
+    def key(item):
+        """
+        Cache key of a products API item, derived from its product id and publication date.
+
+        :param item: A dictionary from the 'items' list of a products API response
+        :return: Hex digest identifying the item
+        """
+        product_id = item.get('sourceId') or item.get('downloadURL') or item.get('title', '')
+        publication_date = item.get('publicationDate') or item.get('lastUpdated') or ''
+        return hashlib.sha256(f"{product_id}|{publication_date}".encode('utf-8')).hexdigest()
+
+    def size(self):
+        """
+        :return: Total size in bytes of the cached zips
+        """
+        with self._lock:
+            return sum(entry['size'] for entry in self.index['tiles'].values())
+
+    def get(self, item):
+        """
+        Look up a product in the cache.
+
+        :param item: A products API item
+        :return: Path to the cached zip, or None if it is not cached
+        """
+        key = self.key(item)
+        with self._lock:
+            entry = self.index['tiles'].get(key)
+            if entry is None:
+                return None
+
+            path = os.path.join(self.cache_dir, entry['file'])
+            if not os.path.exists(path):
+                # The file was removed behind our back, forget about it
+                del self.index['tiles'][key]
+                self._dirty = True
+                return None
+
+            entry['last_access'] = time.time()
+            self._dirty = True
+            return path
+
+    def put(self, item, source_path):
+        """
+        Move a downloaded zip into the cache.
+
+        :param item: The products API item the zip belongs to
+        :param source_path: Path of the downloaded zip, it is moved into the cache
+        :return: Path to the cached zip
+        """
+        key = self.key(item)
+        file_name = key + '.zip'
+        path = os.path.join(self.cache_dir, file_name)
+
+        with self._lock:
+            shutil.move(source_path, path)
+            self.index['tiles'][key] = {
+                'file': file_name,
+                'size': os.path.getsize(path),
+                'last_access': time.time(),
+                'title': item.get('title'),
+                'source_id': item.get('sourceId'),
+                'publication_date': item.get('publicationDate'),
+            }
+            self.evict(keep=key)
+            self._save_index()
+        return path
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used zips until the cache fits within max_bytes.
+
+        :param keep: Optional key that must not be evicted (e.g. the entry just added)
+        :return: List of evicted keys
+        """
+        evicted = []
+        with self._lock:
+            entries = sorted(self.index['tiles'].items(), key=lambda kv: kv[1]['last_access'])
+            total = self.size()
+            for key, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                try:
+                    os.remove(os.path.join(self.cache_dir, entry['file']))
+                except FileNotFoundError:
+                    pass
+                total -= entry['size']
+                del self.index['tiles'][key]
+                evicted.append(key)
+        return evicted
+
+    def fetch(self, item, session=None, chunk_size=1024 * 1024, progress=None):
+        """
+        Return the cached zip for a product, downloading it into the cache on a miss.
+
+        :param item: A products API item with a 'downloadURL'
+        :param session: Optional requests.Session used for the download
+        :param chunk_size: Size of the streamed chunks written to disk
+        :param progress: Optional callable receiving the size of every downloaded chunk
+        :return: Path to the cached zip, or None if the download failed
+        """
+        path = self.get(item)
+        if path is not None:
+            print(f"Shapefile '{item.get('title')}' found in tile cache.")
+            return path
+
+        download_url = item.get('downloadURL')
+        if not download_url:
+            print(f"Error: No download URL found for item '{item.get('title')}'.")
+            return None
+
+        http = session or requests
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with http.get(download_url, stream=True) as response:
+                    if response.status_code != 200:
+                        print(f"Error: Received status code {response.status_code} for '{download_url}'")
+                        return None
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        with self._lock:
+                            self.bytes_downloaded += len(chunk)
+                        if progress is not None:
+                            progress(len(chunk))
+            return self.put(item, temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def query_products(self, request_url, session=None):
+        """
+        Query the products API, serving repeated queries from the cache.
+
+        :param request_url: Full products API request URL
+        :param session: Optional requests.Session used for the request
+        :return: The list of items in the response, or None if the request failed
+        """
+        key = hashlib.sha256(request_url.encode('utf-8')).hexdigest()
+        with self._lock:
+            entry = self.index['queries'].get(key)
+        if entry is not None and time.time() - entry['created'] <= self.query_max_age:
+            return entry['items']
+
+        http = session or requests
+        response = http.get(request_url)
+        if response.status_code != 200:
+            print(f"Error: Received status code {response.status_code}")
+            return None
+        try:
+            items = response.json().get('items')
+        except ValueError:
+            print("Error: Unable to parse response as JSON")
+            print("Response content (first 200 characters):", response.content[:200])
+            return None
+        if items is None:
+            print("Error: No items found in the response")
+            return None
+
+        with self._lock:
+            self.index['queries'][key] = {'url': request_url, 'created': time.time(), 'items': items}
+            self._save_index()
+        return items
+
+    def clear(self):
+        """
+        Remove every cached zip and query.
+        """
+        with self._lock:
+            for entry in self.index['tiles'].values():
+                try:
+                    os.remove(os.path.join(self.cache_dir, entry['file']))
+                except FileNotFoundError:
+                    pass
+            self.index = {'tiles': {}, 'queries': {}}
+            self._save_index()
@@ -0,0 +1,211 @@
+import numpy as np
+import pyproj
+
+# The 7.5 minute topo packages of The National Map cover the cells of a 7.5 minute (0.125 degree) grid
+QUAD_SIZE = 0.125
+
+
+def quad_of(lon, lat, size=QUAD_SIZE):
+    """
+    :param lon: Longitudes in decimal degrees
+    :param lat: Latitudes in decimal degrees
+    :param size: Cell size in degrees (default 7.5 minutes)
+    :return: Tuple of (column, row) arrays of the grid cells holding the points, counted from -180 and -90
+    """
+    column = np.floor((np.asarray(lon, dtype=float) + 180) / size).astype(np.int64)
+    row = np.floor((np.asarray(lat, dtype=float) + 90) / size).astype(np.int64)
+    return column, row
+
+
+def serpentine(columns, rows):
+    """
+    Order grid cells row by row from north to south, reversing direction on every other row, so the
+    cell after each one is its neighbor wherever the grid is filled. Rows without cells are not counted
+    when alternating.
+
+    :param columns: Column of every cell
+    :param rows: Row of every cell
+    :return: Index array ordering the cells
+    """
+    columns = np.asarray(columns)
+    rows = np.asarray(rows)
+    row_rank = np.unique(-rows, return_inverse=True)[1].reshape(-1)
+    direction = np.where(row_rank % 2 == 0, columns, -columns)
+    return np.lexsort((direction, row_rank))
+
+
+def _offsets(keys):
+    # Positions of every key, sorting once and slicing between the offsets of each value
+    order = np.argsort(keys, kind='stable')
+    unique, starts = np.unique(keys[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    return {key.item(): order[start:end] for key, start, end in zip(unique, starts, ends)}
+
+
+class QuadScheduler:
+    """
+    Work plan of the extraction loop on the grid of the USGS 7.5 minute quadrangles.
+
+    Every point is assigned to the quad it falls in and every line to the quads its points fall in, so a
+    line crossing a quad edge belongs to each quad it touches. Working quad by quad, each topo package is
+    downloaded once and the contours of a quad are rasterized and sampled once for all the lines in it,
+    regardless of how the points were clustered. Quads are ordered in a serpentine sweep so consecutive
+    quads are neighbors, which keeps prefetched and cached tiles close to the ones in use.
+
+    A quad is too large to rasterize at 1 meter in one piece, its points are split into windows of
+    window_size map units that are rasterized one after the other (see windows). Besides its own
+    package, a quad needs the packages of the neighbors its edge windows reach into (see packages).
+
+    Quads are identified by an integer key, name gives a readable label.
+
+    :param fids: Feature IDs of the points
+    :param line_ids: Line ID of every point
+    :param x: X coordinate of every point
+    :param y: Y coordinate of every point
+    :param source_crs: Authority ID of the coordinate system of the points (e.g. 'EPSG:26912' for UTM Zone 12N)
+    :param size: Quad size in degrees (default 7.5 minutes)
+    :param window_size: Side of the rasterized windows in map units (default 2000)
+    """
+
+    def __init__(self, fids, line_ids, x, y, source_crs, size=QUAD_SIZE, window_size=2000):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        # Points without coordinates cannot be placed
+        located = np.isfinite(x) & np.isfinite(y)
+        self.fids = np.asarray(fids, dtype=np.int64)[located]
+        self.line_ids = np.asarray(line_ids)[located]
+        self.x = x[located]
+        self.y = y[located]
+        self.size = size
+        self.window_size = window_size
+        self.grid_columns = int(round(360 / size))
+
+        self.transformer = pyproj.Transformer.from_crs(source_crs, "EPSG:4326", always_xy=True)
+        lon, lat = self.transformer.transform(self.x, self.y)
+        column, row = quad_of(lon, lat, size)
+        self.point_quads = row * self.grid_columns + column
+
+        self._points = _offsets(self.point_quads)
+        self._lines = {quad: np.unique(self.line_ids[rows]) for quad, rows in self._points.items()}
+
+        # Lines touching more than one quad
+        if self._lines:
+            line_ids, counts = np.unique(np.concatenate(list(self._lines.values())), return_counts=True)
+            self.edge_lines = line_ids[counts > 1]
+        else:
+            self.edge_lines = self.line_ids[:0]
+
+    def __len__(self):
+        return len(self._points)
+
+    def cell(self, quad):
+        """
+        :return: Tuple of (column, row) of a quad on the grid
+        """
+        return quad % self.grid_columns, quad // self.grid_columns
+
+    def order(self):
+        """
+        :return: List of the keys of the quads holding points, in serpentine order
+        """
+        quads = np.array(sorted(self._points), dtype=np.int64)
+        columns, rows = self.cell(quads)
+        return quads[serpentine(columns, rows)].tolist()
+
+    def bounds(self, quad, inset=0.001):
+        """
+        Bounding box of a quad for the products API. It is shrunk by inset so the query does not return
+        the packages of the neighboring quads sharing its edges.
+
+        :param quad: Quad key
+        :param inset: Distance in degrees the box is shrunk by on every side
+        :return: Tuple of (min_lon, min_lat, max_lon, max_lat)
+        """
+        column, row = self.cell(quad)
+        min_lon = column * self.size - 180
+        min_lat = row * self.size - 90
+        return (min_lon + inset, min_lat + inset, min_lon + self.size - inset, min_lat + self.size - inset)
+
+    def packages(self, quad, padding=30):
+        """
+        Quads whose topo packages the windows of a quad are rasterized from: the quad itself and the
+        neighbors the padded box of a window along the quad edge reaches into.
+
+        :param quad: Quad key
+        :param padding: Distance in map units the windows are padded by, as in LayerMirror.bounding_box
+        :return: List of quad keys, the quad first
+        """
+        needed = [quad]
+        for rows in self._window_rows(quad):
+            min_x = self.x[rows].min() - padding
+            max_x = self.x[rows].max() + padding
+            min_y = self.y[rows].min() - padding
+            max_y = self.y[rows].max() + padding
+            # A window is much smaller than a quad, the quads of its corners are all the quads it touches
+            lon, lat = self.transformer.transform([min_x, min_x, max_x, max_x], [min_y, max_y, min_y, max_y])
+            column, row = quad_of(lon, lat, self.size)
+            for key in (row * self.grid_columns + column).tolist():
+                if key not in needed:
+                    needed.append(key)
+        return needed
+
+    def name(self, quad):
+        """
+        :return: Label of a quad from its south-east corner, e.g. '38.500N_109.625W'
+        """
+        column, row = self.cell(quad)
+        lat = row * self.size - 90
+        lon = (column + 1) * self.size - 180
+        return f"{abs(lat):.3f}{'N' if lat >= 0 else 'S'}_{abs(lon):.3f}{'E' if lon >= 0 else 'W'}"
+
+    def points(self, quad):
+        """
+        :return: Feature IDs of the points in a quad
+        """
+        rows = self._points.get(quad)
+        return self.fids[:0] if rows is None else self.fids[rows]
+
+    def lines(self, quad):
+        """
+        :return: Sorted line IDs of the lines touching a quad
+        """
+        return self._lines.get(quad, self.line_ids[:0])
+
+    def shared_lines(self, quad):
+        """
+        :return: Line IDs of the lines of a quad that also touch another quad
+        """
+        return np.intersect1d(self.lines(quad), self.edge_lines)
+
+    def windows(self, quad, fids=None):
+        """
+        Split the points of a quad into the windows of a window_size grid in map units, in serpentine order.
+
+        :param quad: Quad key
+        :param fids: Optional feature IDs restricting the points (e.g. the points still to sample)
+        :return: List of feature ID arrays, one per window holding points
+        """
+        return [self.fids[rows] for rows in self._window_rows(quad, fids)]
+
+    def _window_rows(self, quad, fids=None):
+        # Point rows of every window of a quad, in serpentine order
+        rows = self._points.get(quad)
+        if rows is None:
+            return []
+        if fids is not None:
+            rows = rows[np.isin(self.fids[rows], fids)]
+        if len(rows) == 0:
+            return []
+
+        columns = np.floor(self.x[rows] / self.window_size).astype(np.int64)
+        window_rows = np.floor(self.y[rows] / self.window_size).astype(np.int64)
+        # One key per window, relative to the first window so it stays small
+        columns -= columns.min()
+        window_rows -= window_rows.min()
+        keys = window_rows * (columns.max() + 1) + columns
+
+        windows = _offsets(keys)
+        window_keys = np.array(sorted(windows), dtype=np.int64)
+        width = columns.max() + 1
+        ordered = window_keys[serpentine(window_keys % width, window_keys // width)]
+        return [rows[windows[key]] for key in ordered.tolist()]
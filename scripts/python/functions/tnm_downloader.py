@@ -0,0 +1,231 @@
+import os
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import functions.project_setup as ps
+from functions.tile_cache import TileCache
+
+
+class TNMDownloader:
+    """
+    Concurrent downloader for The National Map topo packages.
+
+    Products API queries and zip downloads run on a thread pool sharing one pooled
+    requests.Session. Every download streams into its own file (the tile cache when one is
+    given, a per-item temporary file otherwise), so downloads can overlap safely. Tiles are
+    deduplicated by product id and publication date, which lets the driver prefetch the tiles
+    of the next cluster while the current one is being processed and later pick up the
+    already running (or finished) downloads.
+
+    :param cache: Optional functions.tile_cache.TileCache the zips are downloaded into
+    :param max_workers: Number of concurrent downloads
+    :param chunk_size: Size of the streamed chunks written to disk
+    :param api_url: Products API endpoint
+    """
+
+    def __init__(self, cache=None, max_workers=4, chunk_size=1024 * 1024, api_url=ps.TNM_PRODUCTS_URL):
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.api_url = api_url
+
+        self.session = requests.Session()
+        retries = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._bytes_downloaded = 0
+        # Bytes downloaded per item key, handed to the download call that uses the item
+        self._item_bytes = {}
+        # Bytes downloaded for the items of the last download call, prefetched ones included
+        self.last_download_bytes = 0
+
+    @property
+    def bytes_downloaded(self):
+        """
+        Bytes downloaded so far, including the downloads into the cache. Prefetched tiles are counted
+        when they are downloaded, not when they are used (see last_download_bytes).
+        """
+        total = self._bytes_downloaded
+        if self.cache is not None:
+            total += self.cache.bytes_downloaded
+        return total
+
+    def products(self, bbox):
+        """
+        Query the products API for the topo packages covering a bounding box.
+
+        :param bbox: Tuple of (min_lon, min_lat, max_lon, max_lat)
+        :return: List of products API items, or None if the request failed
+        """
+        request_url = ps.build_tnm_request_url(bbox, self.api_url)
+        if self.cache is not None:
+            return self.cache.query_products(request_url, session=self.session)
+
+        response = self.session.get(request_url)
+        if response.status_code != 200:
+            print(f"Error: Received status code {response.status_code}")
+            return None
+        try:
+            return response.json().get("items")
+        except ValueError:
+            print("Error: Unable to parse response as JSON")
+            print("Response content (first 200 characters):", response.content[:200])
+            return None
+
+    def _count(self, key, size):
+        with self._lock:
+            self._item_bytes[key] = self._item_bytes.get(key, 0) + size
+
+    def _download(self, item):
+        # Runs on the pool: returns the path of the downloaded zip or None
+        key = TileCache.key(item)
+        if self.cache is not None:
+            return self.cache.fetch(item, session=self.session, chunk_size=self.chunk_size,
+                                    progress=lambda size: self._count(key, size))
+
+        download_url = item.get("downloadURL")
+        if not download_url:
+            print(f"Error: No download URL found for item '{item.get('title')}'.")
+            return None
+
+        fd, temp_zip_path = tempfile.mkstemp(suffix=".zip")
+        with os.fdopen(fd, "wb") as f:
+            with self.session.get(download_url, stream=True) as response:
+                if response.status_code != 200:
+                    print(f"Error: Received status code {response.status_code} for '{download_url}'")
+                    os.remove(temp_zip_path)
+                    return None
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    with self._lock:
+                        self._bytes_downloaded += len(chunk)
+                    self._count(key, len(chunk))
+        return temp_zip_path
+
+    def submit(self, items):
+        """
+        Start downloading products, reusing downloads that are already running or finished.
+
+        :param items: List of products API items
+        :return: Dictionary mapping each submitted future to its item
+        """
+        submitted = {}
+        with self._lock:
+            for item in items:
+                key = TileCache.key(item)
+                future = self._futures.get(key)
+                if future is None:
+                    future = self.executor.submit(self._download, item)
+                    self._futures[key] = future
+                submitted[future] = item
+        return submitted
+
+    def prefetch(self, bbox):
+        """
+        Start downloading the tiles covering a bounding box in the background.
+
+        :param bbox: Tuple of (min_lon, min_lat, max_lon, max_lat)
+        :return: A future resolving to the submitted items once the query has finished
+        """
+        def query_and_submit():
+            items = self.products(bbox)
+            if items:
+                self.submit(items)
+            return items
+
+        return self.executor.submit(query_and_submit)
+
+    def completed(self, items):
+        """
+        Yield downloaded products as soon as each one finishes.
+
+        :param items: List of products API items
+        :return: Generator of (item, zip path) tuples, the path is None if the download failed
+        """
+        submitted = self.submit(items)
+        for future in as_completed(submitted):
+            item = submitted[future]
+            try:
+                yield item, future.result()
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f"Error downloading '{item.get('title')}': {e}")
+                yield item, None
+            finally:
+                # Each download is handed out once, later requests go through the cache again
+                with self._lock:
+                    self._futures.pop(TileCache.key(item), None)
+
+    def download(self, bbox, output_folder, layers=None):
+        """
+        Download and extract every topo package covering a bounding box, extracting each
+        package as soon as its download completes. The bytes downloaded for these packages, by this
+        call or by an earlier prefetch, are stored in last_download_bytes.
+
+        :param bbox: Tuple of (min_lon, min_lat, max_lon, max_lat)
+        :param output_folder: Directory to extract each product into, one folder per item title
+        :param layers: Optional list of layer name substrings; only those shapefiles are extracted
+        :return: List of extracted folders or None if an error occurred
+        """
+        self.last_download_bytes = 0
+        items = self.products(bbox)
+        if not items:
+            print("Error: No shapefiles found for the given bounding box.")
+            return None
+
+        extracted_folders = []
+        to_download = []
+        for item in items:
+            title = item.get("title", "default_folder")
+            specific_output_folder = os.path.join(output_folder, title)
+            os.makedirs(specific_output_folder, exist_ok=True)
+
+            # Check if the shapefile has already been extracted
+            if os.listdir(specific_output_folder):
+                print(f"Shapefile '{title}' already exists in '{specific_output_folder}'. Skipping download.")
+                extracted_folders.append(specific_output_folder)
+            else:
+                to_download.append(item)
+
+        for item, zip_path in self.completed(to_download):
+            title = item.get("title", "default_folder")
+            if zip_path is None:
+                continue
+
+            if not zipfile.is_zipfile(zip_path):
+                print(f"Error: The downloaded file '{title}' is not a valid zipfile.")
+            else:
+                specific_output_folder = os.path.join(output_folder, title)
+                ps.unzip_folder(zip_path, specific_output_folder, layers)
+                print(f"Shapefile '{title}' downloaded and extracted successfully.")
+                extracted_folders.append(specific_output_folder)
+
+            if self.cache is None:
+                os.remove(zip_path)
+
+        with self._lock:
+            self.last_download_bytes = sum(self._item_bytes.pop(TileCache.key(item), 0) for item in items)
+        if self.cache is not None:
+            # The access times of the cache hits are written once per download
+            self.cache.flush()
+        return extracted_folders
+
+    def shutdown(self, wait=True):
+        """
+        Stop the thread pool and close the session.
+
+        :param wait: Wait for running downloads to finish
+        """
+        self.executor.shutdown(wait=wait)
+        self.session.close()
+        if self.cache is not None:
+            self.cache.flush()
@@ -0,0 +1,125 @@
+"""
+Run the pipeline without the QGIS desktop, e.g. on a batch node.
+
+    python scripts/python/run_pipeline.py
+    python scripts/python/run_pipeline.py --stages extract model
+    python scripts/python/run_pipeline.py --project /data/SkyLineSearch.qgz --stages import extract model search
+
+A standalone QgsApplication is started with the offscreen Qt platform and the numbered scripts are
+run one after the other in a shared namespace, the same way they share the QGIS Python console:
+names defined by 01_importing_layers.py (paths, layers, fingerprints, ...) are visible to
+02_data_extraction.py and so on. The namespace is seeded with what the console provides
+(qgis.core, processing, os, re, iface as None). Layers are loaded with ps.add_vector_layer and
+canvas refreshes and symbology are skipped because there is no canvas.
+
+The project file is only used for its location, which the scripts take as the project directory;
+its layers are not loaded. The working directory is changed to the project directory so the
+relative paths of 03_modeling.py resolve.
+"""
+import os
+import sys
+import time
+import runpy
+import argparse
+
+# No display on batch nodes
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+scripts_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scripts_directory)
+
+from qgis.core import QgsApplication, QgsProject
+
+STAGES = {
+    'import': '01_importing_layers.py',
+    'extract': '02_data_extraction.py',
+    'model': '03_modeling.py',
+    'search': '04_candidate_search.py',
+}
+
+
+def start_qgis(prefix_path=None):
+    """
+    Start a standalone QGIS application with the processing framework (GRASS is used when installed).
+
+    :param prefix_path: QGIS install prefix, only needed when it is not found automatically
+    :return: The QgsApplication, exit it with exitQgis()
+    """
+    if prefix_path:
+        QgsApplication.setPrefixPath(prefix_path, True)
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+
+    # The processing plugin ships with QGIS but is only on the path inside the desktop application
+    plugins_directory = os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins')
+    if plugins_directory not in sys.path:
+        sys.path.append(plugins_directory)
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    return qgs
+
+
+def console_namespace():
+    """
+    :return: Dictionary of the names the QGIS Python console makes available to the scripts
+    """
+    namespace = {}
+    exec('from qgis.core import *', namespace)
+    exec('from qgis.PyQt.QtCore import QVariant', namespace)
+    import re
+    import processing
+    namespace.update({'os': os, 'sys': sys, 're': re, 'processing': processing, 'iface': None})
+    return namespace
+
+
+def run_stages(stages, project_path):
+    """
+    Run the scripts of the given stages in order in one namespace.
+
+    :param stages: Stage names, keys of STAGES
+    :param project_path: Path to the QGIS project file, its folder is the project directory
+    :return: The namespace after the last stage
+    """
+    QgsProject.instance().setFileName(project_path)
+    os.chdir(os.path.dirname(project_path))
+
+    namespace = console_namespace()
+    for stage in stages:
+        script = os.path.join(scripts_directory, STAGES[stage])
+        print(f"==== {stage}: {STAGES[stage]} ====")
+        start = time.perf_counter()
+        namespace = runpy.run_path(script, init_globals=namespace, run_name='__main__')
+        print(f"==== {stage} finished in {time.perf_counter() - start:.1f} s ====")
+    return namespace
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--project', default=os.path.join(scripts_directory, '..', '..', 'SkyLineSearch.qgz'),
+                        help='QGIS project file, its folder is used as the project directory')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=['import', 'extract', 'model'],
+                        help='Stages to run, in order (default: import extract model)')
+    parser.add_argument('--qgis-prefix', default=os.environ.get('QGIS_PREFIX_PATH'),
+                        help='QGIS install prefix (default: $QGIS_PREFIX_PATH)')
+    args = parser.parse_args()
+
+    project_path = os.path.abspath(args.project)
+    if not os.path.exists(project_path):
+        print(f"Error: Project file '{project_path}' not found")
+        return 1
+    if 'extract' in args.stages and 'import' not in args.stages:
+        # 02 reads paths and layers defined by 01 from the shared namespace
+        print("Error: The extract stage needs the import stage in the same run")
+        return 1
+
+    qgs = start_qgis(args.qgis_prefix)
+    try:
+        run_stages(args.stages, project_path)
+    finally:
+        qgs.exitQgis()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
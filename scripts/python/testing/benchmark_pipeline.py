@@ -0,0 +1,445 @@
+"""
+Time the extraction stages on synthetic data at increasing sizes and store the results as JSON.
+
+Run headless from the repository root, e.g.
+
+    python scripts/python/testing/benchmark_pipeline.py --sizes 100 1000 10000 100000
+    python scripts/python/testing/benchmark_pipeline.py --sizes 100 1000 --compare logs/benchmarks/pipeline_<time>.json
+
+Lines are generated in clusters of --cluster-size lines, like the climbing areas of the real data,
+each cluster with a few cone shaped hills (contour rings every 10 feet) and a few polygons. Every
+stage is timed with the QGIS function used by the pipeline and with the engine that runs without
+QGIS, where there is one:
+
+    lines_to_points               dp.lines_to_points             / densify_lines
+    cluster_points_with_dbscan    dp.cluster_points_with_dbscan  / DBSCAN on the coordinate array
+    check_features_within_bounds  dp.check_features_within_bounds (QGIS only, its within-tests have no native engine)
+    rasterize_contours_within_bbox  dp.rasterize_contours_within_bbox (GRASS) / rasterize_contours_to_array
+    sample_raster_values          dp.sample_raster_values        / sample_array_at_points
+    split_and_compute_stats       split_and_compute_stats per line / segment_features
+
+The raster stages run once per cluster over the cluster's bounding box, as 02_data_extraction.py
+does. QGIS engines are skipped when qgis cannot be imported and above --qgis-max-size lines, the
+per line loop of split_and_compute_stats above --loop-max-size lines.
+
+With --compare, every stage is matched with the same stage, engine and size of an earlier result
+file and the script exits with status 1 if any of them got slower by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import numpy as np
+import pandas as pd
+
+project_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.append(os.path.join(project_directory, 'scripts', 'python'))
+
+from osgeo import gdal, ogr, osr
+
+import functions.data_cleaning as dc
+from functions.profile_sampling import densify_lines, rasterize_contours_to_array, sample_array_at_points
+
+# Headless Qt, so the QGIS engines also run without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+try:
+    from qgis.core import (QgsApplication, QgsProject, QgsVectorLayer, QgsRasterLayer, QgsFeature,
+                           QgsGeometry, QgsPointXY, QgsField)
+    from qgis.PyQt.QtCore import QVariant
+    have_qgis = True
+except ImportError:
+    have_qgis = False
+
+try:
+    from sklearn.cluster import DBSCAN
+    from sklearn.preprocessing import StandardScaler
+    have_sklearn = True
+except ImportError:
+    have_sklearn = False
+
+EPSG = 26912
+CLUSTER_RADIUS = 500
+CLUSTER_SPACING = 5000
+CONTOUR_INTERVAL = 10
+
+
+def generate_fixtures(size, cluster_size=100, min_length=20, max_length=120, seed=0):
+    """
+    Synthetic anchors, hills and polygons for `size` lines.
+
+    :return: Dictionary of arrays: line parts (home and far anchor), line cluster, cluster centres,
+             hills (x, y, height in feet, slope in feet per meter) and polygons (x, y, radius, value)
+    """
+    rng = np.random.default_rng(seed)
+    clusters = max(int(np.ceil(size / cluster_size)), 1)
+    side = int(np.ceil(np.sqrt(clusters)))
+    cells = rng.permutation(side * side)[:clusters]
+    centres = np.column_stack((cells % side, cells // side)) * CLUSTER_SPACING + np.array([400000, 4400000])
+
+    line_cluster = np.arange(size) % clusters
+    radius = CLUSTER_RADIUS * np.sqrt(rng.random(size))
+    angle = rng.random(size) * 2 * np.pi
+    home = centres[line_cluster] + np.column_stack((radius * np.cos(angle), radius * np.sin(angle)))
+    length = rng.uniform(min_length, max_length, size)
+    heading = rng.random(size) * 2 * np.pi
+    far = home + np.column_stack((length * np.cos(heading), length * np.sin(heading)))
+
+    hills_per_cluster = 5
+    hill_cluster = np.repeat(np.arange(clusters), hills_per_cluster)
+    hill_xy = centres[hill_cluster] + rng.uniform(-CLUSTER_RADIUS, CLUSTER_RADIUS, (len(hill_cluster), 2))
+    hills = np.column_stack((hill_xy, rng.uniform(100, 300, len(hill_cluster)), rng.uniform(0.5, 1.5, len(hill_cluster))))
+
+    polygons_per_cluster = 3
+    polygon_cluster = np.repeat(np.arange(clusters), polygons_per_cluster)
+    polygon_xy = centres[polygon_cluster] + rng.uniform(-CLUSTER_RADIUS, CLUSTER_RADIUS, (len(polygon_cluster), 2))
+    polygons = np.column_stack((polygon_xy, rng.uniform(100, 400, len(polygon_cluster)), np.arange(len(polygon_cluster))))
+
+    return {'home': home, 'far': far, 'line_cluster': line_cluster, 'centres': centres,
+            'hill_cluster': hill_cluster, 'hills': hills, 'polygons': polygons}
+
+
+def surface_window(hills, bbox, cell_size=1):
+    # Elevation in feet of the cone shaped hills over a bounding box, the highest cone wins
+    min_x, min_y, max_x, max_y = bbox
+    cols = int(np.ceil((max_x - min_x) / cell_size))
+    rows = int(np.ceil((max_y - min_y) / cell_size))
+    xs = min_x + (np.arange(cols) + 0.5) * cell_size
+    ys = max_y - (np.arange(rows) + 0.5) * cell_size
+    surface = np.zeros((rows, cols))
+    for x, y, height, slope in hills:
+        distance = np.hypot(xs[None, :] - x, ys[:, None] - y)
+        np.maximum(surface, height - slope * distance, out=surface)
+    return surface, (min_x, cell_size, 0, max_y, 0, -cell_size)
+
+
+def cluster_bbox(fixtures, cluster):
+    # Bounding box of the lines of a cluster, padded by a few meters like the anchors bounding boxes
+    in_cluster = fixtures['line_cluster'] == cluster
+    xy = np.concatenate((fixtures['home'][in_cluster], fixtures['far'][in_cluster]))
+    return tuple(np.floor(xy.min(axis=0) - 5)) + tuple(np.ceil(xy.max(axis=0) + 5))
+
+
+def write_vector_fixtures(fixtures, folder):
+    """
+    Write the contour rings and polygons as shapefiles for the engines that read files.
+
+    :return: Dictionary of paths under 'contours' and 'polygons'
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    paths = {name: os.path.join(folder, f'{name}.shp') for name in ['contours', 'polygons']}
+
+    source = driver.CreateDataSource(paths['contours'])
+    layer = source.CreateLayer('contours', srs, ogr.wkbLineString)
+    layer.CreateField(ogr.FieldDefn('ContourEle', ogr.OFTReal))
+    angles = np.linspace(0, 2 * np.pi, 65)
+    for x, y, height, slope in fixtures['hills']:
+        for elevation in np.arange(CONTOUR_INTERVAL, height, CONTOUR_INTERVAL):
+            ring_radius = (height - elevation) / slope
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('ContourEle', float(elevation))
+            geometry = ogr.Geometry(ogr.wkbLineString)
+            for a in angles:
+                geometry.AddPoint_2D(x + ring_radius * np.cos(a), y + ring_radius * np.sin(a))
+            feature.SetGeometry(geometry)
+            layer.CreateFeature(feature)
+    source = None
+
+    source = driver.CreateDataSource(paths['polygons'])
+    layer = source.CreateLayer('polygons', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('NAME', ogr.OFTString))
+    angles = np.linspace(0, 2 * np.pi, 9)
+    for x, y, polygon_radius, value in fixtures['polygons']:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('NAME', f'polygon_{int(value)}')
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for a in angles:
+            ring.AddPoint_2D(x + polygon_radius * np.cos(a), y + polygon_radius * np.sin(a))
+        geometry = ogr.Geometry(ogr.wkbPolygon)
+        geometry.AddGeometry(ring)
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+    source = None
+
+    return paths
+
+
+def write_raster(path, array, geotransform):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    rows, cols = array.shape
+    dataset = gdal.GetDriverByName('GTiff').Create(path, cols, rows, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset = None
+
+
+def profile_table(fixtures, line_ids, index, xs, ys):
+    # Points of every line with the elevation of its cluster's hills, as in highline_anchors_points
+    hills_per_cluster = np.bincount(fixtures['hill_cluster'])[0]
+    point_cluster = fixtures['line_cluster'][line_ids - 1]
+    elevation = np.zeros(len(xs))
+    for k in range(hills_per_cluster):
+        x, y, height, slope = fixtures['hills'][point_cluster * hills_per_cluster + k].T
+        np.maximum(elevation, height - slope * np.hypot(xs - x, ys - y), out=elevation)
+    return pd.DataFrame({'line_id': line_ids, 'index': index, 'elevation': elevation})
+
+
+class Timer:
+    """
+    Collects the runtime of every stage, engine and size.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def record(self, stage, engine, size, seconds, items):
+        self.results.append({'stage': stage, 'engine': engine, 'size': size,
+                             'seconds': round(seconds, 6), 'items': int(items)})
+        print(f"  {stage:<32} {engine:<8} {seconds:10.3f} s  ({int(items)} items)")
+
+
+def run_native(fixtures, paths, size, timer):
+    # Stages that only need NumPy, pandas, GDAL and (for DBSCAN) scikit-learn
+    line_ids = np.arange(1, size + 1)
+    parts = [np.array([home, far]) for home, far in zip(fixtures['home'], fixtures['far'])]
+
+    start = time.perf_counter()
+    point_line_ids, point_index, xs, ys = densify_lines(parts, line_ids, spacing=1)
+    timer.record('lines_to_points', 'numpy', size, time.perf_counter() - start, len(xs))
+
+    if have_sklearn:
+        start = time.perf_counter()
+        points_scaled = StandardScaler().fit_transform(fixtures['home'])
+        DBSCAN(eps=0.1, min_samples=5).fit(points_scaled)
+        timer.record('cluster_points_with_dbscan', 'numpy', size, time.perf_counter() - start, size)
+
+    # Raster stages, once per cluster; the points are grouped by cluster beforehand (not timed)
+    point_cluster = fixtures['line_cluster'][point_line_ids - 1]
+    order = np.argsort(point_cluster, kind='stable')
+    bounds = np.searchsorted(point_cluster[order], np.arange(len(fixtures['centres']) + 1))
+    rasterize_seconds, sample_seconds, cells, sampled = 0, 0, 0, 0
+    for cluster in range(len(fixtures['centres'])):
+        bbox = cluster_bbox(fixtures, cluster)
+        start = time.perf_counter()
+        contour_array, geotransform = rasterize_contours_to_array(paths['contours'], bbox, 'ContourEle')
+        rasterize_seconds += time.perf_counter() - start
+        cells += contour_array.size
+
+        surface, geotransform = surface_window(fixtures['hills'][fixtures['hill_cluster'] == cluster], bbox)
+        members = order[bounds[cluster]:bounds[cluster + 1]]
+        start = time.perf_counter()
+        sample_array_at_points(surface, geotransform, xs[members], ys[members])
+        sample_seconds += time.perf_counter() - start
+        sampled += len(members)
+    timer.record('rasterize_contours_within_bbox', 'numpy', size, rasterize_seconds, cells)
+    timer.record('sample_raster_values', 'numpy', size, sample_seconds, sampled)
+
+    profiles = profile_table(fixtures, point_line_ids, point_index, xs, ys)
+    start = time.perf_counter()
+    dc.segment_features(profiles)
+    timer.record('split_and_compute_stats', 'numpy', size, time.perf_counter() - start, size)
+    return profiles
+
+
+def run_loop(profiles, size, timer):
+    # The per line loop 03_modeling.py used before segment_features
+    start = time.perf_counter()
+    pd.concat([dc.split_and_compute_stats(line_id, group) for line_id, group in profiles.groupby('line_id')])
+    timer.record('split_and_compute_stats', 'loop', size, time.perf_counter() - start, size)
+
+
+def memory_layer(geometry_type, name, fields):
+    layer = QgsVectorLayer(f'{geometry_type}?crs=EPSG:{EPSG}', name, 'memory')
+    layer.dataProvider().addAttributes([QgsField(field_name, field_type) for field_name, field_type in fields])
+    layer.updateFields()
+    QgsProject.instance().addMapLayer(layer)
+    return layer
+
+
+def run_qgis(fixtures, paths, size, folder, timer):
+    # The QGIS functions of data_processing on memory layers registered in the project
+    import functions.data_processing as dp
+
+    lines = memory_layer('LineString', 'bench_lines', [('line_id', QVariant.Int)])
+    features = []
+    for line_id, (home, far) in enumerate(zip(fixtures['home'], fixtures['far']), start=1):
+        feature = QgsFeature(lines.fields())
+        feature.setGeometry(QgsGeometry.fromPolylineXY([QgsPointXY(*home), QgsPointXY(*far)]))
+        feature.setAttributes([line_id])
+        features.append(feature)
+    lines.dataProvider().addFeatures(features)
+
+    anchors = memory_layer('Point', 'bench_anchors', [('line_id', QVariant.Int)])
+    features = []
+    for line_id, home in enumerate(fixtures['home'], start=1):
+        feature = QgsFeature(anchors.fields())
+        feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(*home)))
+        feature.setAttributes([line_id])
+        features.append(feature)
+    anchors.dataProvider().addFeatures(features)
+
+    polygons = QgsVectorLayer(paths['polygons'], 'bench_polygons', 'ogr')
+    QgsProject.instance().addMapLayer(polygons)
+
+    start = time.perf_counter()
+    dp.lines_to_points('bench_lines', 'bench_points', 'line_id')
+    points = QgsProject.instance().mapLayersByName('bench_points')[0]
+    timer.record('lines_to_points', 'qgis', size, time.perf_counter() - start, points.featureCount())
+
+    if have_sklearn:
+        start = time.perf_counter()
+        dp.cluster_points_with_dbscan('bench_anchors')
+        timer.record('cluster_points_with_dbscan', 'qgis', size, time.perf_counter() - start, size)
+
+    start = time.perf_counter()
+    dp.check_features_within_bounds('bench_lines', 'bench_polygons', 'within')
+    timer.record('check_features_within_bounds', 'qgis', size, time.perf_counter() - start, size)
+
+    # Raster stages, once per cluster with the cluster's bounding box as a layer
+    rasterize_seconds, sample_seconds, cells, sampled = 0, 0, 0, 0
+    rasterized = True
+    for cluster in range(len(fixtures['centres'])):
+        bbox = cluster_bbox(fixtures, cluster)
+        bbox_layer = memory_layer('Polygon', 'bench_bbox', [])
+        feature = QgsFeature()
+        feature.setGeometry(QgsGeometry.fromPolygonXY([[QgsPointXY(bbox[0], bbox[1]), QgsPointXY(bbox[2], bbox[1]),
+                                                        QgsPointXY(bbox[2], bbox[3]), QgsPointXY(bbox[0], bbox[3])]]))
+        bbox_layer.dataProvider().addFeatures([feature])
+        bbox_layer.updateExtents()
+
+        if rasterized:
+            output_path = os.path.join(folder, f'contours_{cluster}.tif')
+            start = time.perf_counter()
+            rasterized = dp.rasterize_contours_within_bbox(paths['contours'], 'bench_bbox', 'ContourEle', output_path)
+            rasterize_seconds += time.perf_counter() - start
+            cells += (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+            for layer in QgsProject.instance().mapLayersByName('Rasterized Contours'):
+                QgsProject.instance().removeMapLayer(layer.id())
+
+        surface_path = os.path.join(folder, f'surface_{cluster}.tif')
+        write_raster(surface_path, *surface_window(fixtures['hills'][fixtures['hill_cluster'] == cluster], bbox))
+        surface = QgsRasterLayer(surface_path, 'bench_surface')
+        QgsProject.instance().addMapLayer(surface)
+        start = time.perf_counter()
+        feature_ids, _ = dp.sample_raster_values('bench_points', 'bench_surface', 'bench_bbox')
+        sample_seconds += time.perf_counter() - start
+        sampled += len(feature_ids)
+
+        QgsProject.instance().removeMapLayer(surface.id())
+        QgsProject.instance().removeMapLayer(bbox_layer.id())
+
+    # r.surf.contour needs the GRASS provider; its absence is reported by rasterize_contours_within_bbox
+    if rasterized:
+        timer.record('rasterize_contours_within_bbox', 'qgis', size, rasterize_seconds, cells)
+    timer.record('sample_raster_values', 'qgis', size, sample_seconds, sampled)
+
+    QgsProject.instance().removeAllMapLayers()
+    dp.clear_polygon_index_cache()
+
+
+def compare_results(results, previous_path, tolerance):
+    """
+    Print the change of every stage against an earlier result file.
+
+    :return: Number of stages slower than tolerance times their earlier runtime
+    """
+    with open(previous_path, 'r') as f:
+        previous = {(r['stage'], r['engine'], r['size']): r['seconds'] for r in json.load(f)['results']}
+
+    regressions = 0
+    print(f"\nCompared with {previous_path}:")
+    for r in results:
+        before = previous.get((r['stage'], r['engine'], r['size']))
+        if before is None or before <= 0:
+            continue
+        ratio = r['seconds'] / before
+        flag = ''
+        if ratio > tolerance:
+            flag = '  SLOWER'
+            regressions += 1
+        print(f"  {r['stage']:<32} {r['engine']:<8} {r['size']:>7}  {before:10.3f} s -> {r['seconds']:10.3f} s  "
+              f"x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000], help='Numbers of lines')
+    parser.add_argument('--cluster-size', type=int, default=100, help='Lines per cluster')
+    parser.add_argument('--qgis-max-size', type=int, default=10000, help='Largest size the QGIS engines run at')
+    parser.add_argument('--loop-max-size', type=int, default=10000,
+                        help='Largest size the split_and_compute_stats loop runs at')
+    parser.add_argument('--skip-qgis', action='store_true', help='Only time the engines that run without QGIS')
+    parser.add_argument('--output', default=None,
+                        help='Result file (default: logs/benchmarks/pipeline_<time>.json)')
+    parser.add_argument('--compare', default=None, help='Earlier result file to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='Slowdown ratio reported as a regression')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    use_qgis = have_qgis and not args.skip_qgis
+    if not have_qgis and not args.skip_qgis:
+        print("qgis could not be imported, only the engines that run without QGIS are timed.")
+    if not have_sklearn:
+        print("scikit-learn could not be imported, cluster_points_with_dbscan is skipped.")
+
+    if use_qgis:
+        qgs = QgsApplication([], False)
+        qgs.initQgis()
+        from processing.core.Processing import Processing
+        Processing.initialize()
+
+    timer = Timer()
+    for size in args.sizes:
+        print(f"\n{size} lines")
+        folder = tempfile.mkdtemp(prefix='benchmark_pipeline_')
+        try:
+            fixtures = generate_fixtures(size, args.cluster_size, seed=args.seed)
+            paths = write_vector_fixtures(fixtures, folder)
+            profiles = run_native(fixtures, paths, size, timer)
+            if size <= args.loop_max_size:
+                run_loop(profiles, size, timer)
+            if use_qgis and size <= args.qgis_max_size:
+                run_qgis(fixtures, paths, size, folder, timer)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    output_path = args.output
+    if output_path is None:
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_path = os.path.join(project_directory, 'logs', 'benchmarks', f'pipeline_{stamp}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump({
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'gdal': gdal.__version__,
+            'qgis': QgsApplication.version() if use_qgis else None,
+            'sizes': args.sizes,
+            'cluster_size': args.cluster_size,
+            'seed': args.seed,
+            'results': timer.results,
+        }, f, indent=1)
+    print(f"\nResults written to {output_path}")
+
+    status = 0
+    if args.compare:
+        status = 1 if compare_results(timer.results, args.compare, args.tolerance) else 0
+
+    if use_qgis:
+        qgs.exitQgis()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+Compare the in-process contour interpolation (functions.surface_interpolation) against
+GRASS r.surf.contour on synthetic contours, or on a contour shapefile given with --contours.
+
+Run headless from the repository root, e.g.
+
+    python scripts/python/testing/benchmark_surface_interpolation.py --size 500
+    python scripts/python/testing/benchmark_surface_interpolation.py --contours <Elev_Contour.shp>
+
+Without --contours, the contour rings of a group of cone shaped hills are generated as in
+benchmark_pipeline.py. The contours are rasterized once at 1 meter cells over a --size x --size
+window around the centre of the contours. Each engine then builds a surface from the same raster,
+and the runtimes and differences between the surfaces are printed. For synthetic contours, each
+surface is also compared with the true cone surface between the lowest and highest contour.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+project_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.append(os.path.join(project_directory, 'scripts', 'python'))
+
+from qgis.core import QgsApplication
+from osgeo import gdal, ogr
+
+qgs = QgsApplication([], False)
+qgs.initQgis()
+
+import processing
+from processing.core.Processing import Processing
+Processing.initialize()
+
+import functions.data_processing as dp
+import functions.surface_interpolation as si
+from benchmark_pipeline import generate_fixtures, write_vector_fixtures, surface_window
+
+
+def run_r_surf_contour(contour_array, geotransform, projection):
+    # Write the rasterized contours to a GeoTIFF, run r.surf.contour on it and read the result back
+    temp_dir = tempfile.mkdtemp()
+    input_path = os.path.join(temp_dir, 'contours.tif')
+    output_path = os.path.join(temp_dir, 'surface.tif')
+
+    rows, cols = contour_array.shape
+    dataset = gdal.GetDriverByName('GTiff').Create(input_path, cols, rows, 1, gdal.GDT_Float64)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(projection)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    band.WriteArray(np.where(np.isnan(contour_array), -9999, contour_array))
+    dataset = None
+
+    start = time.perf_counter()
+    processing.run("grass7:r.surf.contour", {
+        'input': input_path,
+        'output': output_path,
+        'GRASS_REGION_PARAMETER': None,
+        'GRASS_REGION_CELLSIZE_PARAMETER': 0,
+        'GRASS_RASTER_FORMAT_OPT': '',
+        'GRASS_RASTER_FORMAT_META': ''
+    })
+    elapsed = time.perf_counter() - start
+
+    surface, _ = dp.read_raster_window(output_path)
+    return surface, elapsed
+
+
+def compare(name, surface, reference, reference_name='r.surf.contour', mask=None):
+    difference = surface - reference
+    valid = ~np.isnan(difference)
+    if mask is not None:
+        valid &= mask
+    print(f"  {name} vs {reference_name}: mean abs diff {np.abs(difference[valid]).mean():.3f}, "
+          f"rmse {np.sqrt((difference[valid] ** 2).mean()):.3f}, max abs diff {np.abs(difference[valid]).max():.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contours', default=None, help='Contour shapefile (default: synthetic cone hills)')
+    parser.add_argument('--attribute', default='ContourEle')
+    parser.add_argument('--size', type=float, default=500, help='Width and height of the window in map units')
+    parser.add_argument('--downsample', type=int, default=4, help='Coarsening factor of the fast mode')
+    parser.add_argument('--skip-grass', action='store_true', help='Only time the in-process engine')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fixtures = None
+    if args.contours is None:
+        # One cluster of hills, its contour rings are written to a temporary shapefile
+        fixtures = generate_fixtures(1, seed=args.seed)
+        args.contours = write_vector_fixtures(fixtures, tempfile.mkdtemp())['contours']
+
+    source = ogr.Open(args.contours)
+    if source is None:
+        print(f"Error: Unable to open contours '{args.contours}'")
+        return 1
+    layer = source.GetLayer()
+    min_x, max_x, min_y, max_y = layer.GetExtent()
+    projection = layer.GetSpatialRef().ExportToWkt() if layer.GetSpatialRef() else ''
+    source = None
+
+    centre_x, centre_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+    half = args.size / 2
+    bbox = (centre_x - half, centre_y - half, centre_x + half, centre_y + half)
+
+    start = time.perf_counter()
+    contour_array, geotransform = dp.rasterize_contours_to_array(args.contours, bbox, args.attribute)
+    print(f"Rasterized {contour_array.shape[0]} x {contour_array.shape[1]} cells "
+          f"({int((~np.isnan(contour_array)).sum())} contour cells) in {time.perf_counter() - start:.3f} s")
+
+    surfaces = {}
+    for mode in ['quality', 'fast']:
+        start = time.perf_counter()
+        surfaces[mode] = si.interpolate_contour_surface(contour_array, mode=mode, downsample=args.downsample)
+        print(f"  native {mode}: {time.perf_counter() - start:.3f} s")
+
+    if fixtures is not None:
+        truth, _ = surface_window(fixtures['hills'], bbox)
+        truth = truth[:contour_array.shape[0], :contour_array.shape[1]]
+        contour_levels = contour_array[~np.isnan(contour_array)]
+        # Outside the lowest and above the highest contour there is nothing to interpolate between
+        between = (truth >= contour_levels.min()) & (truth <= contour_levels.max())
+        for mode, surface in surfaces.items():
+            compare(f"native {mode}", surface, truth, 'true surface', between)
+
+    if not args.skip_grass:
+        reference, elapsed = run_r_surf_contour(contour_array, geotransform, projection)
+        print(f"  r.surf.contour: {elapsed:.3f} s")
+        for mode, surface in surfaces.items():
+            compare(f"native {mode}", surface, reference)
+
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    qgs.exitQgis()
+    sys.exit(status)